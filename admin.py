@@ -0,0 +1,74 @@
+from utils import *
+import sys
+
+class AdminServer:
+    """
+    A local control socket for a running node, for the things we would otherwise have to restart it for (profiling, dumping traces).
+    A client connects, sends one command line, gets the text reply and the connection is closed. It only listens on 127.0.0.1,
+    anyone who can reach it can control the node.
+    Run this file to send a command: python admin.py <port> <command> [args]
+    """
+    def __init__(self, port, handler):
+        """
+        args:
+        - port: The port to listen on
+        - handler: Called with the command line (split into words) on the server thread, returns the reply text
+        """
+        self.handler = handler
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", port))
+        self.socket.listen()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        """
+        Answers one client at a time, commands are rare and the ones that take a while (stopping the profiler) are still quick.
+        """
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:
+                return # closed
+            with connection:
+                try:
+                    connection.settimeout(ADMIN_TIMEOUT)
+                    line = b''
+                    while not line.endswith(b"\n") and len(line) < ADMIN_MAX_COMMAND:
+                        data = connection.recv(ADMIN_MAX_COMMAND)
+                        if not data:
+                            break
+                        line += data
+                    try:
+                        reply = self.handler(line.decode('utf-8').split())
+                    except Exception as e:
+                        reply = f"error: {e}"
+                    connection.sendall((reply + "\n").encode('utf-8'))
+                except OSError:
+                    pass # the client went away, nothing to tell it
+
+    def close(self):
+        self.socket.close()
+
+def send_command(port, words):
+    """
+    Sends a command to a node's admin socket and returns the reply.
+    args:
+    - port: The node's admin port
+    - words: The command and its arguments
+    """
+    with socket.create_connection(("127.0.0.1", port), timeout=ADMIN_TIMEOUT) as connection:
+        connection.sendall((" ".join(words) + "\n").encode('utf-8'))
+        reply = b''
+        while True:
+            data = connection.recv(4096)
+            if not data:
+                break
+            reply += data
+    return reply.decode('utf-8')
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("usage: python admin.py <admin port> <command> [args], try the command help")
+        sys.exit(1)
+    print(send_command(int(sys.argv[1]), sys.argv[2:]), end="")
@@ -0,0 +1,97 @@
+"""
+Light node memory benchmark: how much memory a light node's chain takes per header, with headers kept as Blocks with no data
+(what check_header used to make) and as Header records.
+Builds a chain of --headers headers, then feeds it to a fresh light node once for each, measuring what it allocates with tracemalloc.
+Proof of work is turned off (START_ZEROS = 0) so building the chain does not take forever, it does not change what is kept.
+"""
+import argparse
+import gc
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import utils
+utils.START_ZEROS = 0
+import peer as peer_module
+import peer_light
+from peer_light import LightNode
+from block import Block
+from header_store import Header
+
+parser = argparse.ArgumentParser(description="Memory per header on a light node, Block vs Header.")
+parser.add_argument("--headers", type=int, default=100000, help="Length of the chain")
+parser.add_argument("--port", type=int, default=7800, help="First port to use")
+args = parser.parse_args()
+
+peer_module.TIME_TARGET = 1 # headers are built one second apart
+
+def build_headers(node, length):
+    """
+    Makes length headers on top of each other, timestamps one second apart ending now, adding each one to node as it goes
+    (getDifficulty needs the chain). Returns them as bytes, oldest first.
+    """
+    start = int(time.time()) - length - 5
+    headers = []
+    parent = None
+    with node.data_lock:
+        for index in range(length):
+            prev_hash = b'\x00' * 32 if parent is None else parent.hash
+            difficulty = node.getDifficulty(parent)
+            nonce = 0
+            while True:
+                header = b''.join([index.to_bytes(4, byteorder='big'), prev_hash, b'\x00' * 32, (start + index).to_bytes(8, byteorder='big'),
+                                   difficulty.to_bytes(4, byteorder='big'), nonce.to_bytes(4, byteorder='big')])
+                if utils.check_proof_of_work(utils.hashy(header), difficulty):
+                    break
+                nonce += 1
+            assert node.check_header(header, parent), f"header {index} did not check out"
+            parent = node.biggest_chain
+            headers.append(header)
+    return headers
+
+def load(node, headers):
+    """
+    Adds the headers to node the way receive_headers does. Returns (bytes allocated and still held, seconds).
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    with node.data_lock:
+        parent = None
+        for header in headers:
+            node.check_header(header, parent)
+            parent = node.blocks[utils.hashy(header)]
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert node.biggest_chain.index == len(headers) - 1
+    return size, elapsed
+
+directory = tempfile.mkdtemp(prefix="bench_light_headers_")
+cwd = os.getcwd()
+os.chdir(directory) # the nodes' log files go here
+try:
+    print(f"Building {args.headers} headers...")
+    start = time.time()
+    builder = LightNode("build", args.port)
+    builder.logger.level = utils.LOG_ERROR
+    headers = build_headers(builder, args.headers)
+    print(f"Built in {time.time() - start:.1f} seconds")
+    results = {}
+    for offset, (name, kind) in enumerate((("Block, no data", Block), ("Header", Header))):
+        peer_light.Header = kind # what check_header makes
+        node = LightNode(f"light_{offset}", args.port + 1 + offset)
+        node.logger.level = utils.LOG_ERROR # check_header logs every header, that is not what we are measuring
+        results[name] = load(node, headers)
+        node.logger.flush()
+    peer_light.Header = Header
+    for name, (size, elapsed) in results.items():
+        print(f"{name:<15} {size / 2**20:8.1f} MB, {size / len(headers):7.0f} bytes per header, loaded in {elapsed:.2f} seconds")
+    old, new = results["Block, no data"][0], results["Header"][0]
+    print(f"Header uses {old / new:.1f}x less memory")
+finally:
+    os.chdir(cwd)
+    shutil.rmtree(directory, ignore_errors=True)
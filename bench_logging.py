@@ -0,0 +1,96 @@
+"""
+Logging benchmark: how many votes a node admits per second with the log at debug level, with it turned down to errors only,
+and with the old way of logging (every message written and flushed to the file on the calling thread, under a lock).
+Every vote is checked for real (signature included), so the difference is what logging costs on the vote path.
+"""
+import argparse
+import base64
+import gc
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import utils
+from peer import Peer
+from election import Election
+from vote import Vote
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
+
+parser = argparse.ArgumentParser(description="Vote admission throughput with logging on and off.")
+parser.add_argument("--voters", type=int, default=200, help="Voter keys, each votes once in every election")
+parser.add_argument("--elections", type=int, default=50, help="Elections, so a run admits voters * elections votes")
+parser.add_argument("--rounds", type=int, default=5, help="Runs of each mode, the best one is reported")
+parser.add_argument("--port", type=int, default=7700, help="First port to use")
+args = parser.parse_args()
+
+def make_keys(count):
+    private_keys = []
+    public_keys = []
+    for _ in range(count):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=1024)
+        private_keys.append(key)
+        public_keys.append(base64.b64encode(key.public_key().public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)).decode('utf-8'))
+    return private_keys, public_keys
+
+def old_write_log(peer, path):
+    """
+    Swaps in the logging the peer had before: lock, write, flush, on the caller's thread.
+    """
+    lock = threading.Lock()
+    log = open(path, "a")
+    def write_log(message, level = None):
+        if callable(message):
+            message = message()
+        with lock:
+            log.write(f"{time.time()}: {message}\n")
+            log.flush()
+    peer.write_log = write_log
+
+def run(mode, port, directory, elections, messages):
+    """
+    Admits every vote into a fresh node, returns the seconds it took (including getting the log onto disk).
+    """
+    level = utils.LOG_ERROR if mode == "off" else utils.LOG_DEBUG
+    node = Peer(os.path.join(directory, f"{mode}_{port}"), port, log_level=level)
+    if mode == "sync":
+        old_write_log(node, os.path.join(directory, f"{mode}_{port}_sync.log"))
+    with node.data_lock:
+        for election_dict in elections:
+            election = Election(election_dict)
+            node.open_elections[election.hashy] = election
+    gc.collect()
+    gc.disable() # like timeit, the nodes from earlier runs would otherwise make the collector slower every run
+    start = time.perf_counter()
+    for message in messages:
+        node.handle_vote(message, None)
+    node.logger.flush()
+    elapsed = time.perf_counter() - start
+    gc.enable()
+    assert len(node.new_votes) == len(messages), f"{mode}: only {len(node.new_votes)} of {len(messages)} votes admitted"
+    return elapsed
+
+directory = tempfile.mkdtemp(prefix="bench_logging_")
+try:
+    print(f"Making {args.voters} voter keys...")
+    private_keys, public_keys = make_keys(args.voters)
+    elections = [Election({"name": f"bench {i}", "choices": ["A", "B"], "public_keys": public_keys, "end_time": int(time.time()) + 10**6}) for i in range(args.elections)]
+    messages = [Vote({"election_hash": base64.b64encode(election.hashy).decode('utf-8'), "choice": "A",
+                      "public_key": public_keys[i], "signature": Vote.sign(private_keys[i], election.hashy, "A")}).jsonify().encode('utf-8')
+                for election in elections for i in range(args.voters)]
+    port = args.port
+    results = {}
+    for mode in ("sync", "debug", "off"):
+        best = None
+        for _ in range(args.rounds):
+            elapsed = run(mode, port, directory, [election.get_json_dict() for election in elections], messages)
+            port += 1
+            best = elapsed if best is None else min(best, elapsed)
+        results[mode] = best
+    names = {"sync": "old (write + flush per message)", "debug": "logger, debug level", "off": "logger, errors only"}
+    for mode, elapsed in results.items():
+        print(f"{names[mode]:<34} {len(messages) / elapsed:8.0f} votes/second ({elapsed * 1e6 / len(messages):.0f} us per vote)")
+finally:
+    shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,114 @@
+"""
+Startup benchmark: how long a node takes to come back up from its block store, replaying every block vs loading a snapshot.
+Builds a chain of --blocks blocks (with some elections and votes in it) into a temporary data directory, then starts a node
+on it twice, once with the snapshot moved out of the way and once with it.
+Proof of work is turned off (START_ZEROS = 0) so building the chain does not take forever, it does not change what restart does.
+"""
+import argparse
+import base64
+import os
+import shutil
+import tempfile
+import time
+
+import utils
+utils.START_ZEROS = 0
+import peer as peer_module
+from peer import Peer
+from block import Block
+from election import Election
+from vote import Vote
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
+
+parser = argparse.ArgumentParser(description="Compare a full replay with a snapshot load on startup.")
+parser.add_argument("--blocks", type=int, default=10000, help="Length of the chain")
+parser.add_argument("--voters", type=int, default=200, help="Voters per election")
+parser.add_argument("--elections", type=int, default=5, help="Elections in the chain")
+parser.add_argument("--port", type=int, default=7600, help="First port to use")
+args = parser.parse_args()
+
+peer_module.TIME_TARGET = 1 # blocks are built one second apart
+
+def make_keys(count):
+    private_keys = []
+    public_keys = []
+    for _ in range(count):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=1024)
+        private_keys.append(key)
+        public_keys.append(base64.b64encode(key.public_key().public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)).decode('utf-8'))
+    return private_keys, public_keys
+
+def build_chain(node, length, objects_for):
+    """
+    Mines length blocks straight into node (no network), timestamps one second apart ending now.
+    """
+    start = int(time.time()) - length - 5
+    for index in range(length):
+        parent = node.biggest_chain
+        prev_hash = b'\x00' * 32 if parent is None else parent.hash
+        objects = objects_for(index)
+        merkle_root = node.get_merkle_root(objects)
+        difficulty = node.getDifficulty(parent)
+        timestamp = start + index
+        nonce = 0
+        while True:
+            header = b''.join([index.to_bytes(4, byteorder='big'), prev_hash, merkle_root, timestamp.to_bytes(8, byteorder='big'), difficulty.to_bytes(4, byteorder='big'), nonce.to_bytes(4, byteorder='big')])
+            header_hash = utils.hashy(header)
+            if utils.check_proof_of_work(header_hash, difficulty):
+                break
+            nonce += 1
+        block = Block(index, header_hash, prev_hash, merkle_root, timestamp, difficulty, nonce, parent, data=objects)
+        node.handle_block(block.get_sendable(), None, False)
+
+directory = tempfile.mkdtemp(prefix="bench_restart_")
+data_dir = os.path.join(directory, "data")
+try:
+    print(f"Making {args.voters} voter keys...")
+    private_keys, public_keys = make_keys(args.voters)
+    elections = [Election({"name": f"election {i}", "choices": ["A", "B"], "public_keys": public_keys, "end_time": int(time.time()) + 10**6}) for i in range(args.elections)]
+    # each election goes in its own block, then its votes spread out one per block after it
+    spacing = args.blocks // (args.elections + 1)
+    def objects_for(index):
+        objects = []
+        for number, election in enumerate(elections):
+            first = 1 + number * spacing
+            if index == first:
+                objects.append(election)
+            elif first < index <= first + args.voters:
+                voter = index - first - 1
+                choice = "A" if voter % 3 else "B"
+                objects.append(Vote({"election_hash": base64.b64encode(election.hashy).decode('utf-8'), "choice": choice,
+                                     "public_key": public_keys[voter], "signature": Vote.sign(private_keys[voter], election.hashy, choice)}))
+        return objects
+
+    print(f"Building a {args.blocks} block chain...")
+    start = time.time()
+    builder = Peer(os.path.join(directory, "build"), args.port, data_dir=data_dir)
+    build_chain(builder, args.blocks, objects_for)
+    with builder.data_lock:
+        builder.write_snapshot()
+        expected = builder.chain_state.to_dict()
+        tip = builder.biggest_chain.hash
+    builder.block_store.close()
+    print(f"Built in {time.time() - start:.1f} seconds")
+
+    snapshot = os.path.join(data_dir, "snapshot.json")
+    shutil.move(snapshot, snapshot + ".aside")
+    start = time.perf_counter()
+    full = Peer(os.path.join(directory, "full"), args.port + 1, data_dir=data_dir)
+    full_time = time.perf_counter() - start
+    full.block_store.close()
+
+    shutil.move(snapshot + ".aside", snapshot)
+    start = time.perf_counter()
+    snap = Peer(os.path.join(directory, "snap"), args.port + 2, data_dir=data_dir)
+    snap_time = time.perf_counter() - start
+
+    for name, node in (("full replay", full), ("snapshot", snap)):
+        assert node.biggest_chain.hash == tip, f"{name} ended on the wrong tip"
+        assert node.chain_state.to_dict() == expected, f"{name} has the wrong chain state"
+    print(f"Full replay:   {full_time:.3f} seconds")
+    print(f"Snapshot load: {snap_time:.3f} seconds ({full_time / snap_time:.1f}x faster)")
+finally:
+    shutil.rmtree(directory, ignore_errors=True)
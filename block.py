@@ -8,7 +8,13 @@ class Block:
     """
     Simple class to represent a block in the blockchain.
     """
-    def __init__(self, index, out_hash, previous_hash, merkle_root, timestamp, difficulty, nonce, parent = None, data = []):
+    def __init__(self, index, out_hash, previous_hash, merkle_root, timestamp, difficulty, nonce, parent = None, data = [], loader = None, sendable = None):
+        """
+        args:
+        - data: The objects in the block. None if the body is only on disk, it is read back with loader the first time it is needed
+        - loader: Takes the block hash and returns the objects in the block (reads them from the block store)
+        - sendable: The block as it came in over the network, if we have it, so it never has to be serialized again
+        """
         assert isinstance(index, int), "Index must be an integer"
         assert isinstance(previous_hash, bytes), "Previous hash must be bytes"
         assert isinstance(merkle_root, bytes), "Merkle root must be bytes"
@@ -23,37 +29,100 @@ class Block:
         self.index = index
         self.previous_hash = previous_hash
         self.timestamp = timestamp
-        self.elections = {}
-        self.votes = {}
-        self.election_ends = {}
         self.merkle_root = merkle_root
         self.nonce = nonce
-        self.data = data
+        self.hash = out_hash 
+        self.difficulty = difficulty
+        self.loader = loader
+        self.body = None # (data, leaves, votes, elections, election_ends), None while the body is only on disk
+        self.pruned = False # the body is no longer kept in memory, see prune
+        self.sendable = sendable # get_sendable bytes, built the first time they are needed if we did not get them with the block
+        if data is not None:
+            self.body = self.build_body(data)
+
+    def build_body(self, data):
+        """
+        Sorts the objects in the block into votes, elections and ends, and hashes them into the merkle leaves.
+        """
         transactions = []
-        for data in self.data:
-            transactions.append(data.jsonify())
+        for item in data:
+            transactions.append(item.jsonify())
 
         # First, hash all transactions if they aren't already hashed
-        self.leaves = [hashy(tx) for tx in transactions]
-        while len(self.leaves) < 2**MAX_LEVELS:
-            self.leaves.append(b'\x00' * 32)
+        leaves = [hashy(tx) for tx in transactions]
+        while len(leaves) < 2**MAX_LEVELS:
+            leaves.append(b'\x00' * 32)
         
-        for item in self.data:
+        votes = {}
+        elections = {}
+        election_ends = {}
+        for item in data:
             if type(item) == Vote:
-                if item.election_hash not in self.votes:
-                    self.votes[item.election_hash] = []
-                self.votes[item.election_hash].append(item)
+                if item.election_hash not in votes:
+                    votes[item.election_hash] = []
+                votes[item.election_hash].append(item)
             elif type(item) == Election:
-                self.elections[hashy(item.jsonify())] = item
+                elections[hashy(item.jsonify())] = item
             elif type(item) == EndOfElection:
-                self.election_ends[item.election_hash] = item
+                election_ends[item.election_hash] = item
             else:
                 raise ValueError(f"Invalid data type in block: {type(item)}")
-            
-            
+        return (data, leaves, votes, elections, election_ends)
+
+    def get_body(self):
+        """
+        Returns the body, reading it back from disk if it is not in memory. Pruned bodies are read back every time, not kept.
+        """
+        if self.body is not None:
+            return self.body
+        if self.loader is None:
+            raise ValueError(f"Body of block {self.index} is not available")
+        body = self.build_body(self.loader(self.hash))
+        if not self.pruned:
+            self.body = body
+        return body
+
+    def has_body(self):
+        """
+        If the body is in memory right now.
+        """
+        return self.body is not None
+
+    def has_data(self):
+        """
+        If we can still get the objects in the block, from memory or from disk.
+        """
+        return self.body is not None or self.loader is not None
+
+    def prune(self):
+        """
+        Drops the body from memory for good, only the header is kept. If there is a loader it is read back from disk when needed,
+        if not it is gone.
+        """
+        self.body = None
+        self.sendable = None
+        self.pruned = True
+
+    @property
+    def data(self):
+        return self.get_body()[0]
+
+    @property
+    def leaves(self):
+        return self.get_body()[1]
+
+    @property
+    def votes(self):
+        return self.get_body()[2]
+
+    @property
+    def elections(self):
+        return self.get_body()[3]
+
+    @property
+    def election_ends(self):
+        return self.get_body()[4]
 
-        self.hash = out_hash 
-        self.difficulty = difficulty
     def get_header(self):
         return b''.join([
             self.index.to_bytes(4, byteorder='big'),
@@ -66,8 +135,10 @@ class Block:
     
     def get_sendable(self):
         """
-        Returns the block in a format that can be sent over the network.
+        Returns the block in a format that can be sent over the network. Kept after the first time, unless the block is pruned.
         """
+        if self.sendable is not None:
+            return self.sendable
         # Creating the header
         header = self.get_header() 
         # Creating the body (transactions in the block)
@@ -76,7 +147,10 @@ class Block:
         for data in self.data:
             body[count] = data.get_json_dict()
             count += 1
-        return header + json.dumps(body).encode('utf-8')
+        sendable = header + json.dumps(body).encode('utf-8')
+        if not self.pruned:
+            self.sendable = sendable
+        return sendable
     
 
     def create_merkle_tree(self):
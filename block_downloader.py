@@ -0,0 +1,106 @@
+from utils import *
+from collections import OrderedDict
+
+class BlockDownloader:
+    """
+    Schedules block downloads across every node we are connected to.
+    Missing hashes are queued oldest first and handed out in batches to whichever nodes have room in their window.
+    If a node does not answer in time, the hash goes back to the front of the queue and is given to a different node.
+    Not thread safe on its own, the peer calls everything with its data lock held.
+    """
+    def __init__(self):
+        self.wanted = OrderedDict() # hash -> [nodes that already failed to send it, number of tries], oldest first
+        self.in_flight = {} # hash -> (node it was requested from, time requested, [failed nodes, tries])
+        self.block_size = 1000 # moving average of the size of the blocks we get, to guess how long a node will take
+
+    def add(self, hashes):
+        """
+        Queues up hashes to download.
+        args:
+        - hashes: The block hashes, oldest first
+        """
+        for hashy in hashes:
+            if hashy not in self.wanted and hashy not in self.in_flight:
+                self.wanted[hashy] = [set(), 0]
+
+    def is_pending(self, hashy):
+        """
+        Checks if we are already going to get this block, so nobody else needs to ask for it.
+        """
+        return hashy in self.wanted or hashy in self.in_flight
+
+    def received(self, hashy, size):
+        """
+        Marks a block as here. Returns the node we had requested it from and when, or (None, None) if we never asked for it.
+        args:
+        - hashy: The hash of the block
+        - size: The size of the block in bytes
+        """
+        if hashy in self.wanted:
+            del self.wanted[hashy] # got it some other way, like a relay
+        if hashy not in self.in_flight:
+            return None, None
+        node, requested, _ = self.in_flight.pop(hashy)
+        node.blocks_in_flight.discard(hashy)
+        self.block_size = 0.9 * self.block_size + 0.1 * size
+        return node, requested
+
+    def schedule(self, nodes, now):
+        """
+        Hands out queued hashes to the nodes, BLOCKS_PER_BATCH at a time, round robin, until every window is full or the queue is empty.
+        The node we expect to get through its queue soonest (round trip time, throughput and blocks already in flight) goes first.
+        Returns a dict of node -> list of hashes to request from it.
+
+        args:
+        - nodes: The nodes that can answer GET_BLOCKS
+        - now: The current time
+        """
+        requests = {}
+        progress = True
+        while self.wanted and progress:
+            progress = False
+            for node in sorted(nodes, key=lambda n: n.expected_time((len(n.blocks_in_flight) + BLOCKS_PER_BATCH) * self.block_size)):
+                room = min(BLOCK_WINDOW - len(node.blocks_in_flight), BLOCKS_PER_BATCH)
+                if room <= 0:
+                    continue
+                batch = []
+                for hashy, state in self.wanted.items():
+                    if len(batch) >= room:
+                        break
+                    if node not in state[0]:
+                        batch.append(hashy)
+                for hashy in batch:
+                    state = self.wanted.pop(hashy)
+                    state[1] += 1
+                    self.in_flight[hashy] = (node, now, state)
+                    node.blocks_in_flight.add(hashy)
+                if batch:
+                    requests.setdefault(node, []).extend(batch)
+                    progress = True
+        return requests
+
+    def expire(self, nodes, now):
+        """
+        Takes back requests that timed out, or that went to a node we are no longer connected to.
+        They go back to the front of the queue, marked so they are not given to the same node again.
+        Hashes that have failed too many times are dropped. Returns the list of hashes that were taken back.
+
+        args:
+        - nodes: The nodes that can answer GET_BLOCKS
+        - now: The current time
+        """
+        expired = []
+        for hashy, (node, requested, state) in self.in_flight.items():
+            if node not in nodes or now - requested > BLOCK_TIMEOUT:
+                expired.append(hashy)
+        for hashy in reversed(expired):
+            node, _, state = self.in_flight.pop(hashy)
+            node.blocks_in_flight.discard(hashy)
+            if state[1] >= BLOCK_MAX_TRIES:
+                continue
+            state[0].add(node)
+            if all(n in state[0] for n in nodes):
+                state[0] = set() # everyone has failed it once, let them all try again
+            self.wanted[hashy] = state
+            self.wanted.move_to_end(hashy, last=False)
+        return expired
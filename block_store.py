@@ -0,0 +1,171 @@
+from utils import *
+import os
+import json
+
+class BlockStore:
+    """
+    Keeps every block we accept on disk, so a restart does not have to download and verify the chain again.
+    Blocks are appended to segment files as their raw get_sendable bytes, a new segment is started once one passes SEGMENT_SIZE.
+    A separate append-only index file has one fixed size record per block: hash -> (segment, offset, length, height).
+    The index is read back into memory on startup. Nothing is ever rewritten, so a crash can at worst leave a half written
+    record at the end, which is dropped the next time we open the store.
+    """
+    def __init__(self, directory):
+        """
+        args:
+        - directory: Where to keep the files, created if it does not exist
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.index = {} # hash -> (segment, offset, length, height)
+        self.lock = threading.Lock()
+        self.readers = {} # segment -> open file, for reading blocks back
+        self.segment = 0
+        self.load_index()
+        self.segment_file = open(self.segment_path(self.segment), "ab")
+        self.index_file = open(os.path.join(directory, "index.dat"), "ab")
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"blocks_{segment:05d}.dat")
+
+    def load_index(self):
+        """
+        Reads the index file into memory. Records for blocks whose bytes never made it to the segment file, and a half written
+        last record, are dropped (and cut off the file, so new records line up again).
+        """
+        path = os.path.join(self.directory, "index.dat")
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            raw = f.read()
+        sizes = {}
+        good = 0
+        for start in range(0, len(raw) - BLOCK_INDEX_RECORD_SIZE + 1, BLOCK_INDEX_RECORD_SIZE):
+            record = raw[start:start + BLOCK_INDEX_RECORD_SIZE]
+            hashy = record[:32]
+            segment = int.from_bytes(record[32:36], byteorder='big')
+            offset = int.from_bytes(record[36:44], byteorder='big')
+            length = int.from_bytes(record[44:48], byteorder='big')
+            height = int.from_bytes(record[48:52], byteorder='big')
+            if segment not in sizes:
+                path_segment = self.segment_path(segment)
+                sizes[segment] = os.path.getsize(path_segment) if os.path.exists(path_segment) else 0
+            if offset + length > sizes[segment]:
+                break
+            self.index[hashy] = (segment, offset, length, height)
+            self.segment = max(self.segment, segment)
+            good = start + BLOCK_INDEX_RECORD_SIZE
+        if good != len(raw):
+            with open(path, "r+b") as f:
+                f.truncate(good)
+
+    def __contains__(self, hashy):
+        return hashy in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def put(self, hashy, height, data):
+        """
+        Appends a block. Does nothing if we already have it.
+        args:
+        - hashy: The hash of the block
+        - height: The index of the block
+        - data: The block as get_sendable bytes
+        """
+        with self.lock:
+            if hashy in self.index:
+                return
+            offset = self.segment_file.tell()
+            if offset > 0 and offset + len(data) > SEGMENT_SIZE:
+                self.segment_file.close()
+                self.segment += 1
+                self.segment_file = open(self.segment_path(self.segment), "ab")
+                offset = 0
+            self.segment_file.write(data)
+            self.segment_file.flush() # the block has to be on disk before the index points at it
+            self.index_file.write(hashy + self.segment.to_bytes(4, byteorder='big') + offset.to_bytes(8, byteorder='big') + len(data).to_bytes(4, byteorder='big') + height.to_bytes(4, byteorder='big'))
+            self.index_file.flush()
+            self.index[hashy] = (self.segment, offset, len(data), height)
+
+    def get(self, hashy, header_only = False):
+        """
+        Reads a block back. Returns the get_sendable bytes, or None if we dont have it.
+        args:
+        - hashy: The hash of the block
+        - header_only: Only read the header
+        """
+        with self.lock:
+            if hashy not in self.index:
+                return None
+            segment, offset, length, _ = self.index[hashy]
+            if segment not in self.readers:
+                self.readers[segment] = open(self.segment_path(segment), "rb")
+            reader = self.readers[segment]
+            reader.seek(offset)
+            return reader.read(HEADER_SIZE if header_only else length)
+
+    def height(self, hashy):
+        """
+        The height of a block we have, or None.
+        """
+        entry = self.index.get(hashy)
+        return entry[3] if entry is not None else None
+
+    def load(self, header_only = False):
+        """
+        Yields (hash, height, bytes) for every block we have, lowest height first so parents always come before their children.
+        args:
+        - header_only: Only read the headers
+        """
+        with self.lock:
+            entries = sorted(self.index.items(), key=lambda item: item[1][3])
+        for hashy, entry in entries:
+            data = self.get(hashy, header_only)
+            if data is not None:
+                yield hashy, entry[3], data
+
+    def write_snapshot(self, tip, height, state):
+        """
+        Writes a snapshot of the chain state at tip, with a checksum so a torn or edited file is not trusted.
+        It goes to a temporary file first and is then renamed over the old one, so there is always one whole snapshot.
+        args:
+        - tip: The hash of the block the state is for
+        - height: Its index
+        - state: The state, anything json can write
+        """
+        body = json.dumps({"tip": base64.b64encode(tip).decode('utf-8'), "height": height, "state": state}, sort_keys=True)
+        path = os.path.join(self.directory, "snapshot.json")
+        with open(path + ".tmp", "w") as f:
+            f.write(json.dumps({"checksum": hashy(body).hex(), "body": body}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def read_snapshot(self):
+        """
+        Reads the snapshot back. Returns (tip hash, height, state), or None if there is none, the checksum is wrong,
+        or we dont have its tip block.
+        """
+        path = os.path.join(self.directory, "snapshot.json")
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                wrapper = json.load(f)
+            if hashy(wrapper["body"]).hex() != wrapper["checksum"]:
+                return None
+            body = json.loads(wrapper["body"])
+            tip = base64.b64decode(body["tip"])
+        except (ValueError, KeyError, TypeError):
+            return None
+        if tip not in self.index:
+            return None
+        return tip, body["height"], body["state"]
+
+    def close(self):
+        with self.lock:
+            self.segment_file.close()
+            self.index_file.close()
+            for reader in self.readers.values():
+                reader.close()
@@ -0,0 +1,85 @@
+from utils import *
+from election import Election
+
+class ChainState:
+    """
+    What the main chain adds up to: every election on it, the vote tally for each, the keys that have voted and the elections that have ended.
+    Kept up to date block by block as the tip moves (set_tip), so checking a new block on the tip does not have to walk the chain.
+    Can be written out and read back as a dict, for snapshots.
+    """
+    def __init__(self):
+        self.elections = {} # election hash -> (Election, height of the block it is in)
+        self.tallies = {} # election hash -> {choice: votes}
+        self.used_keys = {} # election hash -> {public key: choice}
+        self.ended = {} # election hash -> height of the block with its end
+
+    def connect(self, block):
+        """
+        Adds a block that has just joined the main chain.
+        """
+        for election_hash, election in block.elections.items():
+            self.elections[election_hash] = (election, block.index)
+            self.tallies.setdefault(election_hash, {})
+            self.used_keys.setdefault(election_hash, {})
+        for election_hash, votes in block.votes.items():
+            tally = self.tallies.setdefault(election_hash, {})
+            keys = self.used_keys.setdefault(election_hash, {})
+            for vote in votes:
+                tally[vote.choice] = tally.get(vote.choice, 0) + 1
+                keys[vote.public_key] = vote.choice
+        for election_hash in block.election_ends:
+            self.ended[election_hash] = block.index
+
+    def disconnect(self, block):
+        """
+        Takes back a block that has just left the main chain (a reorg). Blocks have to be taken back newest first.
+        """
+        for election_hash in block.election_ends:
+            if self.ended.get(election_hash) == block.index:
+                del self.ended[election_hash]
+        for election_hash, votes in block.votes.items():
+            tally = self.tallies.get(election_hash, {})
+            keys = self.used_keys.get(election_hash, {})
+            for vote in votes:
+                tally[vote.choice] = tally.get(vote.choice, 0) - 1
+                if tally[vote.choice] <= 0:
+                    del tally[vote.choice]
+                keys.pop(vote.public_key, None)
+        for election_hash in block.elections:
+            if election_hash in self.elections and self.elections[election_hash][1] == block.index:
+                del self.elections[election_hash]
+                self.tallies.pop(election_hash, None)
+                self.used_keys.pop(election_hash, None)
+
+    def get_election(self, election_hash):
+        """
+        The Election on the main chain with this hash, or None.
+        """
+        entry = self.elections.get(election_hash)
+        return entry[0] if entry is not None else None
+
+    def to_dict(self):
+        """
+        The state as something json can write out.
+        """
+        encode = lambda h: base64.b64encode(h).decode('utf-8')
+        return {
+            "elections": {encode(h): [election.get_json_dict(), height] for h, (election, height) in self.elections.items()},
+            "tallies": {encode(h): tally for h, tally in self.tallies.items()},
+            "used_keys": {encode(h): keys for h, keys in self.used_keys.items()},
+            "ended": {encode(h): height for h, height in self.ended.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Builds the state back from to_dict's output.
+        """
+        state = cls()
+        decode = base64.b64decode
+        for h, (election, height) in data["elections"].items():
+            state.elections[decode(h)] = (Election(election), height)
+        state.tallies = {decode(h): tally for h, tally in data["tallies"].items()}
+        state.used_keys = {decode(h): keys for h, keys in data["used_keys"].items()}
+        state.ended = {decode(h): height for h, height in data["ended"].items()}
+        return state
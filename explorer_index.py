@@ -0,0 +1,141 @@
+from utils import *
+import sqlite3
+import json
+
+class ExplorerIndex:
+    """
+    A SQLite index of the main chain, for a block explorer: blocks by height, votes by election or by voter key, and elections by end time.
+    It is fed block by block as the tip moves (set_tip), and undone the same way on a reorg, so nothing ever has to walk the chain.
+    The database is only an index, the blocks themselves stay in memory and the block store. If it falls behind it is caught up
+    with sync, and deleting the file just means it is rebuilt on the next start.
+    Writes come from set_tip with the data lock held, reads can come from any thread.
+    """
+    def __init__(self, path):
+        """
+        args:
+        - path: The SQLite file, created if it does not exist
+        """
+        self.lock = threading.Lock() # one connection shared between threads
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL") # it can always be rebuilt from the chain, no need to sync every commit
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS blocks (height INTEGER PRIMARY KEY, hash BLOB NOT NULL, prev_hash BLOB NOT NULL, timestamp INTEGER NOT NULL, difficulty INTEGER NOT NULL, objects INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS blocks_hash ON blocks (hash);
+            CREATE TABLE IF NOT EXISTS elections (hash BLOB PRIMARY KEY, name TEXT NOT NULL, end_time INTEGER NOT NULL, height INTEGER NOT NULL, data TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS elections_end_time ON elections (end_time);
+            CREATE INDEX IF NOT EXISTS elections_height ON elections (height);
+            CREATE TABLE IF NOT EXISTS votes (election_hash BLOB NOT NULL, public_key TEXT NOT NULL, choice TEXT NOT NULL, height INTEGER NOT NULL, data TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS votes_election ON votes (election_hash);
+            CREATE INDEX IF NOT EXISTS votes_public_key ON votes (public_key);
+            CREATE INDEX IF NOT EXISTS votes_height ON votes (height);
+            CREATE TABLE IF NOT EXISTS election_ends (election_hash BLOB PRIMARY KEY, height INTEGER NOT NULL, results TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS election_ends_height ON election_ends (height);
+        """)
+        self.db.commit()
+
+    def connect(self, block):
+        """
+        Adds a block that has just joined the main chain. Anything already indexed at its height is replaced.
+        Does not commit, call commit once the tip is done moving.
+        """
+        with self.lock:
+            self.remove_height(block.index)
+            self.db.execute("INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?)", (block.index, block.hash, block.previous_hash, block.timestamp, block.difficulty, len(block.data)))
+            self.db.executemany("INSERT OR REPLACE INTO elections VALUES (?, ?, ?, ?, ?)",
+                                [(election_hash, election.name, election.end_time, block.index, election.jsonify()) for election_hash, election in block.elections.items()])
+            self.db.executemany("INSERT INTO votes VALUES (?, ?, ?, ?, ?)",
+                                [(vote.election_hash, vote.public_key, vote.choice, block.index, vote.jsonify()) for votes in block.votes.values() for vote in votes])
+            self.db.executemany("INSERT OR REPLACE INTO election_ends VALUES (?, ?, ?)",
+                                [(election_hash, block.index, json.dumps(end.results)) for election_hash, end in block.election_ends.items()])
+
+    def disconnect(self, block):
+        """
+        Takes back a block that has just left the main chain (a reorg). Does not commit.
+        """
+        with self.lock:
+            self.remove_height(block.index)
+
+    def remove_height(self, height):
+        """
+        Deletes everything indexed from the main chain block at height.
+        THE INDEX LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        """
+        for table in ("blocks", "elections", "votes", "election_ends"):
+            self.db.execute(f"DELETE FROM {table} WHERE height = ?", (height,))
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def sync(self, main_chain):
+        """
+        Catches the index up with the main chain, for when we start up (the index may be behind, ahead on a chain we left, or new).
+        Finds the first height where the index and the chain disagree and redoes everything from there.
+        args:
+        - main_chain: The blocks on our main chain, by height
+        """
+        with self.lock:
+            indexed = self.db.execute("SELECT height, hash FROM blocks ORDER BY height").fetchall()
+        start = 0
+        for height, block_hash in indexed:
+            if height != start or height >= len(main_chain) or main_chain[height].hash != block_hash:
+                break
+            start += 1
+        with self.lock:
+            for table in ("blocks", "elections", "votes", "election_ends"):
+                self.db.execute(f"DELETE FROM {table} WHERE height >= ?", (start,))
+        for block in main_chain[start:]:
+            self.connect(block)
+        self.commit()
+        return len(main_chain) - start
+
+    def query(self, sql, args):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def block_at_height(self, height):
+        """
+        The main chain block at height, as a dict, or None.
+        """
+        rows = self.query("SELECT height, hash, prev_hash, timestamp, difficulty, objects FROM blocks WHERE height = ?", (height,))
+        if not rows:
+            return None
+        height, block_hash, prev_hash, timestamp, difficulty, objects = rows[0]
+        return {"height": height, "hash": base64.b64encode(block_hash).decode('utf-8'), "prev_hash": base64.b64encode(prev_hash).decode('utf-8'),
+                "timestamp": timestamp, "difficulty": difficulty, "objects": objects}
+
+    def height_of(self, block_hash):
+        """
+        The height of a block on the main chain, or None.
+        """
+        rows = self.query("SELECT height FROM blocks WHERE hash = ?", (block_hash,))
+        return rows[0][0] if rows else None
+
+    def votes_for_election(self, election_hash):
+        """
+        Every vote on the main chain for an election, oldest first, as {"vote": json dict, "height": block height}.
+        """
+        rows = self.query("SELECT data, height FROM votes WHERE election_hash = ? ORDER BY height", (election_hash,))
+        return [{"vote": json.loads(data), "height": height} for data, height in rows]
+
+    def votes_by_key(self, public_key):
+        """
+        Every vote on the main chain cast with a public key (base64, as in the vote), oldest first.
+        """
+        rows = self.query("SELECT data, height FROM votes WHERE public_key = ? ORDER BY height", (public_key,))
+        return [{"vote": json.loads(data), "height": height} for data, height in rows]
+
+    def elections_ending(self, start, end):
+        """
+        The elections on the main chain that end between start and end (unix times, inclusive), soonest first,
+        as {"election": json dict, "height": block height, "results": the results if its end is on the chain yet, or None}.
+        """
+        rows = self.query("""SELECT elections.data, elections.height, election_ends.results FROM elections
+                             LEFT JOIN election_ends ON election_ends.election_hash = elections.hash
+                             WHERE elections.end_time BETWEEN ? AND ? ORDER BY elections.end_time""", (start, end))
+        return [{"election": json.loads(data), "height": height, "results": json.loads(results) if results is not None else None} for data, height, results in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -112,13 +112,13 @@ class ForkingNode(Peer):
 
 
         # Remove the parent from self.chain_headers and replace with this node
-        self.write_log(f"Block verified: Index: {block.index}, Difficulty: {block.difficulty}, Objects: {json.dumps([obj.jsonify() for obj in block.data])}\n")
+        self.write_log(lambda: f"Block verified: Index: {block.index}, Difficulty: {block.difficulty}, Objects: {json.dumps([obj.jsonify() for obj in block.data])}\n")
         if parent == self.biggest_chain:
-            self.biggest_chain = block
+            self.set_tip(block)
             self.remove_new(block) # simple check to update the new queues
             self.write_log(f"INF: Chain extended\n")
         elif block.total_work > self.biggest_chain.total_work:
-            self.biggest_chain = block
+            self.set_tip(block)
             self.recompute_new(block) # more through check, goea back throug the whole chain
             self.write_log(f"INF: Longest chain changed\n")
         try:
@@ -139,48 +139,43 @@ class ForkingNode(Peer):
         # checking if this was the parent to any orphans, if so we can process those.
         if header_hash in self.orphan_pool:
             for orphan in self.orphan_pool[header_hash]:
+                self.orphan_hashes.discard(hashy(orphan[:84]))
                 self.write_log(f"INF: Orphan block parent found: {orphan}\n")
                 self.verify_block(orphan, block, None)
             del self.orphan_pool[header_hash]
         
     def handle_message(self, message, node):
         """
-        Handles messages from nodes.
+        Handles messages from nodes. Blocks from other nodes are ignored and our own chain is not handed out,
+        votes and elections go to our own handlers, and everything else (INIT replies, PING/PONG, COMPRESSED frames,
+        peer lists, election results) is handled the same as any peer, by Peer.handle_message.
         args:
         - message: The message to handle
         - node: The node that sent the message
         """
         try:
             typey = int.from_bytes(message[:2], byteorder='big')
-            if typey == BLOCK:
+            # anything we hear counts for check_liveness, not just what Peer.handle_message sees
+            node.lastSeen = 0
+            node.last_heard = time.monotonic()
+            if typey in (BLOCK, CMPCT_BLOCK, BLOCK_TXN, HEADERS):
                 # we are ignoring blocks that come in
                 pass
                 # self.handle_block(message[2:], node)
+            elif typey in (GET_LONGEST_CHAIN, GET_HEADERS, GET_BLOCKS):
+                pass # not doing this, as that would show our blocks
+            elif typey == TRACED:
+                # the trace id is dropped, what is inside still has to come through here and not Peer's dispatch
+                self.handle_message(message[2 + TRACE_ID_SIZE:], node)
             elif typey == VOTE:
                 self.handle_vote(message[2:], node)
-            elif typey == INIT:
-                pass # we ignore more init messages from the same node
-                # Handle init message here
+            elif typey == VOTE_BATCH:
+                for raw in self.split_vote_batch(message[2:]):
+                    self.handle_vote(raw, node)
             elif typey == ELECTION:
                 self.handle_election(message[2:], node)
-            elif typey == LONGEST_CHAIN:
-                self.receive_longest_chain(message[2:], node)
-            elif typey == GET_LONGEST_CHAIN:
-                pass # not doing this, as that would show our blocks
-                # Handle get longest chain message here. Return the heeaders for the longest chain
-            elif typey == GET_BLOCK:
-                self.get_block(message[2:], node) 
-            elif typey == GET_ELECTION_RES:
-                self.get_election(message[2:], node)
-                # Handle get election message here. Return the election for the given name, along with the votes, and the merkle trees to prove it.
-            elif typey == ELECTION_RES:
-                self.handle_election_res(message[2:], node)
-                return
-            elif typey == ERROR_RESPONSE:
-                print(f"Error response received: {message[2:].decode('utf-8')}")
-                return
             else:
-                self.write_log(f"Unknown message type: {message[:2]}\n")
+                super().handle_message(message, node)
         # checks so I dont have to put these in every one (i still do sometimes though)
         except json.JSONDecodeError:
             self.write_log(f"Failed to decode message: {message}\n")
@@ -192,25 +187,26 @@ class ForkingNode(Peer):
     def handle_vote(self, message, node):
         
         vote = Vote(message)
-        self.write_log(f"Vote message received: {vote.jsonify()}\n")
+        self.write_log(lambda: f"Vote message received: {vote.jsonify()}\n")
         with self.data_lock:
             election = None
             if vote.election_hash in self.open_elections: 
                 election = self.open_elections[vote.election_hash]
             else:
                 self.write_log(f"Vote for ended or non-existent election: {vote.election_hash}\n")
+                return
 
             res = self.check_vote(vote, election, time.time() + 20) # makes sure it will be valid for long enough that we could mine theoretically
 
             if not res:
-                self.write_log(f"VOTE FAILED CHECKS: {vote.jsonify()}\n")
+                self.write_log(lambda: f"VOTE FAILED CHECKS: {vote.jsonify()}\n")
                 return
             
             gas = 1
-            self.write_log(f"[ ] Vote added: {vote.jsonify()}\n")
+            self.write_log(lambda: f"[ ] Vote added: {vote.jsonify()}\n")
             election.used_keys[vote.public_key] = vote.choice # mark the key as used
             self.all_things[hashy(vote.jsonify())] = (gas, vote) # theoritical GAS ammount, unimplemented
-            self.new_votes[hashy(vote.jsonify())] = vote # add the vote
+            self.pool_add(self.new_votes, hashy(vote.jsonify()), vote) # add the vote
     
     def handle_election(self, message, node):
         """
@@ -222,7 +218,7 @@ class ForkingNode(Peer):
         - node: The node that sent the message
         """
         election = Election(message)
-        self.write_log(f"Election message received: {election.jsonify()}\n")
+        self.write_log(lambda: f"Election message received: {election.jsonify()}\n")
         with self.data_lock:
             if election.hashy in self.open_elections:
                 self.write_log(f"X Election already exists: {election.name}\n")
@@ -233,7 +229,7 @@ class ForkingNode(Peer):
             gas = 1
             self.open_elections[election.hashy] = election
             self.all_things[hashy(election.jsonify())] = (gas, election) # theoritical GAS ammount, unimplemented
-            self.new_elections[hashy(election.jsonify())] =  election
+            self.pool_add(self.new_elections, hashy(election.jsonify()), election)
             self.write_log(f"[ ] Election added: {election.name}\n")
             
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+from utils import *
+from block import Block
+import types
+
+NO_OBJECTS = types.MappingProxyType({}) # the votes, elections and ends of every header, shared and read only
+
+class Header:
+    """
+    A block header with no body, for light nodes, which only ever check headers and merkle proofs against them.
+    It can stand in for a Block everywhere a light node uses one (the chain, set_tip, getDifficulty, the chain state, merkle proofs),
+    but a Block with no data still builds a body: 256 zero hash leaves and three dicts, a couple of KB per header.
+    This is one __slots__ record of the header fields, the link to the parent and the total work, and the previous hash is the
+    parent's own hash object, so nothing is stored twice.
+    """
+    __slots__ = ("index", "hash", "previous_hash", "merkle_root", "timestamp", "difficulty", "nonce", "previous_block", "total_work")
+
+    def __init__(self, index, out_hash, previous_hash, merkle_root, timestamp, difficulty, nonce, parent = None):
+        """
+        args: as for Block, without the body
+        """
+        self.index = index
+        self.hash = out_hash
+        self.previous_hash = parent.hash if parent is not None and parent.hash == previous_hash else previous_hash
+        self.merkle_root = merkle_root
+        self.timestamp = timestamp
+        self.difficulty = difficulty
+        self.nonce = nonce
+        self.previous_block = parent
+        self.total_work = difficulty + (parent.total_work if parent is not None else 0)
+
+    # the body, which a header never has
+    data = ()
+    leaves = ()
+    votes = NO_OBJECTS
+    elections = NO_OBJECTS
+    election_ends = NO_OBJECTS
+    pruned = True
+
+    def has_body(self):
+        return False
+
+    def has_data(self):
+        return False
+
+    def get_body(self):
+        raise ValueError(f"Block {self.index} is a header only")
+
+    get_header = Block.get_header
+    verify_merkle_proof = Block.verify_merkle_proof
+    parse_merkle_proof = Block.parse_merkle_proof
@@ -0,0 +1,80 @@
+from utils import *
+import atexit
+
+class Logger:
+    """
+    Writes a node's log file on its own thread, so logging on a hot path is just a level check and an append to a list.
+    Lines are timestamped when they are logged. Once there is something to write the writer thread gives it LOG_FLUSH_INTERVAL to
+    build up, then takes everything waiting in one go and writes it with one write and one flush, so a burst of messages costs one
+    trip to the file instead of one each. Nothing wakes up while there is nothing to write.
+    Messages below the level are dropped before they are built. Pass a function instead of a string for anything that is
+    expensive to build (the json of a vote or a block), it is only called if the level is on.
+    """
+    def __init__(self, path, level = LOG_LEVEL):
+        """
+        args:
+        - path: The log file, appended to
+        - level: The lowest level written (LOG_DEBUG, LOG_INFO or LOG_ERROR)
+        """
+        self.level = level
+        self.file = open(path, "a")
+        self.pending = [] # lines waiting for the writer thread
+        self.writing = False # the writer thread has lines it has taken but not written yet
+        self.dropped = 0 # lines thrown away because the writer could not keep up
+        self.ready = threading.Condition() # lock for pending, wakes the writer thread (and flush once it is done)
+        threading.Thread(target=self.run, daemon=True).start()
+        atexit.register(self.flush)
+
+    def log(self, level, message):
+        """
+        Logs a message, if level is on.
+        args:
+        - level: The level of the message
+        - message: The message, or a function returning it
+        """
+        if level < self.level:
+            return
+        if callable(message):
+            message = message()
+        line = f"{time.time()}: {message}\n"
+        with self.ready:
+            if len(self.pending) >= LOG_QUEUE_LIMIT:
+                self.dropped += 1
+                return
+            self.pending.append(line)
+            if len(self.pending) == 1:
+                self.ready.notify_all()
+
+    def run(self):
+        """
+        The writer thread. Waits for lines, writes everything that is waiting at once, repeats.
+        """
+        while True:
+            with self.ready:
+                while not self.pending:
+                    self.ready.wait()
+                self.writing = True
+            time.sleep(LOG_FLUSH_INTERVAL) # let a batch build up, waking up for every line costs the threads logging more than the write
+            with self.ready:
+                lines, self.pending = self.pending, []
+                self.writing = True
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                lines.append(f"{time.time()}: X {dropped} log lines dropped, the log could not keep up\n\n")
+            try:
+                self.file.write("".join(lines))
+                self.file.flush()
+            except (OSError, ValueError):
+                pass # nowhere left to report it
+            with self.ready:
+                self.writing = False
+                self.ready.notify_all()
+
+    def flush(self, timeout = 5):
+        """
+        Waits until everything logged so far is in the file (or timeout seconds).
+        """
+        end = time.monotonic() + timeout
+        with self.ready:
+            while (self.pending or self.writing) and time.monotonic() < end:
+                self.ready.wait(end - time.monotonic())
@@ -0,0 +1,128 @@
+from utils import *
+import os
+import json
+
+class MempoolJournal:
+    """
+    Keeps the mempool (new votes, elections and election ends) on disk, so a restart does not lose what we had verified.
+    Every object going into or out of the pool is appended to a log file as one json line, {"op": "add", "key", "obj"} or {"op": "del", "key"}.
+    Nothing in the file is ever changed in place. Once the log is mostly deletes it is compacted: the live entries are written to a new file
+    which is renamed over the old one. A crash can at worst leave a half written last line, which is cut off the next time we load.
+    """
+    def __init__(self, path):
+        """
+        args:
+        - path: The log file, created if it does not exist
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.live = {} # key -> the add line for every object in the pool, what a compaction writes out
+        self.records = 0 # lines in the file
+        self.file = None # opened by load
+
+    def load(self):
+        """
+        Reads the log back, cuts off a half written last line and opens it for appending. Returns the json dicts of the objects still in the pool, oldest first.
+        """
+        with self.lock:
+            if os.path.exists(self.path):
+                good = 0 # where the whole lines end
+                with open(self.path, "rb") as f:
+                    for line in f:
+                        try:
+                            if not line.endswith(b"\n"):
+                                raise ValueError("no end of line")
+                            record = json.loads(line)
+                            key = record["key"]
+                            if record["op"] == "add":
+                                self.live[key] = line
+                            else:
+                                self.live.pop(key, None)
+                        except (ValueError, KeyError, TypeError):
+                            break # a half written line, only the last one can be
+                        self.records += 1
+                        good += len(line)
+                if good != os.path.getsize(self.path):
+                    # cut off, or the next line we write would be glued onto it and lost with it on the next load
+                    with open(self.path, "r+b") as f:
+                        f.truncate(good)
+            self.file = open(self.path, "ab")
+            return [json.loads(line)["obj"] for line in self.live.values()]
+
+    def add(self, key, thing):
+        """
+        Logs an object going into the pool.
+        args:
+        - key: Its key in the pool (the object hash)
+        - thing: The vote, election or end of election
+        """
+        key = key.hex()
+        with self.lock:
+            if key in self.live:
+                return
+            line = (json.dumps({"op": "add", "key": key, "obj": thing.get_json_dict()}) + "\n").encode('utf-8')
+            self.live[key] = line
+            self.write(line)
+
+    def remove(self, key):
+        """
+        Logs an object leaving the pool (mined, or no good anymore). Keys we never logged are ignored.
+        """
+        key = key.hex()
+        with self.lock:
+            if self.live.pop(key, None) is None:
+                return
+            self.write((json.dumps({"op": "del", "key": key}) + "\n").encode('utf-8'))
+
+    def write(self, line):
+        """
+        THE JOURNAL LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        """
+        self.file.write(line)
+        self.file.flush()
+        self.records += 1
+
+    def replace(self, pools):
+        """
+        Replaces the whole log with what is in the pools now, for when the pool was rebuilt from scratch (a reorg, a restart).
+        args:
+        - pools: Dicts of key -> object
+        """
+        with self.lock:
+            self.live = {}
+            for pool in pools:
+                for key, thing in pool.items():
+                    self.live[key.hex()] = (json.dumps({"op": "add", "key": key.hex(), "obj": thing.get_json_dict()}) + "\n").encode('utf-8')
+            self.rewrite()
+
+    def compact(self):
+        """
+        Rewrites the log with just the live entries, if it has grown to more than MEMPOOL_COMPACT_RATIO lines per live entry.
+        Returns the number of lines dropped.
+        """
+        with self.lock:
+            if self.records <= MEMPOOL_COMPACT_MIN or self.records <= MEMPOOL_COMPACT_RATIO * len(self.live):
+                return 0
+            dropped = self.records - len(self.live)
+            self.rewrite()
+            return dropped
+
+    def rewrite(self):
+        """
+        Writes the live entries to a temporary file and renames it over the log, so there is always one whole log on disk.
+        THE JOURNAL LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        """
+        with open(self.path + ".tmp", "wb") as f:
+            f.writelines(self.live.values())
+            f.flush()
+            os.fsync(f.fileno())
+        if self.file is not None:
+            self.file.close()
+        os.replace(self.path + ".tmp", self.path)
+        self.file = open(self.path, "ab")
+        self.records = len(self.live)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
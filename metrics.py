@@ -0,0 +1,171 @@
+from utils import *
+import http.server
+
+class Counter:
+    """
+    A number that only goes up (messages, bytes, signatures checked). Optionally split by one label, like the message type.
+    """
+    def __init__(self, name, help, label = None):
+        """
+        args:
+        - name: The metric name, as the scraper sees it
+        - help: One line on what it counts
+        - label: The name of the label it is split by, None for a plain counter
+        """
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {} # label value (None without a label) -> count
+        self.lock = threading.Lock()
+
+    def inc(self, amount = 1, label = None):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def get(self, label = None):
+        with self.lock:
+            return self.values.get(label, 0)
+
+    def render(self, kind = "counter"):
+        with self.lock:
+            values = list(self.values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {kind}"]
+        for label, value in sorted(values, key=lambda item: str(item[0])):
+            if self.label is None:
+                lines.append(f"{self.name} {value}")
+            else:
+                lines.append(f'{self.name}{{{self.label}="{label}"}} {value}')
+        return lines
+
+class Gauge(Counter):
+    """
+    A number that goes up and down (mempool size, hashrate). Either set when it changes, or read when it is scraped:
+    read is a function returning the value (or a dict of label value -> value), for things we already keep like the mempool.
+    """
+    def __init__(self, name, help, label = None, read = None):
+        """
+        args:
+        - name, help, label: As for Counter
+        - read: Function called on every scrape for the value, None to use set
+        """
+        super().__init__(name, help, label)
+        self.read = read
+
+    def set(self, value, label = None):
+        with self.lock:
+            self.values[label] = value
+
+    def render(self, kind = "gauge"):
+        if self.read is not None:
+            value = self.read()
+            with self.lock:
+                self.values = value if isinstance(value, dict) else {None: value}
+        return super().render(kind)
+
+class Histogram:
+    """
+    Counts observations into fixed buckets (block validation time, reorg depth), so the scraper can work out percentiles.
+    Buckets are upper bounds, each observation lands in the first one it fits in, anything bigger only counts in +Inf.
+    """
+    def __init__(self, name, help, buckets):
+        """
+        args:
+        - name, help: As for Counter
+        - buckets: The bucket upper bounds, smallest first
+        """
+        self.name = name
+        self.help = help
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # per bucket, not cumulative, the last one is +Inf
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        slot = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                slot = i
+                break
+        with self.lock:
+            self.counts[slot] += 1
+            self.sum += value
+
+    def render(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+class Metrics:
+    """
+    The registry for a node's metrics. Rendered in the Prometheus text format, so any scraper that speaks it can poll serve's endpoint.
+    Updating a metric is a lock and an add, so it is fine on the hot paths.
+    """
+    def __init__(self, prefix = METRICS_PREFIX):
+        """
+        args:
+        - prefix: Put in front of every metric name
+        """
+        self.prefix = prefix
+        self.metrics = [] # in the order they were added, which is the order they are rendered in
+        self.server = None
+
+    def add(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label = None):
+        return self.add(Counter(name, help, label))
+
+    def gauge(self, name, help, label = None, read = None):
+        return self.add(Gauge(name, help, label, read))
+
+    def histogram(self, name, help, buckets):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        """
+        Every metric, in the text format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host = "127.0.0.1"):
+        """
+        Starts the HTTP endpoint on its own thread. GET /metrics returns render(). Only listens locally unless told otherwise,
+        the scraper is expected to be on the same machine.
+        """
+        metrics = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # every scrape would end up on stderr
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
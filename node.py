@@ -1,4 +1,7 @@
 from utils import *
+from token_bucket import TokenBucket
+import os
+import struct
 
 class Node:
     """
@@ -7,6 +10,61 @@ class Node:
     def __init__(self, ip, port, connection):
         self.address = (ip, port)
         self.connection = connection
+        self.send_lock = threading.Lock() # held while a frame is written to it. Per node, so a node that is not reading only holds up sends to itself
+        if connection is not None:
+            self.set_send_timeout(SEND_TIMEOUT)
         self.good = True
-        self.lastSeen = 0
-    
\ No newline at end of file
+        self.lastSeen = 0 # pings we have sent since we last heard from it
+        self.last_heard = time.monotonic() # when we last got a message from it
+        self.liveness_timer = None # the scheduler timer that checks on it
+        self.features = 0 # feature bits the node sent us in the INIT handshake
+        self.blocks_in_flight = set() # hashes we asked this node for and have not gotten back yet
+        self.blocks_asked = set() # hashes asked for one at a time with GET_BLOCK (orphan parents, compact block fallbacks), outside the downloader
+        self.bucket = TokenBucket(PEER_CPU_RATE, PEER_CPU_BURST) # CPU seconds this node can still make us spend
+        self.closed = False # set once we have disconnected it, so buffered messages are not handled
+        self.errors = 0 # errors we have sent it
+        self.throttled = 0 # messages dropped for going over budget
+        self.cpu_time = 0.0 # seconds spent handling its messages
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages = {} # message type -> [messages, seconds spent handling them]
+        self.rtt = None # moving average of the PING round trip time, in seconds
+        self.throughput = None # moving average of how fast it sends us blocks, in bytes per second
+        self.last_delivery = 0 # when the last block we asked it for came in
+        self.outbound = False # if we opened the connection
+        self.peers_seq = 0 # the sequence number of the last peer list it sent us
+
+    def set_send_timeout(self, seconds):
+        """
+        Makes a send to the node fail with an OSError once it has been stuck for seconds. Only sends, talk_to_node still waits on
+        recv for as long as the node is quiet (a timeout from settimeout would apply to both).
+        """
+        if os.name == "nt":
+            value = struct.pack("L", int(seconds * 1000)) # a DWORD of milliseconds
+        else:
+            value = struct.pack("ll", int(seconds), int(seconds % 1 * 1000000)) # a struct timeval
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+
+    def update_rtt(self, sample):
+        """
+        Adds a round trip time sample (seconds) to the moving average.
+        """
+        self.rtt = sample if self.rtt is None else (1 - RTT_WEIGHT) * self.rtt + RTT_WEIGHT * sample
+
+    def update_throughput(self, size, seconds):
+        """
+        Adds a throughput sample to the moving average.
+        args:
+        - size: Bytes we got
+        - seconds: How long they took to get here
+        """
+        sample = size / max(seconds, 0.001)
+        self.throughput = sample if self.throughput is None else (1 - THROUGHPUT_WEIGHT) * self.throughput + THROUGHPUT_WEIGHT * sample
+
+    def expected_time(self, size = 0):
+        """
+        How long we expect this node to take to answer a request for size bytes. Used to send requests to the fastest nodes first.
+        """
+        rtt = DEFAULT_RTT if self.rtt is None else self.rtt
+        throughput = DEFAULT_THROUGHPUT if self.throughput is None else self.throughput
+        return rtt + size / throughput
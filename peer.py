@@ -3,21 +3,34 @@ from block import Block
 from election import Election
 from vote import Vote
 from node import Node
+from block_downloader import BlockDownloader
+from seen_filter import SeenFilter
+from peer_directory import PeerDirectory
+from scheduler import Scheduler
+from block_store import BlockStore
+from chain_state import ChainState
+from explorer_index import ExplorerIndex
+from mempool_journal import MempoolJournal
+from logger import Logger
+from metrics import Metrics
+from tracing import Tracer
+from profiler import SamplingProfiler
+from admin import AdminServer
 import itertools
 import json
+import math
+import os
 import threading
 import time
 import socket
 import base64
+import zlib
 
 from end_of_election import EndOfElection
 from random import shuffle
 
-PING = 10
-PONG = 11
-
 class Peer():
-    def __init__(self, name, port, tracker_ip = None, tracker_port = None):
+    def __init__(self, name, port, tracker_ip = None, tracker_port = None, data_dir = None, prune = None, explorer = None, log_level = LOG_LEVEL, metrics_port = None, trace_rate = TRACE_SAMPLE_RATE, admin_port = None):
         """
         Initializes the Peer class.
         This will immidiatly start to connect to the network, trying to find the tracker if ip is provided (if not, this is the tracker)
@@ -26,17 +39,27 @@ class Peer():
         - port: The port to listen on
         - tracker_ip: The ip of the tracker to connect to (if this is the tracker, this should be None)
         - tracker_port: The port of the tracker to connect to (if this is the tracker, this should be None)
+        - data_dir: Where to keep the blocks and the mempool on disk. If given, both are loaded from there before we connect to anyone
+        - prune: Only keep the bodies of the last this many blocks in memory (PRUNE_DEPTH is a good value), plus the ones with open elections.
+          Older bodies are read back from data_dir when needed, or dropped for good if there is none. None keeps every body
+        - explorer: Path of a SQLite file to keep an explorer index of the main chain in (see ExplorerIndex). None for no index
+        - log_level: The lowest level written to the log (LOG_DEBUG, LOG_INFO or LOG_ERROR)
+        - metrics_port: Port for the local metrics endpoint (GET /metrics, see Metrics). None to only keep the metrics in memory
+        - trace_rate: Fraction of messages and mined blocks traced (see Tracer), 0 to only trace what other nodes send us traced
+        - admin_port: Port for the local admin socket (see admin_command), for profiling the node or dumping its traces while it runs. None for no socket
 
         returns:
         - None
         """
         self.nodes = {} # used to store current connections, more complex processing will be needed for larger networks, but right now we just talk to everyone.
-        self.log_lock = threading.Lock() # lock for the log file
-        self.log = open(f"{name}.log", "a") # log file
-        self.log.write(f"{name} INITIALIZE.\n\n")
+        self.logger = Logger(f"{name}.log", log_level) # log file, written on its own thread
+        self.write_log(f"INF: {name} INITIALIZE.\n")
 
 
         self.node_list_lock = threading.Lock() # lock for the node list, so more than one thread dont race
+        self.directory = PeerDirectory() # the nodes connected to us, sampled for node lists. Also held with the node list lock
+        self.peer_pool = PeerDirectory() # addresses we have heard about, for opening more connections. Also held with the node list lock
+        self.tracker_address = (tracker_ip, tracker_port) if tracker_ip and tracker_port else None
         self.chain_headers = [] # list of current chain headers (any node that is not a parent of another node that we know)
         self.port = port # the port
         self.name = name # the name of the peer
@@ -44,13 +67,50 @@ class Peer():
         self.new_votes = {} # these are the votes that we have recieved and verified, but are not in a block on the longest chain yet
         self.new_elections = {} # these are the elections that we have recieved and verified, but are not in a block on the longest chain yet
         self.new_ended_elections = {} # these are end of election events, critical for determining security and preventing nodes from dropping votes when reporting results
+        self.short_ids = {} # short id -> (key, object) for everything in the three dicts above, for rebuilding compact blocks. Kept up by pool_add and pool_remove
         self.open_elections = {} # elections that we think are ongoing. This may contain some recently ended elections, so still check
         self.orphan_pool = {} # orphan pool
+        self.orphan_hashes = set() # hashes of the blocks sitting in the orphan pool
         self.blocks = {} # all blocks and their hashes. This is storing pointers. Memory overhead for this is pretty light. Still, some trimming of stubs and untaken branches could be good
         self.all_things = {} # hashes of every object we have seen, used to recalculate the new arrays when we switch chains
         self.biggest_chain = None # the node with the most work
+        self.main_chain = [] # the blocks on the biggest chain, by height. Kept up to date by set_tip
+        self.header_chain = bytearray() # the headers of main_chain back to back, HEADER_SIZE bytes each, so header requests are just a slice
+        self.downloader = BlockDownloader() # spreads the blocks we are missing over all the nodes we know
+        self.pending_compact = {} # compact blocks waiting on objects we did not have: hash -> (header, object dicts with None for the missing ones)
+        self.header_fallback = {} # node asked for the next headers -> (node that sent the last batch, its last hash), in case the first one does not have them
         self.data_lock = threading.Lock() # lock for the data (all of the data structures here)
-        self.send_lock = threading.Lock() # lock to prevent two threads from sending at the same time. More fine-grained per node could be good, but this should suffice
+        self.features = self.supported_features() # what we tell other nodes we support in the INIT handshake
+        self.compression_stats = {} # message type -> [frames, raw bytes, compressed bytes, seconds spent compressing]
+        self.stats_lock = threading.Lock() # lock for the stats, they are updated from every connection thread
+        self.seen_filter = SeenFilter() # hashes of recent votes, elections and blocks, so the copies from every neighbour are dropped early
+        self.handle_stats = {} # message type -> [messages handled, seconds spent handling them]
+        self.setup_metrics()
+        self.tracer = Tracer(port, name, trace_rate) # sampled spans of message handling and mining, dump with self.tracer.dump(path)
+        self.profiler = SamplingProfiler() # off until started from the admin socket
+        self.seen_stats = {} # message type -> [messages checked, duplicates dropped, seconds spent checking]
+        self.vote_relay = [] # (vote message, node it came from) admitted but not relayed yet, sent out in batches
+        self.vote_relay_ready = threading.Condition() # lock for vote_relay, wakes the relay thread
+        self.scheduler = Scheduler(self.write_log) # one thread for every timer: keepalives, idle nodes, block request timeouts, stats
+        self.download_timer = None # the scheduler timer for the next block request timeout check
+        self.chain_state = ChainState() # elections, tallies and used keys on the main chain, kept up to date by set_tip
+        self.block_store = BlockStore(data_dir) if data_dir else None # every block we accept, on disk
+        self.prune_depth = prune # main chain blocks deeper than this get pruned, None to keep every body
+        self.pruned_height = 0 # every main chain block below this height has been through prune_block
+        self.pinned = {} # election hash -> blocks past the prune depth kept in memory because the election is still open
+        if self.prune_depth is not None and self.block_store is None:
+            self.features |= FEATURE_PRUNED # the old bodies are gone, nobody should come to us for them
+        self.explorer = None # the explorer index, fed by set_tip. Made after the blocks are loaded, it catches up in one go
+        self.mempool_journal = None # the mempool on disk, see pool_add. Made after the blocks are loaded, what is on disk is checked against them
+        if self.block_store is not None:
+            self.load_blocks()
+            self.mempool_journal = MempoolJournal(os.path.join(data_dir, "mempool.log"))
+            self.load_mempool()
+            self.scheduler.every(MEMPOOL_COMPACT_INTERVAL, self.compact_mempool)
+        if explorer:
+            self.explorer = ExplorerIndex(explorer)
+            with self.data_lock:
+                self.write_log(f"INF: Explorer index caught up {self.explorer.sync(self.main_chain)} blocks\n")
         threading.Thread(target=self.accept_connections, daemon=True).start() # starting the thread to accept connections
         self.is_tracker = False # if this is the tracker or not 
         if tracker_ip and tracker_port:
@@ -59,17 +119,121 @@ class Peer():
         else:
             self.is_tracker = True # if we are the tracker, we need to accept connections
             
-        threading.Thread(target=self.ping_loop, daemon=True).start()
+        self.scheduler.every(STATS_INTERVAL, self.log_stats)
+        self.scheduler.every(METRICS_RATE_INTERVAL, self.update_rates)
+        if metrics_port is not None:
+            self.metrics.serve(metrics_port)
+            self.write_log(f"INF: Metrics on http://127.0.0.1:{metrics_port}/metrics\n")
+        self.admin = AdminServer(admin_port, self.admin_command) if admin_port is not None else None
+        threading.Thread(target=self.vote_relay_loop, daemon=True).start()
+
+    def admin_command(self, words):
+        """
+        Runs a command from the admin socket and returns the reply. Runs on the admin socket's thread.
+        Commands:
+        - profile start [interval]: Starts sampling every thread's stack, every interval seconds (PROFILE_INTERVAL if not given)
+        - profile stop [file]: Stops it, writes the collapsed stacks to file (<name>.profile if not given) and replies with a summary
+        - profile status: If it is running
+        - trace dump [file]: Writes the trace buffer to file (<name>.trace.json if not given), see Tracer
+        Files are written next to the node's log, see admin_file.
+        - metrics: The metrics, as the endpoint would serve them
+        args:
+        - words: The command line, split into words
+        """
+        command = " ".join(words[:2])
+        if command == "profile start":
+            interval = float(words[2]) if len(words) > 2 else PROFILE_INTERVAL
+            if not math.isfinite(interval) or interval <= 0:
+                return "interval must be a number of seconds above 0"
+            if not self.profiler.start(interval):
+                return "profiler already running"
+            self.write_log(f"INF: Profiler started, sampling every {interval} seconds\n")
+            return "profiler started"
+        elif command == "profile stop":
+            path = self.admin_file(words[2] if len(words) > 2 else f"{self.name}.profile") # before stopping, a bad name keeps the session
+            if not self.profiler.stop():
+                return "profiler not running"
+            self.profiler.write(path)
+            self.write_log(f"INF: Profiler stopped, {self.profiler.samples} samples written to {path}\n")
+            return f"profile written to {path}\n{self.profiler.summary()}"
+        elif command == "profile status":
+            return "profiler running" if self.profiler.is_running() else "profiler not running"
+        elif command == "trace dump":
+            path = self.admin_file(words[2] if len(words) > 2 else f"{self.name}.trace.json")
+            return f"{self.tracer.dump(path)} spans written to {path}"
+        elif command == "metrics":
+            return self.metrics.render()
+        return "commands: profile start [interval], profile stop [file], profile status, trace dump [file], metrics"
+
+    def admin_file(self, name):
+        """
+        Where an admin command writes a file: a plain file name, in the directory the node keeps its log in.
+        Anything that could point somewhere else (a directory, "..") is refused, whoever can reach the admin socket
+        should not be able to overwrite files outside it.
+        args:
+        - name: The file name given with the command
+        """
+        if name in ("", ".", "..") or os.sep in name or (os.altsep and os.altsep in name):
+            raise ValueError(f"{name!r} is not a plain file name")
+        return name
 
-    def write_log(self, message):
+    def setup_metrics(self):
         """
-        Logs a message to the log file. Lock to prevent race conditions on the file
-        args:
-        - message: The message to log
+        Makes the metrics registry and everything in it. The counters and histograms are updated where the work happens,
+        the gauges for things we already keep (mempool, chain, nodes) are read when they are scraped.
+        """
+        self.metrics = Metrics()
+        self.validation_time = self.metrics.histogram("block_validation_seconds", "Time to validate a block that passed, from parsing to the signature checks", VALIDATION_BUCKETS)
+        self.signature_checks = self.metrics.counter("signature_checks_total", "Vote signatures checked")
+        self.signature_rate = self.metrics.gauge("signature_checks_per_second", f"Vote signatures checked per second, over the last {METRICS_RATE_INTERVAL} seconds")
+        self.hashes = self.metrics.counter("hashes_total", "Block header hashes tried while mining")
+        self.hashrate = self.metrics.gauge("hashrate", f"Header hashes per second while mining, over the last {METRICS_RATE_INTERVAL} seconds")
+        self.reorg_depth = self.metrics.histogram("reorg_depth_blocks", "Blocks taken off the main chain by each reorg", REORG_BUCKETS)
+        self.bytes_in = self.metrics.counter("bytes_in_total", "Bytes received, by frame type (compressed frames count as COMPRESSED)", "type")
+        self.bytes_out = self.metrics.counter("bytes_out_total", "Bytes sent, by frame type (compressed frames count as COMPRESSED)", "type")
+        self.metrics.gauge("mempool_objects", "Verified objects waiting to go in a block, by type", "type",
+                           lambda: {"vote": len(self.new_votes), "election": len(self.new_elections), "end_of_election": len(self.new_ended_elections)})
+        self.metrics.gauge("chain_height", "Height of our tip", read=lambda: self.biggest_chain.index if self.biggest_chain is not None else -1)
+        self.metrics.gauge("orphans", "Blocks waiting on their parent", read=lambda: len(self.orphan_hashes))
+        self.metrics.gauge("nodes", "Nodes connected", read=lambda: len(self.nodes))
+        self.rate_marks = (time.monotonic(), 0, 0) # (when, signature checks, hashes) at the last update_rates
+
+    def update_rates(self):
         """
-        with self.log_lock:
-            self.log.write(f"{time.time()}: {message}\n")
-            self.log.flush()
+        Runs on the scheduler every METRICS_RATE_INTERVAL. Works out the signature check rate and the hashrate since the last run.
+        """
+        now = time.monotonic()
+        checks = self.signature_checks.get()
+        hashes = self.hashes.get()
+        then, old_checks, old_hashes = self.rate_marks
+        if now > then:
+            self.signature_rate.set(round((checks - old_checks) / (now - then), 2))
+            self.hashrate.set(round((hashes - old_hashes) / (now - then), 2))
+        self.rate_marks = (now, checks, hashes)
+
+    def supported_features(self):
+        """
+        The feature bits we send in the INIT handshake. Nodes that cant do everything (light nodes) override this.
+        """
+        return FEATURE_COMPRESSION | FEATURE_GET_BLOCKS | FEATURE_HEADERS | FEATURE_COMPACT_BLOCKS | FEATURE_VOTE_BATCH | FEATURE_TRACE
+
+    def write_log(self, message, level = None):
+        """
+        Logs a message to the log file. The logger writes it out on its own thread.
+        args:
+        - message: The message to log, or a function that returns it, so an expensive message is only built if its level is on
+        - level: LOG_DEBUG, LOG_INFO or LOG_ERROR. If not given it comes from the prefix: "X " is an error, "INF: " is info, the rest is debug
+        """
+        if level is None:
+            if callable(message):
+                level = LOG_DEBUG
+            elif message.startswith("X "):
+                level = LOG_ERROR
+            elif message.startswith("INF: "):
+                level = LOG_INFO
+            else:
+                level = LOG_DEBUG
+        self.logger.log(level, message)
     def mine(self):
         """
         Starts the mining process.
@@ -93,20 +257,32 @@ class Peer():
 
         """
         while self.should_mine:
-            index = 0
-            prev_hash = b'\x00' * 32
-            with self.data_lock:
-                biggest_chain = self.biggest_chain
-            old_longest = self.biggest_chain # for if there are updates mid mining below, we want to break and work on the new longer chain
+            with self.tracer.start("mine block"):
+                self.mine_block()
+
+    def mine_block(self):
+        """
+        One go at mining a block on our tip, until we find one or the tip moves.
+        """
+        index = 0
+        prev_hash = b'\x00' * 32
+        with self.data_lock:
+            biggest_chain = self.biggest_chain
+        old_longest = self.biggest_chain # for if there are updates mid mining below, we want to break and work on the new longer chain
+        with self.tracer.span("move_to_ended"):
             self.move_to_ended() # cleans up the open elections, and moves them to the ended elections, and generates end of election events
+        with self.tracer.span("get_objects"):
             objects = self.get_objects() # gets the objects that will be included in the block
+        with self.tracer.span("merkle root"):
             merkle_root = self.get_merkle_root(objects) # gets the merkle root of the objects
-            if biggest_chain is not None:
-                prev_hash = biggest_chain.hash # case where this is the first block in the chain
-                index = biggest_chain.index + 1
-            difficulty = self.getDifficulty(biggest_chain) # gets the difficulty of the block
-            timestamp = int(time.time()).to_bytes(8, byteorder='big')
-            nonce = 0
+        if biggest_chain is not None:
+            prev_hash = biggest_chain.hash # case where this is the first block in the chain
+            index = biggest_chain.index + 1
+        difficulty = self.getDifficulty(biggest_chain) # gets the difficulty of the block
+        timestamp = int(time.time()).to_bytes(8, byteorder='big')
+        nonce = 0
+        found = None
+        with self.tracer.span("hash search"):
             while nonce < 2**32: # max for 4 byte num
                 if nonce % 10000000 == 0:
                     self.write_log(f"Mining block {index} with nonce {nonce}")
@@ -116,13 +292,15 @@ class Peer():
                 header_hash = hashy(block_header)
                 if check_proof_of_work(header_hash, difficulty): #checks if the hash we just made will work
                     # print(f"Found a block: {header_hash}")
-                    block = Block(index, header_hash, prev_hash, merkle_root, int.from_bytes(timestamp, byteorder='big'), difficulty, nonce, biggest_chain, data=objects)
-                    self.handle_block(block.get_sendable(), None, False)
+                    found = Block(index, header_hash, prev_hash, merkle_root, int.from_bytes(timestamp, byteorder='big'), difficulty, nonce, biggest_chain, data=objects)
+                    nonce += 1 # so the count below includes this one
                     break
-                
+
                 nonce += 1
-                
-        
+        self.hashes.inc(nonce) # nonces start at 0, so this is the number of hashes tried
+        if found is not None:
+            self.handle_block(found.get_sendable(), None, False)
+
     def get_merkle_root(self, objects):
         """
         Gets the merkle root of the objects.
@@ -172,7 +350,7 @@ class Peer():
                 new_elections.append(item)
                 total_size += sizey
             for key in del_list:
-                del self.new_elections[key]
+                self.pool_remove(self.new_elections, key)
             shuffle(new_elections)
             for item in new_elections:
                 objects.append(item)
@@ -190,7 +368,7 @@ class Peer():
                 new_votes.append(item)
                 total_size += sizey
             for key in del_list:
-                del self.new_votes[key]
+                self.pool_remove(self.new_votes, key)
             shuffle(new_votes)
             for item in new_votes:
                 objects.append(item)
@@ -211,6 +389,7 @@ class Peer():
             new_connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             # creating and adding the node
             node = Node(ip, port, new_connection)
+            node.outbound = True
             # this checks for duplicates and self refrences.
             new = self.add_node(node)
             if not new:
@@ -220,35 +399,159 @@ class Peer():
             # connecting to the node
             new_connection.connect((ip, port))
             # sending the initial message
-            msg = INIT.to_bytes(2, byteorder='big') + self.port.to_bytes(2, byteorder='big')
+            msg = INIT.to_bytes(2, byteorder='big') + self.port.to_bytes(2, byteorder='big') + self.features.to_bytes(2, byteorder='big')
             self.send_message(msg, node)
 
-            #getting and parsing the node list response
-            response = new_connection.recv(4096 * 8) 
-            leny = int.from_bytes(response[:2], byteorder='big')
-            # print(response[2:2+leny])
+            #getting and parsing the node list response. Only read that one frame, the INIT reply right behind it is handled by talk_to_node
+            response = self.recv_frame(new_connection)
             try:
-                node_list = json.loads(response[2:2+leny].decode('utf-8'))
+                node_list = json.loads(response.decode('utf-8'))
             except (json.JSONDecodeError, UnicodeDecodeError) as e:
                 print("Failed to decode node list:", e)
                 self.write_log(f"Failed to decode node list: {e}\n")
                 return
             
-            # connecting to all the other nodes (if they are new)
-            for node_info in node_list:
-                ip = node_info.get("ip")
-                port = node_info.get("port")
-                
-                if ip and port:
-                    self.start_connection(ip, port)
+            # it is a random sample of the nodes it knows, we connect to some of them (up to MAX_OUTBOUND)
+            self.learn_peers(node_list, node)
 
-            self.write_log(f"Node list received: {node_list}\n")
             # starting a deticated thread to talk to the node
             threading.Thread(target=self.talk_to_node, args=(new_connection, False, node), daemon=True).start()
         except Exception as e:
             print("failed to connect", e)
             self.write_log(f"Failed to connect to node: {e}\n")
 
+    def get_peers(self, message, node):
+        """
+        Handles get peers messages. Sends the joins and leaves since the sequence number the node gave us,
+        or a fresh random sample if it asked for one (0) or is further behind than our log goes.
+        args:
+        - message: The sequence number (8 bytes)
+        - node: The node that sent the message
+        """
+        seq = int.from_bytes(message[:8], byteorder='big')
+        with self.node_list_lock:
+            changes = self.directory.changes_since(seq) if seq else None
+            if changes is None:
+                result = {"seq": self.directory.seq, "peers": self.directory.sample(PEER_SAMPLE_SIZE, node.address)}
+            else:
+                events, seq = changes
+                result = {"seq": seq, "events": [[joined, address[0], address[1]] for joined, address in events]}
+        self.send_message(PEERS.to_bytes(2, byteorder='big') + json.dumps(result).encode('utf-8'), node)
+
+    def learn_peers(self, node_list, node):
+        """
+        Takes in a node list (a sample or the changes since last time) and adds it to our pool of addresses.
+        If we have fewer than MAX_OUTBOUND connections of our own, we connect to some from the pool.
+        args:
+        - node_list: The decoded PEERS json, or the node list from the INIT handshake
+        - node: The node that sent it
+        """
+        try:
+            seq, peers, events = self.check_node_list(node_list)
+        except (TypeError, ValueError, KeyError, AttributeError) as e:
+            self.write_log(f"X Malformed node list from {node}: {e}\n")
+            return
+        self.write_log(f"Node list received: {len(peers)} nodes, {len(events)} changes\n")
+        with self.node_list_lock:
+            for address in peers:
+                if len(self.peer_pool) < PEER_POOL_SIZE:
+                    self.peer_pool.add(address)
+            for joined, address in events:
+                if not joined:
+                    self.peer_pool.remove(address)
+                elif len(self.peer_pool) < PEER_POOL_SIZE:
+                    self.peer_pool.add(address)
+            node.peers_seq = seq
+            wanted = MAX_OUTBOUND - sum(1 for n in self.nodes.values() if n.outbound)
+            candidates = [address for address in self.peer_pool.sample(wanted + len(self.nodes)) if address not in self.nodes][:wanted]
+        if candidates:
+            # connecting takes a round trip each, so it is done off this thread
+            threading.Thread(target=self.connect_to_peers, args=(candidates,), daemon=True).start()
+
+    def check_node_list(self, node_list):
+        """
+        Checks a node list before anything in it is used, and returns (seq, [address], [(joined, address)]).
+        Raises ValueError if it is not what get_peers sends: seq has to fit the 8 bytes poll_tracker sends it back in,
+        every address has to be an [ip, port] pair and every change a [joined, ip, port] triple.
+        args:
+        - node_list: The decoded json
+        """
+        if not isinstance(node_list, dict):
+            raise ValueError(f"not a json object: {type(node_list).__name__}")
+        seq = node_list["seq"]
+        if type(seq) is not int or not 0 <= seq < 2**64:
+            raise ValueError(f"invalid seq: {seq!r}")
+        peers = node_list.get("peers", [])
+        events = node_list.get("events", [])
+        if not isinstance(peers, list) or not isinstance(events, list):
+            raise ValueError("peers and events have to be lists")
+        addresses = []
+        for entry in peers:
+            if not isinstance(entry, list) or len(entry) != 2:
+                raise ValueError(f"invalid address: {entry!r}")
+            addresses.append(self.check_address(*entry))
+        changes = []
+        for entry in events:
+            if not isinstance(entry, list) or len(entry) != 3 or not isinstance(entry[0], bool):
+                raise ValueError(f"invalid change: {entry!r}")
+            changes.append((entry[0], self.check_address(entry[1], entry[2])))
+        return seq, addresses, changes
+
+    def check_address(self, ip, port):
+        """
+        Checks an address from a node list, returns it as the (ip, port) tuple we key nodes by.
+        """
+        if not isinstance(ip, str) or not ip or len(ip) > 255 or type(port) is not int or not 0 < port < 65536:
+            raise ValueError(f"invalid address: {ip!r}:{port!r}")
+        return (ip, port)
+
+    def connect_to_peers(self, addresses):
+        """
+        Opens connections to the addresses, stopping once we have MAX_OUTBOUND of our own.
+        """
+        for ip, port in addresses:
+            if sum(1 for n in list(self.nodes.values()) if n.outbound) >= MAX_OUTBOUND:
+                break
+            self.start_connection(ip, port)
+
+    def poll_tracker(self):
+        """
+        Asks the tracker what changed in the network since last time. If we are short on connections and it has nothing new for us,
+        we ask for a fresh sample instead.
+        """
+        tracker = self.nodes.get(self.tracker_address) if self.tracker_address else None
+        if tracker is None:
+            return
+        seq = tracker.peers_seq
+        with self.node_list_lock:
+            if len(self.peer_pool) <= len(self.nodes) and sum(1 for n in self.nodes.values() if n.outbound) < MAX_OUTBOUND:
+                seq = 0
+        self.send_message(GET_PEERS.to_bytes(2, byteorder='big') + seq.to_bytes(8, byteorder='big'), tracker)
+
+    def recv_frame(self, connection):
+        """
+        Reads exactly one length prefixed frame from the connection, and returns the body.
+        args:
+        - connection: The socket to read from
+        """
+        leny = int.from_bytes(self.recv_exact(connection, 2), byteorder='big')
+        return self.recv_exact(connection, leny)
+
+    def recv_exact(self, connection, leny):
+        """
+        Reads exactly leny bytes from the connection (recv can return less than asked for).
+        args:
+        - connection: The socket to read from
+        - leny: The number of bytes to read
+        """
+        data = b''
+        while len(data) < leny:
+            chunk = connection.recv(leny - len(data))
+            if chunk == b'':
+                raise ConnectionError("Connection closed mid frame")
+            data += chunk
+        return data
+
     def add_node(self, node):
         """
         Adds a node to the tracker.
@@ -261,6 +564,8 @@ class Peer():
             if node.address in self.nodes:
                 return False
             self.nodes[node.address] = node
+            self.directory.add(node.address)
+            node.liveness_timer = self.scheduler.schedule(KEEPALIVE_INTERVAL, self.check_liveness, node)
             self.write_log(f"Node added: {node}\n")
         return True
     
@@ -270,7 +575,12 @@ class Peer():
         """
         with self.node_list_lock:
             if node in self.nodes:
-                del self.nodes[node]
+                removed = self.nodes.pop(node)
+                self.directory.remove(node)
+                if removed.liveness_timer is not None:
+                    removed.liveness_timer.cancel()
+                if removed.blocks_in_flight:
+                    self.scheduler.schedule(0, self.check_downloads) # give its block requests to someone else now, not at the timeout
                 self.write_log(f"Node removed: {node}\n")
             else:
                 self.write_log(f"Node not found: {node}\n")
@@ -279,11 +589,11 @@ class Peer():
         """
         Accepts connections from nodes, spinning off a thread for each one.
         """
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind(('', self.port))
+        server_socket.listen(MAX_CONNECTIONS)
         while True:
-            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            server_socket.bind(('', self.port))
-            server_socket.listen(MAX_CONNECTIONS)
             connection, _ = server_socket.accept()
             self.write_log(f"Connection accepted: {connection}\n")
             threading.Thread(target=self.talk_to_node, args=(connection,)).start()
@@ -304,41 +614,49 @@ class Peer():
             valid, porty = self.verify_node_connection(initial_message)
             node = None
             if valid:
-                # sending the node list
-                node_list = [{"ip": n[0], "port": n[1]} for n in self.nodes]
+                # sending the node list, a random sample so it stays small however many nodes we know
                 node = Node(connection.getpeername()[0], porty, connection)
+                with self.node_list_lock:
+                    node_list = {"seq": self.directory.seq, "peers": self.directory.sample(PEER_SAMPLE_SIZE, node.address)}
                 msg = json.dumps(node_list).encode('utf-8')
                 self.send_message(msg, node)
+                # replying with our own INIT so the other side knows what we support
+                node.features = int.from_bytes(initial_message[4:6], byteorder='big')
+                self.send_message(INIT.to_bytes(2, byteorder='big') + self.port.to_bytes(2, byteorder='big') + self.features.to_bytes(2, byteorder='big'), node)
                 self.add_node(node)
+                self.send_ping(node) # timing it straight away, so it can be ranked before the first minute is up
             else:
                 self.write_log(f"Connection failed: {connection}\n")
                 return
-        else:
-            # otherwise, we want the longest chain, as we are new.
-            self.send_message(GET_LONGEST_CHAIN.to_bytes(2, byteorder='big') + (0).to_bytes(4, byteorder='big'), node)
+        # otherwise, we want the longest chain, as we are new. That is asked for once the INIT reply tells us what the node supports
         # Send the list of nodes in JSON format to the connected node
         
 
+        fragment = b'' # leftover bytes of a frame that was split across recv calls
         while True:
             # loop to receive and process messages from the node
-            fragment = b''
             try:
-                connection.settimeout(1)
+                # blocking until there is something, idle nodes are checked on by the scheduler (check_liveness)
                 message = connection.recv(1024*8)
                 if message == b'':
                     #connection was closed by peer
                     self.write_log(f"Connection closed by peer: {node}\n")
                     break
+                node.bytes_in += len(message)
                 message = fragment + message
                 leny = int.from_bytes(message[:2], byteorder='big')
-                print("Message length:", leny, len(message[2:]))
-                while len(message[2:]) >= leny and leny > 0:
+                self.write_log(lambda: f"Message length: {leny}, have {len(message[2:])}\n")
+                while len(message[2:]) >= leny and leny > 0 and not node.closed:
+                    typey = int.from_bytes(message[2:4], byteorder='big')
+                    self.bytes_in.inc(leny + 2, MESSAGE_NAMES.get(typey, str(typey)))
                     self.handle_message(message[2:leny+2], node) 
                     message = message[leny+2:]
                     leny = int.from_bytes(message[:2], byteorder='big')
                 fragment = message
-            except socket.timeout:
-                node.lastSeen += 1
+            except OSError as e:
+                # we closed it ourselves (disconnect_node), or the connection broke
+                self.write_log(f"Connection to {node} ended: {e}\n")
+                break
                 
 
     def send_vote(self, vote):
@@ -364,56 +682,256 @@ class Peer():
         - message: The message to handle
         - node: The node that sent the message
         """
-        try:
-            typey = int.from_bytes(message[:2], byteorder='big')
-            #if typey == BLOCK:
-
+        typey = int.from_bytes(message[:2], byteorder='big')
+        if node.closed:
+            return
+        # a TRACED frame is traced under the id it came with, as the message inside it
+        trace_id = None
+        if typey == TRACED:
+            trace_id = bytes(message[2:2 + TRACE_ID_SIZE])
+            typey = int.from_bytes(message[2 + TRACE_ID_SIZE:4 + TRACE_ID_SIZE], byteorder='big')
+            message = message[2 + TRACE_ID_SIZE:]
+        with self.tracer.start(MESSAGE_NAMES.get(typey, "unknown"), trace_id):
             # Reset lastSeen counter whenever we get any message
             node.lastSeen = 0
-            
-            if typey == PING:
-                # Reply with pong
-                pong_message = PONG.to_bytes(2, byteorder='big')
-                self.send_message(pong_message, node)
-            elif typey == PONG:
-                # Do nothing, lastSeen already reset
-                pass
-            elif typey == BLOCK:
-                self.handle_block(message[2:], node)
-            elif typey == VOTE:
-                self.handle_vote(message[2:], node)
-            elif typey == INIT:
-                pass # we ignore more init messages from the same node
-                # Handle init message here
-            elif typey == ELECTION:
-                self.handle_election(message[2:], node)
-            elif typey == LONGEST_CHAIN:
-                self.receive_longest_chain(message[2:], node)
-            elif typey == GET_LONGEST_CHAIN:
-                self.get_longest_chain(message[2:], node)
-                # Handle get longest chain message here. Return the heeaders for the longest chain
-            elif typey == GET_BLOCK:
-                self.get_block(message[2:], node) 
-            elif typey == GET_ELECTION_RES:
-                self.get_election(message[2:], node)
-                # Handle get election message here. Return the election for the given name, along with the votes, and the merkle trees to prove it.
-            elif typey == ELECTION_RES:
-                self.handle_election_res(message[2:], node)
+            node.last_heard = time.monotonic()
+            # nodes only get so much of our CPU, anything over their budget is dropped unread. Answers to our own requests are free.
+            # Checked before the seen filter, so a copy we throw away here is not remembered and the next one from someone else gets through
+            answer = self.is_answer(typey, message, node)
+            if not answer and not self.allow_message(typey, message, node):
                 return
-            elif typey == ERROR_RESPONSE:
-                print(f"Error response received: {message[2:].decode('utf-8')}")
+            # flooded messages show up once from every neighbour, drop the copies before doing any work on them
+            if typey in SEEN_FILTER_TYPES and self.check_seen(typey, message):
                 return
-            elif typey == GET_ACTIVE_ELECTIONS:
-                self.get_active_election(node)
-            elif typey == ACTIVE_ELECTIONS:
-                self.handle_active_elections(message[2:], node)
-            else:
-                self.write_log(f"Unknown message type: {message[:2]}\n")
-        # checks so I dont have to put these in every one (i still do sometimes though)
-        except json.JSONDecodeError:
-            self.write_log(f"Failed to decode message: {message}\n")
-        except KeyError as e:
-            self.write_log(f"Malformed message: {e}\n")
+            start = time.thread_time() # CPU time, waiting on the data lock or a backed up send is not the node's doing
+            try:
+                if typey == PING:
+                    # Reply with pong, echoing the time so the sender can work out the round trip
+                    self.send_message(PONG.to_bytes(2, byteorder='big') + message[2:10], node)
+                elif typey == PONG:
+                    # lastSeen already reset, just record the round trip time
+                    if len(message) == 10:
+                        node.update_rtt((time.monotonic_ns() - int.from_bytes(message[2:10], byteorder='big')) / 1e9)
+                elif typey == BLOCK:
+                    self.handle_block(message[2:], node)
+                elif typey == CMPCT_BLOCK:
+                    self.handle_compact_block(message[2:], node)
+                elif typey == GET_BLOCK_TXN:
+                    self.get_block_txn(message[2:], node)
+                elif typey == BLOCK_TXN:
+                    self.handle_block_txn(message[2:], node)
+                elif typey == VOTE:
+                    self.handle_vote(message[2:], node)
+                elif typey == VOTE_BATCH:
+                    self.handle_vote_batch(message[2:], node)
+                elif typey == INIT:
+                    # the reply to our INIT, tells us what the node supports. Now we can ask for its chain
+                    node.features = int.from_bytes(message[4:6], byteorder='big')
+                    self.send_ping(node)
+                    self.start_sync(node)
+                elif typey == COMPRESSED:
+                    inner = self.decompress_message(message[2:])
+                    if inner is not None:
+                        self.handle_message(inner, node)
+                elif typey == ELECTION:
+                    self.handle_election(message[2:], node)
+                elif typey == LONGEST_CHAIN:
+                    self.receive_longest_chain(message[2:], node)
+                elif typey == GET_HEADERS:
+                    self.get_headers(message[2:], node)
+                elif typey == HEADERS:
+                    self.receive_headers(message[2:], node)
+                elif typey == GET_LONGEST_CHAIN:
+                    self.get_longest_chain(message[2:], node)
+                    # Handle get longest chain message here. Return the heeaders for the longest chain
+                elif typey == GET_BLOCK:
+                    self.get_block(message[2:], node) 
+                elif typey == GET_BLOCKS:
+                    self.get_blocks(message[2:], node)
+                elif typey == GET_ELECTION_RES:
+                    self.get_election(message[2:], node)
+                    # Handle get election message here. Return the election for the given name, along with the votes, and the merkle trees to prove it.
+                elif typey == ELECTION_RES:
+                    self.handle_election_res(message[2:], node)
+                    return
+                elif typey == ERROR_RESPONSE:
+                    print(f"Error response received: {message[2:].decode('utf-8')}")
+                    return
+                elif typey == GET_ACTIVE_ELECTIONS:
+                    self.get_active_election(node)
+                elif typey == GET_PEERS:
+                    self.get_peers(message[2:], node)
+                elif typey == PEERS:
+                    self.learn_peers(json.loads(message[2:].decode('utf-8')), node)
+                elif typey == ACTIVE_ELECTIONS:
+                    self.handle_active_elections(message[2:], node)
+                else:
+                    self.write_log(f"Unknown message type: {message[:2]}\n")
+            # checks so I dont have to put these in every one (i still do sometimes though)
+            except json.JSONDecodeError:
+                self.write_log(f"Failed to decode message: {message}\n")
+            except KeyError as e:
+                self.write_log(f"Malformed message: {e}\n")
+            finally:
+                elapsed = time.thread_time() - start
+                with self.stats_lock:
+                    if typey not in self.handle_stats:
+                        self.handle_stats[typey] = [0, 0.0]
+                    self.handle_stats[typey][0] += 1
+                    self.handle_stats[typey][1] += elapsed
+                if typey != COMPRESSED: # the inner message charges for itself
+                    self.charge_node(node, typey, elapsed, answer)
+
+    def message_cost(self, typey):
+        """
+        What we expect a message of this type to cost us, in seconds.
+        The measured average once we have handled enough of them, a starting guess before that.
+        args:
+        - typey: The message type
+        """
+        with self.stats_lock:
+            handled, seconds = self.handle_stats.get(typey, [0, 0.0])
+        if handled >= MIN_COST_SAMPLES:
+            return seconds / handled
+        return MESSAGE_COSTS.get(typey, DEFAULT_MESSAGE_COST)
+
+    def is_answer(self, typey, message, node):
+        """
+        Checks if a message is the answer to a request we made, which is never limited or charged: a block we are downloading
+        or asked this node for. HEADERS and BLOCK_TXN only ever come as answers, they are not in RATE_LIMITED_TYPES at all.
+        args:
+        - typey: The message type
+        - message: The raw message (type + payload)
+        - node: The node that sent it
+        """
+        if typey != BLOCK:
+            return False
+        block_hash = hashy(message[2:2+HEADER_SIZE])
+        if block_hash in node.blocks_asked:
+            node.blocks_asked.discard(block_hash)
+            return True
+        return block_hash in self.downloader.in_flight
+
+    def allow_message(self, typey, message, node):
+        """
+        Checks if the node has enough left in its token bucket to pay for this message. Only messages a node can send us unasked are limited,
+        answers to our own requests (see is_answer) are not checked here.
+        Nodes we have had to send errors to pay more for everything.
+        args:
+        - typey: The message type
+        - message: The raw message (type + payload)
+        - node: The node that sent it
+        """
+        if typey not in RATE_LIMITED_TYPES:
+            return True
+        cost = self.message_cost(typey)
+        if not node.good:
+            cost *= BAD_NODE_COST_FACTOR
+        if node.bucket.has(cost):
+            return True
+        node.throttled += 1
+        if node.throttled % 1000 == 1:
+            self.write_log(f"X Rate limiting {node.address}: {MESSAGE_NAMES.get(typey, typey)} dropped, {node.throttled} dropped so far\n")
+        return False
+
+    def charge_node(self, node, typey, elapsed, answer = False):
+        """
+        Records what a message from the node actually cost us, and takes it out of the node's bucket.
+        A node that has run up too much debt is disconnected.
+        args:
+        - node: The node that sent the message
+        - typey: The message type
+        - elapsed: CPU seconds spent handling it
+        - answer: If it answered a request we made, then it is recorded but not charged
+        """
+        node.cpu_time += elapsed
+        if typey not in node.messages:
+            node.messages[typey] = [0, 0.0]
+        node.messages[typey][0] += 1
+        node.messages[typey][1] += elapsed
+        if typey not in RATE_LIMITED_TYPES or answer:
+            return
+        if not node.good:
+            elapsed *= BAD_NODE_COST_FACTOR
+        if node.bucket.consume(elapsed) < -PEER_CPU_DEBT_LIMIT:
+            self.disconnect_node(node, "over CPU budget")
+
+    def disconnect_node(self, node, reason):
+        """
+        Drops a node: removes it from the node list and closes the connection, which ends its talk_to_node thread.
+        args:
+        - node: The node to drop
+        - reason: Why, for the log
+        """
+        if node.closed:
+            return
+        node.closed = True
+        self.write_log(f"X Disconnecting {node.address}: {reason}\n")
+        self.remove_node(node.address)
+        try:
+            node.connection.shutdown(socket.SHUT_RDWR)
+            node.connection.close()
+        except OSError:
+            pass
+
+    def peer_stats_report(self):
+        """
+        Returns the CPU and bandwidth each node has cost us, busiest first.
+        """
+        report = {}
+        for addr, node in sorted(list(self.nodes.items()), key=lambda item: -item[1].cpu_time):
+            report[f"{addr[0]}:{addr[1]}"] = {
+                "cpu_ms": round(node.cpu_time * 1000, 2),
+                "bytes_in": node.bytes_in,
+                "bytes_out": node.bytes_out,
+                "throttled": node.throttled,
+                "errors": node.errors,
+                "tokens": round(node.bucket.refill(), 3),
+                "messages": {MESSAGE_NAMES.get(t, str(t)): n for t, (n, _) in node.messages.items()},
+            }
+        return report
+
+    def check_seen(self, typey, message):
+        """
+        Checks the raw message against the seen filter, and keeps count of how many duplicates it caught.
+        args:
+        - typey: The message type
+        - message: The raw message (type + payload)
+        """
+        start = time.perf_counter()
+        duplicate = self.seen_filter.check_and_add(message)
+        elapsed = time.perf_counter() - start
+        with self.stats_lock:
+            if typey not in self.seen_stats:
+                self.seen_stats[typey] = [0, 0, 0.0]
+            stats = self.seen_stats[typey]
+            stats[0] += 1
+            stats[1] += duplicate
+            stats[2] += elapsed
+        return duplicate
+
+    def seen_filter_report(self):
+        """
+        Returns how many duplicates the seen filter dropped for each message type, and an estimate of the share of inbound CPU that saved.
+        The saving is the duplicates times the average cost of handling a message of that type (which is what they would have cost us).
+        """
+        report = {}
+        total_spent = 0.0
+        total_saved = 0.0
+        with self.stats_lock:
+            for typey, (checked, duplicates, filter_seconds) in self.seen_stats.items():
+                handled, handle_seconds = self.handle_stats.get(typey, [0, 0.0])
+                saved = duplicates * (handle_seconds / handled) if handled else 0.0
+                total_spent += handle_seconds + filter_seconds
+                total_saved += saved
+                report[MESSAGE_NAMES.get(typey, str(typey))] = {
+                    "checked": checked,
+                    "duplicates": duplicates,
+                    "ms_saved": round(saved * 1000, 2),
+                    "ms_filtering": round(filter_seconds * 1000, 2),
+                }
+        report["cpu_saved_share"] = round(total_saved / (total_saved + total_spent), 3) if total_saved + total_spent else 0
+        return report
     
     def get_active_election(self, node):
         """
@@ -447,26 +965,170 @@ class Peer():
         - node: The node that sent the message
         """
         with self.data_lock:
-            if message in self.blocks:
+            if message in self.blocks and not self.blocks[message].has_data():
+                self.send_error(node, "Block pruned", False)
+            elif message in self.blocks:
                 block = self.blocks[message]
                 # Send the block to the node
-                self.send_message(BLOCK.to_bytes(2, byteorder='big') + block.get_sendable(), node)
+                self.send_message(BLOCK.to_bytes(2, byteorder='big') + self.block_bytes(block), node)
             else:
                 self.write_log(f"Get block request failed: Block not found: {len(message[2:])} {message[2:]}\n")
                 # Send an error message to the node
                 self.send_error(node, "Block not found")
-    def send_message(self, message, node):
+
+    def get_blocks(self, message, node):
+        """
+        Handles get blocks messages from nodes. Either a start hash and a count (walking forward on our main chain),
+        or a list of hashes. The blocks are streamed back as normal BLOCK messages, one after another.
+        Sending happens outside the data lock, sendall blocks once the connection is backed up, which is our flow control.
+        Only sends to this node wait on it, and a node that stops reading for SEND_TIMEOUT is dropped.
+        args:
+        - message: The message to handle
+        - node: The node that sent the message
+        """
+        # a range is the mode, a start hash and a count, a list is the mode and whole hashes
+        if len(message) < 1 or (message[0] == GET_BLOCKS_RANGE and len(message) != 35) or (message[0] == GET_BLOCKS_LIST and (len(message) < 33 or (len(message) - 1) % 32)):
+            self.write_log(f"X Malformed get blocks request from {node}: {len(message)} bytes\n")
+            self.send_error(node, "Malformed get blocks request")
+            return
+        mode = message[0]
+        blocks = []
+        with self.data_lock:
+            if mode == GET_BLOCKS_RANGE:
+                start = message[1:33]
+                count = min(int.from_bytes(message[33:35], byteorder='big'), MAX_BLOCKS_PER_REQUEST)
+                if start not in self.blocks or not self.on_main_chain(self.blocks[start]):
+                    self.write_log(f"Get blocks request failed: start block not on our chain: {start}\n")
+                    self.send_error(node, "Block not found")
+                    return
+                height = self.blocks[start].index
+                blocks = self.main_chain[height:height + count]
+            elif mode == GET_BLOCKS_LIST:
+                for i in range(1, min(len(message), 1 + 32 * MAX_BLOCKS_PER_REQUEST), 32):
+                    if message[i:i+32] in self.blocks:
+                        blocks.append(self.blocks[message[i:i+32]])
+            else:
+                self.write_log(f"X Unknown get blocks mode: {mode}\n")
+                self.send_error(node, "Unknown get blocks mode")
+                return
+        if not all(block.has_data() for block in blocks):
+            blocks = [block for block in blocks if block.has_data()]
+            self.send_error(node, "Block pruned", False) # the rest will time out on their end and be asked for from someone else
+        self.write_log(f"Sending {len(blocks)} blocks to node {node}\n")
+        for block in blocks:
+            self.send_message(BLOCK.to_bytes(2, byteorder='big') + self.block_bytes(block), node)
+
+    def block_bytes(self, block):
+        """
+        The block as we send it. If the body is not in memory the bytes come straight from the block store, there is no need to parse
+        it just to write it back out. Otherwise they are cached on the block.
+        """
+        if not block.has_body() and self.block_store is not None:
+            sendable = self.block_store.get(block.hash)
+            if sendable is not None:
+                return sendable
+        return block.get_sendable()
+
+    def send_message(self, message, node, wait = True):
         """
         Sends a message to the node. Does number of bytes in the message + the message
+        Big messages are compressed if the node told us it can handle it.
         args:
         - message: The message to send
         - node: The node to send the message to
+        - wait: If another thread is sending to the node, wait for it. If False the message is not sent and False is returned
         """
         if node is None:
             return
-        with self.send_lock:
-            leny = len(message)
-            node.connection.send(leny.to_bytes(2, byteorder='big') + message)
+        if node.features & FEATURE_COMPRESSION and len(message) >= COMPRESSION_THRESHOLD:
+            message = self.compress_message(message)
+        return self.send_frame(len(message).to_bytes(2, byteorder='big') + message, node, wait)
+
+    def send_frame(self, frame, node, wait = True):
+        """
+        Writes a whole frame (length and all) to the node, holding the node's send lock so frames from different threads dont interleave.
+        A send that fails or is stuck for SEND_TIMEOUT may have written part of the frame, so the node is dropped and the OSError raised.
+        args:
+        - frame: The frame
+        - node: The node to send it to
+        - wait: If another thread is sending to the node, wait for it. If False the frame is not sent and False is returned
+        """
+        if not node.send_lock.acquire(wait):
+            return False
+        try:
+            node.connection.sendall(frame)
+            node.bytes_out += len(frame)
+        except OSError as e:
+            error = e
+        else:
+            error = None
+        finally:
+            node.send_lock.release()
+        if error is not None:
+            self.disconnect_node(node, f"send failed: {error}")
+            raise error
+        typey = int.from_bytes(frame[2:4], byteorder='big')
+        self.bytes_out.inc(len(frame), MESSAGE_NAMES.get(typey, str(typey)))
+        return True
+
+    def compress_message(self, message):
+        """
+        Compresses a message (type + payload) into a COMPRESSED frame, and records how well it did.
+        If compressing does not make it smaller, the original message is returned.
+        args:
+        - message: The message to compress
+        """
+        typey = int.from_bytes(message[:2], byteorder='big')
+        start = time.perf_counter()
+        compressed = COMPRESSED.to_bytes(2, byteorder='big') + zlib.compress(message, COMPRESSION_LEVEL)
+        elapsed = time.perf_counter() - start
+        with self.stats_lock:
+            if typey not in self.compression_stats:
+                self.compression_stats[typey] = [0, 0, 0, 0.0]
+            stats = self.compression_stats[typey]
+            stats[0] += 1
+            stats[1] += len(message)
+            stats[2] += min(len(compressed), len(message))
+            stats[3] += elapsed
+        if len(compressed) >= len(message):
+            return message
+        return compressed
+
+    def decompress_message(self, message):
+        """
+        Decompresses the payload of a COMPRESSED frame. Returns None if it is broken, too big, or nested.
+        args:
+        - message: The compressed payload
+        """
+        try:
+            decompressor = zlib.decompressobj()
+            inner = decompressor.decompress(message, MAX_BLOCK_SIZE)
+        except zlib.error as e:
+            self.write_log(f"X Failed to decompress message: {e}\n")
+            return None
+        if decompressor.unconsumed_tail:
+            self.write_log("X Compressed message too big, dropping\n")
+            return None
+        if int.from_bytes(inner[:2], byteorder='big') == COMPRESSED:
+            self.write_log("X Nested compressed message, dropping\n")
+            return None
+        return inner
+
+    def compression_report(self):
+        """
+        Returns the compression ratio and the cost of compressing for each message type we have compressed.
+        """
+        report = {}
+        with self.stats_lock:
+            for typey, (count, raw, compressed, seconds) in self.compression_stats.items():
+                report[MESSAGE_NAMES.get(typey, str(typey))] = {
+                    "frames": count,
+                    "ratio": round(raw / compressed, 2) if compressed else 0,
+                    "saved_bytes": raw - compressed,
+                    "ms_per_frame": round(seconds * 1000 / count, 3),
+                    "us_per_kb": round(seconds * 1e6 / (raw / 1024), 1) if raw else 0,
+                }
+        return report
     def receive_longest_chain(self, message, node):
         """
         Handles receive longest chain messages from nodes. Check it for correctness, and see if we need to switch chains (if so, we need to grab the data for all the nodes we dont have)
@@ -479,7 +1141,8 @@ class Peer():
         #pull out chunks of 84 byte sections
         #these should be in the normal header format
         with self.data_lock:
-            for i in range(len(message) - 84, -1, -84):
+            missing = []
+            for i in range(0, len(message) - 83, 84): # oldest first
                 # Extract the block header
                 block_header = message[i:i+84]
                 # Exract the rest of the block eader fields
@@ -487,12 +1150,161 @@ class Peer():
                 if this_hash in self.blocks:
                     # this block is already in our chain, so we can skip it
                     continue
-                self.request_block(this_hash, node)
+                missing.append(this_hash)
+            self.request_blocks(missing, node)
+        self.continue_longest_chain(message, node)
+
+    def continue_longest_chain(self, message, node):
+        """
+        Asks a node for the rest of its chain if the longest chain reply it sent was full (get_longest_chain sends at most
+        MAX_HEADERS_PER_MESSAGE headers at a time).
+        args:
+        - message: The longest chain reply
+        - node: The node that sent it
+        """
+        if len(message) == MAX_HEADERS_PER_MESSAGE * HEADER_SIZE:
+            next_index = int.from_bytes(message[-HEADER_SIZE:-HEADER_SIZE + 4], byteorder='big') + 1
+            self.send_message(GET_LONGEST_CHAIN.to_bytes(2, byteorder='big') + next_index.to_bytes(4, byteorder='big'), node)
             
 
+    def start_sync(self, node):
+        """
+        Asks a node we just connected to for its chain. Uses a block locator if the node can do GET_HEADERS,
+        otherwise falls back on asking for the whole chain.
+        args:
+        - node: The node to sync with
+        """
+        if node.features & FEATURE_HEADERS:
+            with self.data_lock:
+                locator = self.get_locator()
+            self.send_message(GET_HEADERS.to_bytes(2, byteorder='big') + b''.join(locator), node)
+        else:
+            self.send_message(GET_LONGEST_CHAIN.to_bytes(2, byteorder='big') + (0).to_bytes(4, byteorder='big'), node)
+
+    def send_ping(self, node, wait = True):
+        """
+        Pings a node. The PONG carries our send time back, which gives us its round trip time.
+        args:
+        - node: The node to ping
+        - wait: As for send_message
+        """
+        return self.send_message(PING.to_bytes(2, byteorder='big') + time.monotonic_ns().to_bytes(8, byteorder='big'), node, wait)
+
+    def rank_nodes(self, nodes, size = 0):
+        """
+        Sorts nodes fastest first, by how long we expect them to take to answer a request for size bytes.
+        args:
+        - nodes: The nodes to sort
+        - size: Roughly how big the answer will be
+        """
+        return sorted(nodes, key=lambda node: node.expected_time(size))
+
+    def continue_headers(self, node, last_hash, locator):
+        """
+        Asks for the next batch of headers after last_hash. It goes to the fastest node that can do GET_HEADERS, not only the one that
+        sent the last batch. That node is remembered, and asked again if the fast one comes back with less than a full batch.
+        args:
+        - node: The node that sent the last batch
+        - last_hash: The hash of the last header in it
+        - locator: Our block locator, for a node that does not know last_hash
+        """
+        target = node
+        ranked = self.rank_nodes([n for n in list(self.nodes.values()) if n.features & FEATURE_HEADERS], MAX_HEADERS_PER_MESSAGE * HEADER_SIZE)
+        if ranked and ranked[0] is not node:
+            target = ranked[0]
+            with self.data_lock:
+                self.header_fallback[target] = (node, last_hash)
+        self.send_message(GET_HEADERS.to_bytes(2, byteorder='big') + last_hash + b''.join(locator), target)
+
+    def headers_done(self, node, full, last_hash, locator):
+        """
+        Called once a batch of headers has been handled. Asks for the next batch if it was full. If it was not, and we only asked
+        this node because it was faster, the node that had more gets asked again.
+        args:
+        - node: The node that sent the batch
+        - full: If the batch was full (the node probably has more)
+        - last_hash: The hash of the last header in the batch
+        - locator: Our block locator
+        """
+        with self.data_lock:
+            fallback = self.header_fallback.pop(node, None)
+        if full and last_hash is not None:
+            self.continue_headers(node, last_hash, locator)
+        elif fallback is not None and not fallback[0].closed:
+            self.send_message(GET_HEADERS.to_bytes(2, byteorder='big') + fallback[1] + b''.join(locator), fallback[0])
+
+    def get_locator(self):
+        """
+        Builds a block locator for our main chain: the last 10 hashes, then going back in doubling steps, always ending on the genesis block.
+        Whoever gets it can find where our chains split in O(log(height)) hashes.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        """
+        locator = []
+        height = len(self.main_chain) - 1
+        step = 1
+        while height > 0 and len(locator) < MAX_LOCATOR_HASHES - 1:
+            locator.append(self.main_chain[height].hash)
+            if len(locator) >= 10:
+                step *= 2
+            height -= step
+        if self.main_chain:
+            locator.append(self.main_chain[0].hash)
+        return locator
+
+    def get_headers(self, message, node):
+        """
+        Handles get headers messages from nodes. The message is a block locator, we find the first hash in it that is on our main chain
+        and send back the headers that come after it (at most MAX_HEADERS_PER_MESSAGE, the node will ask again for more).
+
+        args:
+        - message: The message to handle
+        - node: The node that sent the message
+        """
+        with self.data_lock:
+            start = 0 # if nothing in the locator is on our chain, we start from the genesis block
+            for i in range(0, len(message) - 31, 32):
+                locator_hash = message[i:i+32]
+                if locator_hash in self.blocks and self.on_main_chain(self.blocks[locator_hash]):
+                    start = self.blocks[locator_hash].index + 1
+                    break
+            result = bytes(self.header_chain[start * HEADER_SIZE:(start + MAX_HEADERS_PER_MESSAGE) * HEADER_SIZE])
+        self.send_message(HEADERS.to_bytes(2, byteorder='big') + result, node)
+        self.write_log(f"Sent {len(result) // HEADER_SIZE} headers from height {start} to node {node}\n")
+
+    def receive_headers(self, message, node):
+        """
+        Handles headers messages from nodes. The headers are oldest first, and have to link up with each other.
+        We request the blocks we dont have, and if the batch was full, ask for the next one.
+
+        args:
+        - message: The message to handle
+        - node: The node that sent the message
+        """
+        if len(message) % HEADER_SIZE != 0:
+            self.write_log(f"X Malformed headers message, length {len(message)}\n")
+            return
+        with self.data_lock:
+            missing = []
+            last_hash = None
+            for i in range(0, len(message), HEADER_SIZE):
+                header = message[i:i + HEADER_SIZE]
+                prev_hash = header[4:36]
+                if last_hash is not None and prev_hash != last_hash:
+                    self.write_log("X Headers do not link up, dropping the rest\n")
+                    break
+                last_hash = hashy(header)
+                if last_hash not in self.blocks:
+                    missing.append(last_hash)
+            self.request_blocks(missing, node)
+            locator = self.get_locator()
+        # if the batch was full there is probably more, continue from the last header we got
+        self.headers_done(node, len(message) == MAX_HEADERS_PER_MESSAGE * HEADER_SIZE, last_hash, locator)
+
     def get_longest_chain(self, message, node):
         """
         Handles get longest chain messages from nodes. Starts from index specified, but this should useally be 0 to get the whole chain.
+        The headers go out oldest first, straight from header_chain, at most MAX_HEADERS_PER_MESSAGE of them so the reply fits in one
+        message. A full reply means there are probably more, and the node asks again from where it ended (see continue_longest_chain).
 
 
         args:
@@ -502,14 +1314,7 @@ class Peer():
         # finding the node with the greatest total work
         idx = int.from_bytes(message[:4], byteorder='big')
         with self.data_lock:
-            current = self.biggest_chain
-            result = []
-            while current is not None and current.index >= idx:
-                header = current.get_header()
-                result.append(header)
-                current = current.previous_block
-            # smashing results together so its one big binary string
-            result = b''.join(result)
+            result = bytes(self.header_chain[idx * HEADER_SIZE:(idx + MAX_HEADERS_PER_MESSAGE) * HEADER_SIZE])
             # send the result back to the node
             self.send_message(LONGEST_CHAIN.to_bytes(2, byteorder='big') + result, node)
             self.write_log(f"Longest chain sent to node {node}\n")
@@ -531,26 +1336,149 @@ class Peer():
         - node: The node that sent the message
         """
         vote = Vote(message)
-        self.write_log(f"Vote message received: {vote.jsonify()}\n")
+        self.write_log(lambda: f"Vote message received: {vote.jsonify()}\n")
         with self.data_lock:
-            election = None
-            if vote.election_hash in self.open_elections: 
-                election = self.open_elections[vote.election_hash]
-            else:
-                self.write_log(f"Vote for ended or non-existent election: {vote.election_hash}\n")
+            self.admit_vote(vote, message, node)
 
-            res = self.check_vote(vote, election, time.time() + 20) # makes sure it will be valid for long enough that we could mine theoretically
+    def handle_vote_batch(self, message, node):
+        """
+        Handles vote batch messages from nodes. Every vote is checked against the seen filter and parsed first,
+        then they are all checked and added in one pass with the data lock taken once.
 
-            if not res:
-                self.write_log(f"VOTE FAILED CHECKS: {vote.jsonify()}\n")
-                return
-            
-            gas = 1
-            self.write_log(f"[ ] Vote added: {vote.jsonify()}\n")
-            election.used_keys[vote.public_key] = vote.choice # mark the key as used
-            self.all_things[hashy(vote.jsonify())] = (gas, vote) # theoritical GAS ammount, unimplemented
-            self.new_votes[hashy(vote.jsonify())] = vote # add the vote to the new votes so we can throw it on a block
-            self.broadcast(node, VOTE, message) # if its good, we spread it to the rest of the network
+        args:
+        - message: The message to handle
+        - node: The node that sent the message
+        """
+        votes = []
+        for raw in self.split_vote_batch(message):
+            # same key as if the vote came in on its own, so a vote is only worked on once however it gets here
+            if self.check_seen(VOTE, VOTE.to_bytes(2, byteorder='big') + raw):
+                continue
+            try:
+                votes.append((Vote(raw), raw))
+            except (json.JSONDecodeError, KeyError, UnicodeDecodeError, ValueError) as e:
+                self.write_log(f"X Malformed vote in batch: {e}\n")
+        if not votes:
+            return
+        start = time.thread_time()
+        with self.data_lock:
+            added = 0
+            for vote, raw in votes:
+                added += self.admit_vote(vote, raw, node)
+        # counted as votes too, so the seen filter report knows what a vote costs us
+        elapsed = time.thread_time() - start
+        with self.stats_lock:
+            if VOTE not in self.handle_stats:
+                self.handle_stats[VOTE] = [0, 0.0]
+            self.handle_stats[VOTE][0] += len(votes)
+            self.handle_stats[VOTE][1] += elapsed
+        self.write_log(f"INF: Vote batch of {len(votes)} new votes, {added} added\n")
+
+    def split_vote_batch(self, message):
+        """
+        Splits a vote batch into the raw vote messages.
+        """
+        result = []
+        i = 0
+        while i + 2 <= len(message):
+            leny = int.from_bytes(message[i:i+2], byteorder='big')
+            result.append(message[i+2:i+2+leny])
+            i += 2 + leny
+        return result
+
+    def admit_vote(self, vote, message, node):
+        """
+        Checks a vote, and if it is good, adds it to the new votes and queues it to be relayed.
+        MUST BE CALLED WITH THE DATA LOCK HELD
+
+        args:
+        - vote: The vote
+        - message: The raw vote message, this is what gets relayed
+        - node: The node that sent the vote
+
+        returns:
+        - True if the vote was added
+        """
+        election = None
+        if vote.election_hash in self.open_elections: 
+            election = self.open_elections[vote.election_hash]
+        else:
+            self.write_log(f"Vote for ended or non-existent election: {vote.election_hash}\n")
+            # the election may just not have got here yet, so a copy that comes after it has to get through the seen filter
+            self.seen_filter.forget(VOTE.to_bytes(2, byteorder='big') + message)
+            return False
+
+        res = self.check_vote(vote, election, time.time() + 20) # makes sure it will be valid for long enough that we could mine theoretically
+
+        if not res:
+            self.write_log(lambda: f"VOTE FAILED CHECKS: {vote.jsonify()}\n")
+            return False
+        
+        gas = 1
+        self.write_log(lambda: f"[ ] Vote added: {vote.jsonify()}\n")
+        election.used_keys[vote.public_key] = vote.choice # mark the key as used
+        self.all_things[hashy(vote.jsonify())] = (gas, vote) # theoritical GAS ammount, unimplemented
+        self.pool_add(self.new_votes, hashy(vote.jsonify()), vote) # add the vote to the new votes so we can throw it on a block
+        self.queue_vote_relay(message, node) # if its good, we spread it to the rest of the network
+        return True
+
+    def queue_vote_relay(self, message, node):
+        """
+        Queues a vote to be relayed with the next batch. The relay thread sends it within VOTE_BATCH_INTERVAL,
+        or straight away once VOTE_BATCH_SIZE votes are waiting.
+
+        args:
+        - message: The raw vote message
+        - node: The node that sent it (it does not get it back)
+        """
+        self.seen_filter.check_and_add(VOTE.to_bytes(2, byteorder='big') + message) # so it is dropped when it comes back around to us
+        with self.vote_relay_ready:
+            self.vote_relay.append((message, node))
+            if len(self.vote_relay) == 1 or len(self.vote_relay) >= VOTE_BATCH_SIZE:
+                self.vote_relay_ready.notify()
+
+    def vote_relay_loop(self):
+        """
+        Sends out the queued votes. Sleeps until there is a vote, gives the batch VOTE_BATCH_INTERVAL to fill up, then relays it.
+        """
+        while True:
+            with self.vote_relay_ready:
+                while not self.vote_relay:
+                    self.vote_relay_ready.wait()
+                if len(self.vote_relay) < VOTE_BATCH_SIZE:
+                    self.vote_relay_ready.wait(VOTE_BATCH_INTERVAL)
+                pending = self.vote_relay
+                self.vote_relay = []
+            self.flush_vote_relay(pending)
+
+    def flush_vote_relay(self, pending):
+        """
+        Relays a batch of votes. Each node gets every vote it did not send us, as VOTE_BATCH frames if it supports them,
+        otherwise one VOTE frame per vote.
+
+        args:
+        - pending: The (vote message, sender) pairs to relay
+        """
+        for addr, node in list(self.nodes.items()):
+            votes = [message for message, sender in pending if sender is not node]
+            try:
+                if not node.features & FEATURE_VOTE_BATCH:
+                    for message in votes:
+                        self.send_message(VOTE.to_bytes(2, byteorder='big') + message, node)
+                    continue
+                batch = []
+                size = 0
+                for message in votes:
+                    if batch and size + 2 + len(message) > MAX_VOTE_BATCH_BYTES:
+                        self.send_message(VOTE_BATCH.to_bytes(2, byteorder='big') + b''.join(batch), node)
+                        batch = []
+                        size = 0
+                    batch.append(len(message).to_bytes(2, byteorder='big') + message)
+                    size += 2 + len(message)
+                if batch:
+                    self.send_message(VOTE_BATCH.to_bytes(2, byteorder='big') + b''.join(batch), node)
+            except Exception as e:
+                self.disconnect_node(node, f"failed to send votes: {e}")
 
         
     def handle_election(self, message, node):
@@ -563,7 +1491,7 @@ class Peer():
         - node: The node that sent the message
         """
         election = Election(message)
-        self.write_log(f"Election message received: {election.jsonify()}\n")
+        self.write_log(lambda: f"Election message received: {election.jsonify()}\n")
         with self.data_lock:
             if election.hashy in self.open_elections:
                 self.write_log(f"X Election already exists: {election.name}\n")
@@ -574,7 +1502,7 @@ class Peer():
             gas = 1
             self.open_elections[election.hashy] = election
             self.all_things[hashy(election.jsonify())] = (gas, election) # theoritical GAS ammount, unimplemented
-            self.new_elections[hashy(election.jsonify())] =  election
+            self.pool_add(self.new_elections, hashy(election.jsonify()), election)
             self.write_log(f"[ ] Election added: {election.name}\n")
             # Broadcast the election to all nodes
             self.broadcast(node, ELECTION, message)
@@ -613,11 +1541,152 @@ class Peer():
             return
         
         # check that the signature is valid
+        self.signature_checks.inc()
         if not vote.check_sig():
             self.write_log(f"X Vote signature verification failed: {vote.signature}\n")
             return False
         return True
 
+    def handle_compact_block(self, message, node):
+        """
+        Handles compact block messages from nodes. The body is rebuilt from the objects in our mempool,
+        and anything we dont have is asked for with GET_BLOCK_TXN.
+
+        args:
+        - message: The message to handle
+        - node: The node that sent the message
+        """
+        header = message[:84]
+        this_hash = hashy(header)
+        count = int.from_bytes(message[84:86], byteorder='big')
+        # a block holds at most 2**MAX_LEVELS objects, and the short ids have to be all there is. Otherwise the GET_BLOCK_TXN
+        # we would build from it could go over the frame size
+        if len(message) < 86 or count > 2**MAX_LEVELS or len(message) != 86 + count * SHORT_ID_SIZE:
+            self.write_log(f"X Malformed compact block from {node}, {len(message)} bytes for {count} objects\n")
+            self.send_error(node, "Malformed compact block")
+            if len(message) >= 84 and not node.closed:
+                self.request_block(this_hash, node)
+            return
+        short_ids = [message[86 + i * SHORT_ID_SIZE:86 + (i + 1) * SHORT_ID_SIZE] for i in range(count)]
+        with self.data_lock:
+            if this_hash in self.blocks or this_hash in self.pending_compact:
+                return
+            objects = [self.short_ids[short_id][1].get_json_dict() if short_id in self.short_ids else None for short_id in short_ids]
+            missing = [i for i in range(count) if objects[i] is None]
+            if missing:
+                if len(self.pending_compact) >= MAX_PENDING_COMPACT:
+                    del self.pending_compact[next(iter(self.pending_compact))] # dropping the oldest, it will come in as a full block if we need it
+                self.pending_compact[this_hash] = (header, objects)
+                self.write_log(f"INF: Compact block {this_hash} missing {len(missing)} of {count} objects, requesting\n")
+                self.send_message(GET_BLOCK_TXN.to_bytes(2, byteorder='big') + this_hash + b''.join(i.to_bytes(2, byteorder='big') for i in missing), node)
+                return
+        self.finish_compact_block(header, objects, node)
+
+    def finish_compact_block(self, header, objects, node):
+        """
+        Puts a compact block back together into a normal block message and handles it.
+        If the objects dont hash to the merkle root (two objects with the same short id), we ask for the full block instead.
+
+        args:
+        - header: The block header
+        - objects: The json dicts of the objects in the block, in order
+        - node: The node that sent the block
+        """
+        data = []
+        for obj in objects:
+            thing = self.make_object(obj)
+            if thing is None:
+                return
+            data.append(thing)
+        if self.get_merkle_root(data) != header[36:68]:
+            self.write_log(f"INF: Compact block did not match its merkle root, requesting the full block\n")
+            self.request_block(hashy(header), node)
+            return
+        body = {}
+        for count, obj in enumerate(objects):
+            body[count] = obj
+        self.handle_block(header + json.dumps(body).encode('utf-8'), node)
+
+    def get_block_txn(self, message, node):
+        """
+        Handles get block txn messages from nodes, sending back the objects they could not find for a compact block we sent.
+
+        args:
+        - message: The message to handle
+        - node: The node that sent the message
+        """
+        block_hash = message[:32]
+        with self.data_lock:
+            if block_hash not in self.blocks:
+                self.send_error(node, "Block not found")
+                return
+            block = self.blocks[block_hash]
+            if not block.has_data():
+                self.send_error(node, "Block pruned", False)
+                return
+            result = {}
+            for i in range(32, len(message) - 1, 2):
+                index = int.from_bytes(message[i:i+2], byteorder='big')
+                if index < len(block.data):
+                    result[index] = block.data[index].get_json_dict()
+        self.send_message(BLOCK_TXN.to_bytes(2, byteorder='big') + block_hash + json.dumps(result).encode('utf-8'), node)
+
+    def handle_block_txn(self, message, node):
+        """
+        Handles block txn messages from nodes, filling in the objects missing from a compact block.
+
+        args:
+        - message: The message to handle
+        - node: The node that sent the message
+        """
+        block_hash = message[:32]
+        with self.data_lock:
+            if block_hash not in self.pending_compact:
+                return
+            header, block_objects = self.pending_compact.pop(block_hash)
+        # a reply we cannot use is treated like one that left objects out: the block is asked for in full
+        try:
+            objects = json.loads(message[32:].decode('utf-8'))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            objects = None
+        if not isinstance(objects, dict):
+            self.write_log(f"X Malformed block txn from {node}, requesting the full block\n")
+            self.request_block(block_hash, node)
+            return
+        for index, obj in objects.items():
+            try:
+                index = int(index)
+            except ValueError:
+                index = -1
+            if not 0 <= index < len(block_objects) or not isinstance(obj, dict):
+                self.write_log(f"X Malformed block txn from {node}, requesting the full block\n")
+                self.request_block(block_hash, node)
+                return
+            block_objects[index] = obj
+        if None in block_objects:
+            self.write_log(f"X Block txn still missing objects, requesting the full block\n")
+            self.request_block(block_hash, node)
+            return
+        self.finish_compact_block(header, block_objects, node)
+
+    def make_object(self, obj):
+        """
+        Turns the json dict of an object in a block back into the object. Returns None if it is not something we know.
+        args:
+        - obj: The json dict
+        """
+        if "type" not in obj:
+            self.write_log(f"X Malformed object in block data: {obj}\n")
+            return None
+        if obj["type"] == "vote":
+            return Vote(obj)
+        elif obj["type"] == "election":
+            return Election(obj)
+        elif obj["type"] == "end_of_election":
+            return EndOfElection(obj)
+        self.write_log(f"X Unknown object type in block data: {obj['type']}\n")
+        return None
+
     def handle_block(self, message, node, new = True):
         """
         handles a block message from another node.
@@ -639,13 +1708,14 @@ class Peer():
         parent = None
         found = False
         thing = None
-        with self.data_lock:
+        with self.tracer.acquire(self.data_lock, "data_lock"):
+            self.block_received(this_hash, node, len(message))
             # if this is the genisis block, we need to add it to the chain
             if index == 0:
                 found = True
             # otherwise, we need to find the parent block
             if this_hash in self.blocks:
-                self.write_log(f"INF: Duplicate block received: {message}\n")
+                self.write_log(lambda: f"INF: Duplicate block received: {message}\n", LOG_DEBUG)
                 # WE FOUND A DUPLICATE, BREAK IT UP.
                 return
             if prev_hash in self.blocks:
@@ -657,19 +1727,22 @@ class Peer():
 
             # throwing it in the orphan pool, we can check it later once we get the chain it goes on.    
             if not found:
-                self.write_log(f"INF: Orphan block received: {message}\n")
+                self.write_log(lambda: f"INF: Orphan block received: {message}\n", LOG_DEBUG)
                 if prev_hash not in self.orphan_pool:
                     self.orphan_pool[prev_hash] = []
                 if message not in self.orphan_pool[prev_hash]:
                     self.orphan_pool[prev_hash].append(message)
-                # request the parent block from the node
-                self.request_block(prev_hash, node)
+                    self.orphan_hashes.add(this_hash)
+                # request the parent block from the node, unless the downloader is already getting it or it is an orphan itself
+                if not self.downloader.is_pending(prev_hash) and prev_hash not in self.orphan_hashes:
+                    self.request_block(prev_hash, node)
+                self.forget_block(message)
                 return
             # if we found the parent, we can do the rest of verification
             self.verify_block(message, thing, node)
         
         
-    def verify_block(self, message, parent, node):
+    def verify_block(self, message, parent, node, connect_orphans = True):
         """
         Verifies a block message from another node.
         Checks: 
@@ -685,47 +1758,23 @@ class Peer():
         - message: The message to handle
         - node: The node that sent the message
         - parent: The parent block of this block
-        """
-        # pull out index (first 4 bytes)
-        index = int.from_bytes(message[:4], byteorder='big') 
-        # Exract the rest of the block header fields
-        prev_hash = message[4:36]  # 32 bytes for previous hash
-        merkle_root = message[36:68]  # 32 bytes for merkle root
-        timestamp = int.from_bytes(message[68:76], byteorder='big')  # 8 bytes for timestamp
-        difficulty = int.from_bytes(message[76:80], byteorder='big') # 4 bytes for difficulty
-        nonce = int.from_bytes(message[80:84], byteorder='big')  # 4 bytes for nonce
-        block_header = message[:84]
-        header_hash = hashy(block_header)
+        - connect_orphans: If we should go on to connect any orphans waiting on this block
 
-
-        # Extract the votes and elections from the block data. It is a concatanation of json encoded forms of the votes and elections
-        block_data = message[84:]
-        json_data = block_data.decode('utf-8') 
-        if json_data == "":
-            json_data = "{}"
-        # Parse the JSON data to extract votes and elections
-        objects = json.loads(json_data) 
-        
-        # Parse each object in the block data
-        data = []
-        for key in objects:
-            if "type" not in objects[key]:
-                self.write_log(f"X Malformed object in block data: {objects[key]}\n")
-                return
-            obj = objects[key]
-            if obj["type"] == "vote":
-                data.append(Vote(obj))
-            elif obj["type"] == "election":
-                data.append(Election(obj))
-            elif obj["type"] == "end_of_election":
-                data.append(EndOfElection(obj))
-            else:
-                self.write_log(f"X Unknown object type in block data: {obj['type']}\n")
-                return
-        # Create a new block object
-        block = Block(index, header_hash, prev_hash, merkle_root, timestamp, difficulty, nonce, parent, data=data)
+        returns:
+        - The new block if it was added, None otherwise
+        """
+        start = time.perf_counter()
+        with self.tracer.span("parse_block"):
+            block = self.parse_block(message, parent, node)
+        if block is None:
+            return
+        header_hash = block.hash
+        difficulty = block.difficulty
+        timestamp = block.timestamp
         # checking the merkle root
-        if block.merkle_root != block.get_merkle_root():
+        with self.tracer.span("merkle root"):
+            merkle_root = block.get_merkle_root()
+        if block.merkle_root != merkle_root:
             self.write_log(f"X Invalid merkle root: {block.merkle_root} != {block.get_merkle_root()}\n")
             self.send_error(node, "Invalid merkle root")
             return
@@ -747,25 +1796,122 @@ class Peer():
         if not self.check_timestamp(parent, timestamp):
             self.write_log(f"X Invalid timestamp: {timestamp}\n")
             self.send_error(node, "Invalid timestamp")
+            if timestamp > time.time() + MAX_FUTURE_TIME:
+                self.forget_block(message, block) # it will be fine once our clock catches up
             return
 
         # checking the signatures (also checks other app correctness things with the elections and votes)
-        if not self.check_sigs(block, parent):
+        try:
+            with self.tracer.span("check_sigs"):
+                sigs_ok = self.check_sigs(block, parent)
+        except ValueError as e:
+            # a side chain going back past bodies we pruned, not the sender's fault
+            self.write_log(f"X Cannot check block {block.index}: {e}\n")
+            self.forget_block(message, block)
+            return
+        if not sigs_ok:
             self.write_log("X Invalid signatures in block\n")
             self.send_error(node, "Invalid signatures")
             return
+        self.validation_time.observe(time.perf_counter() - start)
+
+        self.write_log(lambda: f"Block verified: Index: {block.index}, Difficulty: {block.difficulty}, Objects: {json.dumps([obj.jsonify() for obj in block.data])}\n")
+        with self.tracer.span("connect_block"):
+            self.connect_block(block, parent)
+        if self.block_store is not None:
+            with self.tracer.span("block store"):
+                self.block_store.put(header_hash, block.index, message)
+        with self.tracer.span("relay"):
+            self.relay_block(node, block, message)
+
+        # checking if this was the parent to any orphans, if so we can process those.
+        if connect_orphans:
+            self.connect_orphans(block)
+        return block
+
+    def parse_block(self, message, parent, node):
+        """
+        Turns a block message into a Block hanging off parent. Only checks that it parses and that the index follows on from the parent,
+        the rest is up to verify_block. Returns None if it is no good.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+
+        args:
+        - message: The block (header + json body)
+        - parent: The parent block
+        - node: The node that sent it (for errors)
+        """
+        # pull out index (first 4 bytes)
+        index = int.from_bytes(message[:4], byteorder='big') 
+        # Exract the rest of the block header fields
+        prev_hash = message[4:36]  # 32 bytes for previous hash
+        merkle_root = message[36:68]  # 32 bytes for merkle root
+        timestamp = int.from_bytes(message[68:76], byteorder='big')  # 8 bytes for timestamp
+        difficulty = int.from_bytes(message[76:80], byteorder='big') # 4 bytes for difficulty
+        nonce = int.from_bytes(message[80:84], byteorder='big')  # 4 bytes for nonce
+        block_header = message[:84]
+        header_hash = hashy(block_header)
 
 
+        data = self.parse_body(message)
+        if data is None:
+            return
+        # the index has to follow on from the parent, the main chain index relies on it
+        if index != (parent.index + 1 if parent is not None else 0):
+            self.write_log(f"X Invalid index: {index}\n")
+            self.send_error(node, "Invalid index")
+            return
+        # Create a new block object
+        return Block(index, header_hash, prev_hash, merkle_root, timestamp, difficulty, nonce, parent, data=data, sendable=bytes(message))
+
+    def parse_body(self, message):
+        """
+        Parses the objects out of a block message. Returns None if one of them is no good.
+        """
+        # Extract the votes and elections from the block data. It is a concatanation of json encoded forms of the votes and elections
+        block_data = message[84:]
+        json_data = block_data.decode('utf-8') 
+        if json_data == "":
+            json_data = "{}"
+        # Parse the JSON data to extract votes and elections
+        objects = json.loads(json_data) 
+        
+        # Parse each object in the block data
+        data = []
+        for key in objects:
+            thing = self.make_object(objects[key])
+            if thing is None:
+                return
+            data.append(thing)
+        return data
+
+    def connect_block(self, block, parent):
+        """
+        Adds a block that has passed verification to our chains, moving the tip and updating the mempool if it is now the best chain.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+
+        args:
+        - block: The block
+        - parent: Its parent
+        """
         # Remove the parent from self.chain_headers and replace with this node
-        self.write_log(f"Block verified: Index: {block.index}, Difficulty: {block.difficulty}, Objects: {json.dumps([obj.jsonify() for obj in block.data])}\n")
         if parent == self.biggest_chain:
-            self.biggest_chain = block
+            self.set_tip(block)
             self.remove_new(block) # simple check to update the new queues
             self.write_log(f"INF: Chain extended\n")
-        elif block.total_work > self.biggest_chain.total_work:
-            self.biggest_chain = block
+            self.maybe_snapshot()
+        elif block.total_work > self.biggest_chain.total_work and not self.forks_below_pruned(block):
+            removed = self.set_tip(block)
+            self.reorg_depth.observe(len(removed))
+            for old in removed:
+                # the objects in blocks we are leaving have to go back in the pool. Blocks loaded under a snapshot never had them added
+                for thing in old.data:
+                    if hashy(thing.jsonify()) not in self.all_things:
+                        self.all_things[hashy(thing.jsonify())] = (0, thing)
             self.recompute_new(block) # more through check, goea back throug the whole chain
             self.write_log(f"INF: Longest chain changed\n")
+            self.maybe_snapshot()
+        if self.prune_depth is not None:
+            self.prune_blocks()
         try:
             self.chain_headers.remove(parent)
         except ValueError:
@@ -773,27 +1919,248 @@ class Peer():
 
         
         self.chain_headers.append(block)
-        self.blocks[header_hash] = block
-        self.broadcast(node, BLOCK, message)
+        self.blocks[block.hash] = block
 
-        # checking if this was the parent to any orphans, if so we can process those.
-        if header_hash in self.orphan_pool:
-            for orphan in self.orphan_pool[header_hash]:
-                self.write_log(f"INF: Orphan block parent found: {orphan}\n")
-                self.verify_block(orphan, block, None)
-            del self.orphan_pool[header_hash]
-    def send_error(self, node, message):
+    def load_blocks(self):
+        """
+        Loads the chain back from the block store on startup. These blocks all passed verify_block before they were written,
+        so the signatures and proof of work are not checked again, we only make sure each one is the block its hash says it is.
+        If there is a snapshot, the blocks up to its tip are only loaded as headers (bodies are read from disk when needed)
+        and the chain state comes from the snapshot, only the blocks after it are replayed.
+        Whatever we are missing after that is fetched from the network by the normal header sync.
+        """
+        start = time.time()
+        loaded = 0
+        with self.data_lock:
+            snapshot = self.block_store.read_snapshot()
+            if snapshot is not None:
+                loaded = self.load_snapshot(*snapshot)
+            for header_hash, height, message in self.block_store.load(header_only=False):
+                if snapshot is not None and height <= snapshot[1]:
+                    continue
+                if hashy(message[:HEADER_SIZE]) != header_hash:
+                    self.write_log(f"X Block store entry does not match its hash, skipping: {header_hash}\n")
+                    continue
+                index = int.from_bytes(message[:4], byteorder='big')
+                parent = self.blocks.get(message[4:36])
+                if parent is None and index != 0:
+                    self.write_log(f"X Stored block {index} has no parent, skipping\n")
+                    continue
+                block = self.parse_block(message, parent, None)
+                if block is None:
+                    continue
+                self.connect_block(block, parent)
+                loaded += 1
+        self.write_log(f"INF: Loaded {loaded} blocks from disk in {time.time() - start:.2f} seconds\n")
+
+    def load_snapshot(self, tip, height, state):
+        """
+        Sets up the chain from a snapshot: every stored block up to its height is added with just its header, and the chain state,
+        open elections and tip come from the snapshot. Returns the number of blocks loaded.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        args:
+        - tip: The hash of the block the snapshot is for
+        - height: Its index
+        - state: The saved state (see write_snapshot)
+        """
+        loaded = 0
+        for header_hash, block_height, header in self.block_store.load(header_only=True):
+            if block_height > height:
+                break
+            if hashy(header) != header_hash:
+                self.write_log(f"X Block store entry does not match its hash, skipping: {header_hash}\n")
+                continue
+            parent = self.blocks.get(header[4:36])
+            if parent is None and block_height != 0:
+                continue
+            block = Block(block_height, header_hash, header[4:36], header[36:68], int.from_bytes(header[68:76], byteorder='big'),
+                          int.from_bytes(header[76:80], byteorder='big'), int.from_bytes(header[80:84], byteorder='big'), parent, data=None, loader=self.load_body)
+            try:
+                self.chain_headers.remove(parent)
+            except ValueError:
+                pass
+            self.chain_headers.append(block)
+            self.blocks[header_hash] = block
+            loaded += 1
+        # the main chain is just the tip and its ancestors, nothing to recount, the state is in the snapshot
+        chain = []
+        current = self.blocks.get(tip)
+        while current is not None:
+            chain.append(current)
+            current = current.previous_block
+        self.main_chain = chain[::-1]
+        self.header_chain = bytearray(b''.join(block.get_header() for block in self.main_chain))
+        self.biggest_chain = self.blocks.get(tip)
+        self.chain_state = ChainState.from_dict(state["chain"])
+        for election in state["open_elections"]:
+            election = Election(election)
+            self.open_elections[election.hashy] = election
+        self.write_log(f"INF: Loaded snapshot at height {height}\n")
+        return loaded
+
+    def load_body(self, header_hash):
+        """
+        Reads a block's objects back from the block store, for blocks whose body is not kept in memory.
+        """
+        message = self.block_store.get(header_hash) if self.block_store is not None else None
+        if message is None:
+            raise ValueError(f"Block {header_hash} is not in the block store")
+        return self.parse_body(message)
+
+    def maybe_snapshot(self):
+        """
+        Writes a snapshot every SNAPSHOT_INTERVAL blocks of the main chain.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        """
+        if self.block_store is not None and self.biggest_chain.index % SNAPSHOT_INTERVAL == 0 and self.biggest_chain.index > 0:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        """
+        Saves the chain state at the current tip, so a restart can start from here instead of replaying every block.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        """
+        if self.block_store is None or self.biggest_chain is None:
+            return
+        state = {
+            "chain": self.chain_state.to_dict(),
+            "open_elections": [election.get_json_dict() for election in self.open_elections.values()],
+        }
+        self.block_store.put(self.biggest_chain.hash, self.biggest_chain.index, self.biggest_chain.get_sendable()) # the tip has to be in the store for the snapshot to be used
+        self.block_store.write_snapshot(self.biggest_chain.hash, self.biggest_chain.index, state)
+        self.write_log(f"INF: Snapshot written at height {self.biggest_chain.index}\n")
+
+    def prune_blocks(self):
+        """
+        Prunes the main chain blocks that are now deeper than the prune depth, and the ones we held on to for elections that have since ended.
+        Each block is only looked at once as the chain grows, so this is O(1) per block plus the open elections.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        """
+        horizon = len(self.main_chain) - self.prune_depth
+        while self.pruned_height < horizon:
+            self.prune_block(self.main_chain[self.pruned_height], horizon)
+            self.pruned_height += 1
+        for election_hash in [h for h in self.pinned if self.chain_state.ended.get(h, horizon) < horizon]:
+            for block in self.pinned.pop(election_hash):
+                self.prune_block(block, horizon)
+
+    def prune_block(self, block, horizon):
+        """
+        Drops the body of a block past the prune depth, unless it has something in it for an election whose end is not that deep yet,
+        then it is pinned until it is. The objects go out of all_things too, they are buried too deep to ever come back to the mempool.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        args:
+        - block: The block
+        - horizon: The height the prune depth starts at
+        """
+        if block.pruned:
+            return
+        if not block.has_body():
+            block.prune() # loaded from a snapshot, the body was never in memory
+            return
+        open_elections = [h for h in set(block.elections) | set(block.votes) | set(block.election_ends) if self.chain_state.ended.get(h, horizon) >= horizon]
+        if open_elections:
+            self.pinned.setdefault(open_elections[0], []).append(block) # looked at again when that one ends
+            return
+        for thing in block.data:
+            self.all_things.pop(hashy(thing.jsonify()), None)
+        if self.block_store is not None:
+            block.loader = self.load_body
+        block.prune()
+
+    def forks_below_pruned(self, block):
+        """
+        If switching to the chain ending in block would need blocks we pruned without keeping them on disk. We cant undo those, so a pruned
+        node without a block store sticks with its chain when the fork is deeper than the prune depth.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        """
+        if self.prune_depth is None or self.block_store is not None:
+            return False
+        current = block
+        while current is not None and not self.on_main_chain(current):
+            current = current.previous_block
+        fork = 0 if current is None else current.index + 1
+        if fork < self.pruned_height:
+            self.write_log(f"X Chain at {block.index} forks off at {fork}, below what we pruned, not switching\n")
+            return True
+        return False
+
+    def connect_orphans(self, block):
+        """
+        Connects every orphan that was waiting on this block, then their orphans and so on.
+        Uses a stack instead of recursing, during a sync a long run of blocks can show up out of order.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        """
+        stack = [block]
+        while stack:
+            parent = stack.pop()
+            for orphan in self.orphan_pool.pop(parent.hash, []):
+                self.orphan_hashes.discard(hashy(orphan[:84]))
+                self.write_log(lambda: f"INF: Orphan block parent found: {orphan[:84]}\n", LOG_DEBUG)
+                child = self.verify_block(orphan, parent, None, False)
+                if child is not None:
+                    stack.append(child)
+
+    def set_tip(self, block):
+        """
+        Makes block the tip of our chain, and updates the main chain index and the chain state to match.
+        Extending the chain is O(1), a reorg is O(depth of the reorg), as we only walk back to where the chains meet.
+        Returns the blocks that left the main chain, newest first.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        args:
+        - block: The new tip
+        """
+        new_blocks = []
+        current = block
+        while current is not None and not self.on_main_chain(current):
+            new_blocks.append(current)
+            current = current.previous_block
+        # current is now where the two chains meet (or None if they share nothing)
+        fork = 0 if current is None else current.index + 1
+        removed = self.main_chain[fork:][::-1]
+        self.pruned_height = min(self.pruned_height, fork)
+        for old in removed:
+            self.chain_state.disconnect(old)
+            if self.explorer is not None:
+                self.explorer.disconnect(old)
+        del self.main_chain[fork:]
+        del self.header_chain[fork * HEADER_SIZE:]
+        for new in reversed(new_blocks):
+            self.main_chain.append(new)
+            self.header_chain += new.get_header()
+            self.chain_state.connect(new)
+            if self.explorer is not None:
+                self.explorer.connect(new)
+        if self.explorer is not None:
+            self.explorer.commit()
+        self.biggest_chain = block
+        return removed
+
+    def on_main_chain(self, block):
+        """
+        Checks if the block is on our biggest chain.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        """
+        return block.index < len(self.main_chain) and self.main_chain[block.index] is block
+
+    def send_error(self, node, message, penalize = True):
         """
         Sends an error message to the node.
         args:
         - node: The node to send the message to
         - message: The message to send
+        - penalize: If it counts against the node. False when the problem is on our end (a block we pruned)
         """
         if node is None:
             return
         self.send_message(ERROR_RESPONSE.to_bytes(2, byteorder='big') + message.encode('utf-8'), node)
-        node.good = False
+        if not penalize:
+            return
+        node.good = False # from now on its messages cost it more, see allow_message
+        node.errors += 1
         self.write_log(f"Error sent to node {node}: {message}\n")
+        if node.errors >= MAX_NODE_ERRORS:
+            self.disconnect_node(node, f"{node.errors} errors")
 
     def request_block(self, hashy, node):
         """
@@ -805,9 +2172,97 @@ class Peer():
         """
         # Send a request to the node for the block with the given hash
         request_message = GET_BLOCK.to_bytes(2, byteorder='big') + hashy
+        if node is not None:
+            node.blocks_asked.add(hashy) # so the answer is not rate limited, see is_answer
         self.send_message(request_message, node) 
         self.write_log(f"Requesting block {hashy} from node {node}\n")
 
+    def request_blocks(self, hashes, node):
+        """
+        Requests a bunch of blocks. They are handed to the downloader, which spreads them over every node that can do GET_BLOCKS.
+        If nobody can, we fall back to one GET_BLOCK per hash to the node that told us about them.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+
+        args:
+        - hashes: The hashes of the blocks to request, oldest first so the parents get here before the children
+        - node: The node that told us about the blocks
+        """
+        if not self.download_nodes():
+            for hashy in hashes:
+                self.request_block(hashy, node)
+            return
+        self.downloader.add(hashes)
+        self.schedule_downloads()
+
+    def download_nodes(self):
+        """
+        The nodes we can download blocks from. Pruned nodes only if there is nobody else, they dont have the old blocks.
+        """
+        nodes = [node for node in list(self.nodes.values()) if node.features & FEATURE_GET_BLOCKS]
+        full = [node for node in nodes if not node.features & FEATURE_PRUNED]
+        return full if full else nodes
+
+    def schedule_downloads(self):
+        """
+        Sends GET_BLOCKS requests for whatever the downloader hands out.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        """
+        requests = self.downloader.schedule(self.download_nodes(), time.time())
+        self.arm_download_timer()
+        for node, batch in requests.items():
+            for i in range(0, len(batch), MAX_BLOCKS_PER_REQUEST):
+                chunk = batch[i:i + MAX_BLOCKS_PER_REQUEST]
+                try:
+                    self.send_message(GET_BLOCKS.to_bytes(2, byteorder='big') + GET_BLOCKS_LIST.to_bytes(1, byteorder='big') + b''.join(chunk), node)
+                except OSError as e:
+                    self.write_log(f"X Failed to request blocks from {node}: {e}\n") # the downloader will time these out and move them
+                    break
+            self.write_log(f"Requesting {len(batch)} blocks from node {node}\n")
+
+    def block_received(self, hashy, node, size):
+        """
+        Tells the downloader a block is here, updates the throughput of the node we asked for it,
+        and hands out more requests once that node has half its window free.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        args:
+        - hashy: The hash of the block
+        - node: The node that sent it
+        - size: The size of the block in bytes
+        """
+        requested_from, requested = self.downloader.received(hashy, size)
+        if requested_from is None:
+            return
+        # timing from the request, or from the last block it sent if it was still working through earlier ones
+        now = time.time()
+        requested_from.update_throughput(size, now - max(requested, requested_from.last_delivery))
+        requested_from.last_delivery = now
+        if len(requested_from.blocks_in_flight) <= BLOCK_WINDOW // 2:
+            self.schedule_downloads()
+
+    def arm_download_timer(self):
+        """
+        Makes sure there is a timer for when the oldest block request times out. Nothing runs while there are no requests out.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        """
+        if self.download_timer is not None or not self.downloader.in_flight:
+            return
+        oldest = min(requested for _, requested, _ in self.downloader.in_flight.values())
+        self.download_timer = self.scheduler.schedule(max(0, oldest + BLOCK_TIMEOUT - time.time()), self.check_downloads)
+
+    def check_downloads(self):
+        """
+        Runs on the scheduler. Takes back block requests that timed out (or whose node went away), and gives them to someone else.
+        """
+        with self.data_lock:
+            if self.download_timer is not None:
+                self.download_timer.cancel()
+                self.download_timer = None
+            expired = self.downloader.expire(self.download_nodes(), time.time())
+            if expired:
+                self.write_log(f"INF: {len(expired)} block requests timed out, rescheduling\n")
+                self.schedule_downloads()
+            self.arm_download_timer()
+
     def remove_new(self, block):
         """ 
         remove the transactions in the block from the new_elections and new_votes queues. Use if the new block is just an extension of the current chain
@@ -826,7 +2281,7 @@ class Peer():
             else:
                 self.all_things[hashy(election.jsonify())] = (0, election)
             if hashy(election.jsonify()) in self.new_elections:
-                del self.new_elections[hashy(election.jsonify())]
+                self.pool_remove(self.new_elections, hashy(election.jsonify()))
         for key in block.votes:
             votes = block.votes[key]
             for vote in votes:
@@ -836,7 +2291,7 @@ class Peer():
                 else:
                     self.all_things[hashy(vote.jsonify())] = (0, vote)
                 if hashy(vote.jsonify()) in self.new_votes:
-                    del self.new_votes[hashy(vote.jsonify())]
+                    self.pool_remove(self.new_votes, hashy(vote.jsonify()))
         for key in block.election_ends:
             end = block.election_ends[key]
             end.new = False
@@ -845,7 +2300,7 @@ class Peer():
             else:
                 self.all_things[hashy(end.jsonify())] = (0, end)
             if hashy(end.jsonify()) in self.new_ended_elections:
-                del self.new_ended_elections[hashy(end.jsonify())]
+                self.pool_remove(self.new_ended_elections, hashy(end.jsonify()))
     
     def recompute_new(self, block):
         """
@@ -860,6 +2315,10 @@ class Peer():
         # going backwards, starting from block, and makring all the things in the block as not new
         current_block = block
         while current_block is not None:
+            # bodies that are not in memory (pruned, or loaded from a snapshot) have nothing in all_things to mark
+            if not current_block.has_body():
+                current_block = current_block.previous_block
+                continue
             # for every election in the block, we need to mark it as not new
             for key in current_block.elections:
                 election = current_block.elections[key]
@@ -873,7 +2332,7 @@ class Peer():
             for key in current_block.votes:
                 votes = current_block.votes[key]
                 for vote in votes:
-                    vote.new = True
+                    vote.new = False
                     if hashy(vote.jsonify()) in self.all_things:
                         self.all_things[hashy(vote.jsonify())][1].new = False
                     else:
@@ -905,7 +2364,8 @@ class Peer():
                         self.open_elections[thing.hashy] = thing
             elif isinstance(thing, EndOfElection):
                 if thing.new:
-                    if not self.all_things[thing.election_hash][1].new: # we dont want to add the end if the start was never added. If it is a thing we need to do, we can do it during processing.
+                    start = self.all_things.get(thing.election_hash)
+                    if start is None or not start[1].new: # we dont want to add the end if the start was never added. If it is a thing we need to do, we can do it during processing.
                         self.new_ended_elections[hashy(thing.jsonify())] = thing
             elif isinstance(thing, Vote):
                 if thing.new:
@@ -913,6 +2373,90 @@ class Peer():
             else:
                 self.write_log(f"X Invalid object in recompute_new: {thing}\n")
                 continue
+        self.index_mempool()
+        if self.mempool_journal is not None:
+            self.mempool_journal.replace((self.new_elections, self.new_votes, self.new_ended_elections)) # elections first, the votes need them when loading
+
+    def pool_add(self, pool, key, thing):
+        """
+        Puts an object in one of the mempool dicts (new_votes, new_elections, new_ended_elections), and in the journal on disk.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        """
+        pool[key] = thing
+        self.short_ids[key[:SHORT_ID_SIZE]] = (key, thing)
+        if self.mempool_journal is not None:
+            self.mempool_journal.add(key, thing)
+
+    def pool_remove(self, pool, key):
+        """
+        Takes an object out of one of the mempool dicts, and out of the journal on disk.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        """
+        del pool[key]
+        if self.short_ids.get(key[:SHORT_ID_SIZE], (None,))[0] == key: # another object with the same short id may have taken the slot
+            del self.short_ids[key[:SHORT_ID_SIZE]]
+        if self.mempool_journal is not None:
+            self.mempool_journal.remove(key)
+
+    def index_mempool(self):
+        """
+        Rebuilds the short id index from the mempool dicts, after they were filled in without pool_add.
+        The mempool dicts are keyed by the object hash, which is the merkle leaf, so the short id is just the front of the key.
+        THE DATA LOCK MUST BE HELD WHEN CALLING THIS FUNCTION
+        """
+        self.short_ids = {}
+        for pool in (self.new_votes, self.new_elections, self.new_ended_elections):
+            for key, thing in pool.items():
+                self.short_ids[key[:SHORT_ID_SIZE]] = (key, thing)
+
+    def load_mempool(self):
+        """
+        Puts the mempool from the journal back, on startup after the chain is loaded. The signatures were checked before these went in
+        the journal, so they are only checked against the chain: anything that made it into a block, is for an election that is over
+        or not known, or uses a key that has voted since, is dropped. The journal is then rewritten with just what we kept.
+        """
+        now = time.time()
+        kept = 0
+        with self.data_lock:
+            objects = self.mempool_journal.load()
+            for obj in objects:
+                thing = self.make_object(obj)
+                if thing is None:
+                    continue
+                key = hashy(thing.jsonify())
+                if isinstance(thing, Election):
+                    if self.chain_state.get_election(thing.hashy) is not None or thing.end_time < now:
+                        continue
+                    self.open_elections[thing.hashy] = thing
+                    self.new_elections[key] = thing
+                elif isinstance(thing, EndOfElection):
+                    if self.chain_state.get_election(thing.election_hash) is None or thing.election_hash in self.chain_state.ended:
+                        continue
+                    self.new_ended_elections[key] = thing
+                else:
+                    election = self.open_elections.get(thing.election_hash)
+                    if election is None and self.chain_state.get_election(thing.election_hash) is not None:
+                        election = Election(self.chain_state.get_election(thing.election_hash).get_json_dict()) # our own copy, its used keys are the mempool's
+                    if election is None or election.end_time < now or thing.choice not in election.choices or thing.public_key not in election.public_keys:
+                        continue
+                    if thing.public_key in self.chain_state.used_keys.get(thing.election_hash, {}) or thing.public_key in election.used_keys:
+                        continue
+                    election.used_keys[thing.public_key] = thing.choice
+                    self.open_elections[thing.election_hash] = election
+                    self.new_votes[key] = thing
+                self.all_things[key] = (1, thing)
+                kept += 1
+            self.index_mempool()
+            self.mempool_journal.replace((self.new_elections, self.new_votes, self.new_ended_elections)) # elections first, the votes need them when loading
+        self.write_log(f"INF: Loaded {kept} of {len(objects)} mempool objects from disk\n")
+
+    def compact_mempool(self):
+        """
+        Runs on the scheduler, compacts the mempool journal once it is mostly deleted entries.
+        """
+        dropped = self.mempool_journal.compact()
+        if dropped:
+            self.write_log(f"INF: Mempool journal compacted, {dropped} lines dropped\n")
     
     def move_to_ended(self):
         """
@@ -927,36 +2471,55 @@ class Peer():
                 if election.end_time < time.time():
                     keys_to_remove.append(key) # we will remove this later
                     self.write_log(f"X Election ended: {election.name}\n")
-                    results = {} # track results so we can put them on the blockchain
-                    thing = self.biggest_chain # we will loop backwards from here
-                    already_done = False # if we have already added this election end to the chain
-                    found_election = None # confirming the election actually exists
-                    while thing is not None:
-                        self.write_log(thing.votes)
-                        if election.hashy in thing.election_ends:
-                            already_done = True
-                            break
-
-                        if election.hashy in thing.votes:
-                            for vote in thing.votes[election.hashy]:
-                                if vote.choice not in results:
-                                    results[vote.choice] = 0
-                                results[vote.choice] += 1
-                        if election.hashy in thing.elections:
-                            found_election = thing.elections[election.hashy]
-                            break    
-                        thing = thing.previous_block
+                    # the chain state has the tally for the main chain, so there is no walking back through the blocks
+                    already_done = election.hashy in self.chain_state.ended # if we have already added this election end to the chain
+                    found_election = self.chain_state.get_election(election.hashy) # confirming the election actually exists
+                    results = dict(self.chain_state.tallies.get(election.hashy, {})) # track results so we can put them on the blockchain
                     if found_election is None: #never on the chain
                         self.write_log(f"X Election not found: {election.name}, likely never added to chain\n")
                         continue
                     if not already_done: # we have not added this election end to the chain yet
                         self.write_log(f"INF: election {election.hashy} results: " + str(results) + "\n")
                         election_end = EndOfElection({"election_hash": base64.b64encode(election.hashy).decode('utf-8'), "results": results})
-                        self.new_ended_elections[hashy(election_end.jsonify())] = election_end 
+                        self.pool_add(self.new_ended_elections, hashy(election_end.jsonify()), election_end)
             for key in keys_to_remove:
                 del self.open_elections[key]
 
-    def broadcast(self, sender, typey, message):
+    def relay_block(self, sender, block, message):
+        """
+        Relays a block we just added. Nodes that can do compact blocks get the header and short ids of the objects,
+        as they will have most of them from gossip already. Everyone else gets the full block.
+
+        args:
+        - sender: The node that sent us the block
+        - block: The block
+        - message: The full block message
+        """
+        self.broadcast(sender, CMPCT_BLOCK, self.compact_block(block), lambda node: node.features & FEATURE_COMPACT_BLOCKS)
+        self.broadcast(sender, BLOCK, message, lambda node: not node.features & FEATURE_COMPACT_BLOCKS)
+
+    def compact_block(self, block):
+        """
+        The CMPCT_BLOCK payload for a block: the header, the number of objects and the short id of each one.
+        """
+        compact = [block.get_header(), len(block.data).to_bytes(2, byteorder='big')]
+        for leaf in block.leaves[:len(block.data)]:
+            compact.append(leaf[:SHORT_ID_SIZE])
+        return b''.join(compact)
+
+    def forget_block(self, message, block = None):
+        """
+        Takes a block we turned away for now (no parent yet, a timestamp ahead of our clock, a side chain we cannot check)
+        out of the seen filter, so a later copy of it gets looked at. Blocks that are just wrong stay in it.
+        args:
+        - message: The block message (header + json body)
+        - block: The parsed block, if we got that far, to forget the compact block it would have come as too
+        """
+        self.seen_filter.forget(BLOCK.to_bytes(2, byteorder='big') + message)
+        if block is not None:
+            self.seen_filter.forget(CMPCT_BLOCK.to_bytes(2, byteorder='big') + self.compact_block(block))
+
+    def broadcast(self, sender, typey, message, wants = None):
         """
         Broadcasts a message to all nodes.
         This results in n^2 messages being sent, where n is the number of nodes for updates.
@@ -966,23 +2529,33 @@ class Peer():
         - sender: The node that sent the message
         - typey: The type of message to send
         - message: The message to send
+        - wants: Optional check on the node, only nodes it returns true for get the message
         """
          
         message = typey.to_bytes(2, byteorder='big') + message
-        message = len(message).to_bytes(2, byteorder='big') + message
-        with self.send_lock:
-            del_list = []
-            for addr, node in self.nodes.items():
+        if typey in SEEN_FILTER_TYPES:
+            self.seen_filter.check_and_add(message) # so it is dropped when it comes back around to us
+        trace_id = self.tracer.current() # if we are in a sampled trace, nodes that understand TRACED frames get its id with the message
+        frames = {} # (traced, compressed) -> the frame to send, each one only made once, and only if some node wants it
+        with self.tracer.span("broadcast"):
+            for addr, node in list(self.nodes.items()):
                 # Check if the node is not the sender
-                if node != sender:
+                if node != sender and (wants is None or wants(node)):
                     try:
                         # print("Sending message to node:", node.address)
-                        node.connection.send(message)
+                        kind = (trace_id is not None and node.features & FEATURE_TRACE != 0,
+                                node.features & FEATURE_COMPRESSION != 0 and len(message) >= COMPRESSION_THRESHOLD)
+                        frame = frames.get(kind)
+                        if frame is None:
+                            frame = TRACED.to_bytes(2, byteorder='big') + trace_id + message if kind[0] else message
+                            if kind[1]:
+                                frame = self.compress_message(frame)
+                            frame = len(frame).to_bytes(2, byteorder='big') + frame
+                            frames[kind] = frame
+                        with self.tracer.span("send"):
+                            self.send_frame(frame, node)
                     except Exception as e:
-                        self.write_log(f"X Failed to send message to {node}: {e}, removing\n")
-                        del_list.append(addr)
-            for addr in del_list:
-                self.remove_node(addr)
+                        self.disconnect_node(node, f"failed to send message: {e}")
 
 
     def verify_node_connection(self, initial_message):
@@ -1073,19 +2646,21 @@ class Peer():
             return False
         
         # Check if the timestamp is more than 2 minutes in the future
-        if timestamp > time.time() + 120:
+        if timestamp > time.time() + MAX_FUTURE_TIME:
             return False
         return True
     
     def check_sigs(self, block, parent):
         """
         Checks the signatures in the block, as well as ensuring that the vote is a valid one for this chain.
-        Runs in O(n) time, where n is the number of blocks on the chain, as it has to go back to try to find the election.
+        For a block on our tip the elections and tallies come from the chain state. For a block on a side chain it runs in O(n) time,
+        where n is the number of blocks on the chain, as it has to go back to try to find the election.
 
         args:
         - block: The block to check
         - parent: The parent block of this block
         """
+        on_tip = parent is not None and parent is self.biggest_chain
         try:
             
             for election_hash in block.votes:
@@ -1094,6 +2669,9 @@ class Peer():
                     # if its in this block, thats cool
                     if vote.election_hash in block.elections:
                         election = block.elections[vote.election_hash]
+                    # on our tip, the chain state has every election
+                    elif on_tip:
+                        election = self.chain_state.get_election(election_hash)
                     # if not, we have to go looking for it
                     else:
                         this = parent
@@ -1117,6 +2695,10 @@ class Peer():
                 this = parent
                 totals = {}
                 election = None
+                if on_tip:
+                    election = self.chain_state.get_election(end.election_hash)
+                    totals = dict(self.chain_state.tallies.get(end.election_hash, {}))
+                    this = None # no need to walk
                 # check to make sure the results said here accuratly reflect the votes in the block and on the rest of the chain.
                 while this is not None:
                     if end.election_hash in this.votes:
@@ -1180,14 +2762,22 @@ class Peer():
         votes = []
         end = {}
         while current_block is not None:
-            if election_hash in current_block.election_ends:
-                endy = current_block.election_ends[election_hash]
+            if not current_block.has_data():
+                # pruned with no copy on disk. Only blocks whose elections had all ended get pruned, so an open one is not in it
+                if election_hash in self.chain_state.ended:
+                    self.send_error(node, f"Election pruned: {election_hash}", False)
+                    return None
+                current_block = current_block.previous_block
+                continue
+            _, _, block_votes, block_elections, block_ends = current_block.get_body() # one read, for bodies that are only on disk
+            if election_hash in block_ends:
+                endy = block_ends[election_hash]
                 end["election_end"] = endy.get_json_dict()
                 end["block"] = base64.b64encode(current_block.hash).decode('utf-8')
                 end["proof"] = current_block.get_merkle_proof(hashy(endy.jsonify()))
 
-            if election_hash in current_block.votes:
-                votes_block = current_block.votes[election_hash]
+            if election_hash in block_votes:
+                votes_block = block_votes[election_hash]
                 for vote in votes_block:
                     vote_inst = {}
                     vote_inst["vote"] = vote.get_json_dict()
@@ -1195,8 +2785,8 @@ class Peer():
                     vote_inst["proof"] = current_block.get_merkle_proof(hashy(vote.jsonify()))
                     votes.append(vote_inst)
             
-            if election_hash in current_block.elections:
-                election = current_block.elections[election_hash]
+            if election_hash in block_elections:
+                election = block_elections[election_hash]
                 start["election"] = election.get_json_dict()
                 start["block"] = base64.b64encode(current_block.hash).decode('utf-8')
                 start["proof"] = current_block.get_merkle_proof(election_hash)
@@ -1213,30 +2803,39 @@ class Peer():
         self.send_message(ELECTION_RES.to_bytes(2, byteorder='big') + election_hash + json.dumps(election_dict).encode('utf-8'), node)
         return election_dict
     
-    def ping_loop(self):
+    def check_liveness(self, node):
         """
-        Simple periodic ping to all nodes
+        Runs on the scheduler for every node. A node we have heard from in the last KEEPALIVE_INTERVAL is left alone and checked again
+        once it has been quiet that long. A quiet one gets pinged, and after MAX_MISSED_PINGS pings with no answer it is dropped.
+        args:
+        - node: The node to check
         """
-        while True:
-            time.sleep(60)  # Ping once per minute
-            
-            with self.node_list_lock:
-                for addr, node in list(self.nodes.items()):
-                    try:
-                        # Send ping
-                        ping_message = PING.to_bytes(2, byteorder='big')
-                        self.send_message(ping_message, node)
-
-                        # Increment lastSeen counter (will be reset by pong)
-                        node.lastSeen += 1
-                        
-                        # Remove node if no response for too long
-                        if node.lastSeen > 3:  # No response for 3 ping cycles
-                            self.write_log(f"Node {addr} unresponsive, removing\n")
-                            self.remove_node(addr)
-                            
-                    except Exception as e:
-                        # Remove failed nodes
-                        self.write_log(f"Ping failed for {addr}: {e}\n")
-                        self.remove_node(addr)
-            
\ No newline at end of file
+        if node.closed or self.nodes.get(node.address) is not node:
+            return
+        idle = time.monotonic() - node.last_heard
+        if idle < KEEPALIVE_INTERVAL:
+            node.liveness_timer = self.scheduler.schedule(KEEPALIVE_INTERVAL - idle, self.check_liveness, node)
+            return
+        # Increment lastSeen counter (will be reset by pong)
+        node.lastSeen += 1
+        if node.lastSeen > MAX_MISSED_PINGS:
+            self.disconnect_node(node, "unresponsive")
+            return
+        try:
+            self.send_ping(node, False) # if another thread is still sending to it the ping is skipped, the scheduler does not wait on a backed up node
+        except OSError as e:
+            self.disconnect_node(node, f"ping failed: {e}")
+            return
+        node.liveness_timer = self.scheduler.schedule(KEEPALIVE_INTERVAL, self.check_liveness, node)
+
+    def log_stats(self):
+        """
+        Runs on the scheduler every STATS_INTERVAL. Writes the stats to the log, and asks the tracker what changed in the network.
+        """
+        if self.compression_stats:
+            self.write_log(f"INF: Compression stats: {self.compression_report()}\n")
+        if self.seen_stats:
+            self.write_log(f"INF: Seen filter stats: {self.seen_filter_report()}\n")
+        if self.nodes:
+            self.write_log(f"INF: Node stats: {self.peer_stats_report()}\n")
+        self.poll_tracker()
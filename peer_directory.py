@@ -0,0 +1,77 @@
+from utils import *
+from collections import deque
+import itertools
+import random
+
+class PeerDirectory:
+    """
+    The addresses of the nodes that have registered with us (connected and sent an INIT), for handing out to new nodes.
+    Addresses are kept in a list with an index map, so adding, removing and taking a random sample never walk the whole set.
+    Every join and leave is also numbered and kept in a bounded log, so nodes can ask for just what changed since they last asked.
+    Not thread safe on its own, the peer calls everything with its node list lock held.
+    """
+    def __init__(self, log_size = PEER_LOG_SIZE):
+        """
+        args:
+        - log_size: How many join/leave events we keep for nodes catching up
+        """
+        self.addresses = [] # registered addresses, in no order
+        self.positions = {} # address -> index in self.addresses
+        self.events = deque(maxlen=log_size) # (sequence number, joined, address), oldest first
+        self.seq = 0 # sequence number of the latest event
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def add(self, address):
+        """
+        Registers an address. Returns False if we already had it.
+        """
+        if address in self.positions:
+            return False
+        self.positions[address] = len(self.addresses)
+        self.addresses.append(address)
+        self.seq += 1
+        self.events.append((self.seq, True, address))
+        return True
+
+    def remove(self, address):
+        """
+        Forgets an address, by moving the last one into its spot. Returns False if we did not have it.
+        """
+        position = self.positions.pop(address, None)
+        if position is None:
+            return False
+        last = self.addresses.pop()
+        if last != address:
+            self.addresses[position] = last
+            self.positions[last] = position
+        self.seq += 1
+        self.events.append((self.seq, False, address))
+        return True
+
+    def sample(self, count, exclude = None):
+        """
+        Returns up to count random addresses.
+        args:
+        - count: The most addresses to return
+        - exclude: An address to leave out (the node asking)
+        """
+        picked = random.sample(self.addresses, min(count + 1, len(self.addresses)))
+        return [address for address in picked if address != exclude][:count]
+
+    def changes_since(self, seq, limit = MAX_PEER_DELTA):
+        """
+        Returns the join and leave events after seq, as (joined, address) oldest first, and the sequence number they bring the caller up to.
+        Returns None if seq is older than our log, the caller has to start over from a fresh sample.
+        args:
+        - seq: The last sequence number the caller has seen
+        - limit: The most events to return, the caller asks again for the rest
+        """
+        if seq == self.seq:
+            return [], seq
+        if seq > self.seq or not self.events or seq < self.events[0][0] - 1:
+            return None # from before we restarted, or too far behind
+        start = seq - self.events[0][0] + 1 # events are numbered one after another, so we can index straight into the log
+        events = list(itertools.islice(self.events, start, start + limit))
+        return [(joined, address) for _, joined, address in events], events[-1][0]
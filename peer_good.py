@@ -7,10 +7,11 @@ def main():
     parser.add_argument('--tracker-ip', type=str, required=False, help='Tracker IP address')
     parser.add_argument('name', type=str, help='Name of the peer')
     parser.add_argument('--tracker-port', type=int, required=False, help='Tracker port number')
+    parser.add_argument('--admin-port', type=int, required=False, help='Port for the local admin socket (profiling, trace dumps), see admin.py')
     args = parser.parse_args()
 
     print(f"Starting peer '{args.name}' on port {args.port}, connecting to tracker at {args.tracker_ip}:{args.tracker_port}")
-    peer = Peer(args.name, port=args.port, tracker_ip=args.tracker_ip, tracker_port=args.tracker_port)
+    peer = Peer(args.name, port=args.port, tracker_ip=args.tracker_ip, tracker_port=args.tracker_port, admin_port=args.admin_port)
     time.sleep(2)  # Give some time for the peer to initialize
     peer.mine()
 
@@ -1,12 +1,85 @@
 from peer import Peer
 from utils import *
-from block import Block
+from header_store import Header
 from election import Election
 from vote import Vote
 from end_of_election import EndOfElection
+from concurrent.futures import ThreadPoolExecutor
 import json
 import argparse
-import random
+
+class ElectionRequest:
+    """
+    A request_election call waiting on ELECTION_RES answers. handle_election_res hands it each answer as it comes in, each one is
+    verified on the light node's worker pool, and the caller is woken as soon as quorum of them agree on a finished election
+    (or every answer has been checked, or the time is up), instead of polling.
+    """
+    def __init__(self, nodes, quorum):
+        """
+        args:
+        - nodes: The nodes that were asked, only their answers count, and only the first one from each
+        - quorum: Fully proven results (with the end of the election) that have to agree before we stop waiting
+        """
+        self.waiting = set(nodes) # nodes we have not had an answer from yet
+        self.quorum = quorum
+        self.answers = 0 # answers we have had
+        self.unchecked = 0 # answers not verified yet
+        self.checking = [] # futures of the answers being verified, for cancelling
+        self.verified = [] # the elections the answers checked out to, in the order they were done
+        self.agreeing = {} # (winner, votes) of a finished election -> how many answers had it
+        self.answer = None # the election quorum answers agreed on
+        self.done = False # we have what we need (or gave up), answers still being checked can stop
+        self.ready = threading.Condition() # lock for the above, notified on every answer checked
+
+    def add(self, node):
+        """
+        Counts an answer from node. Returns False if it was not one we were waiting on (or we are already done).
+        """
+        with self.ready:
+            if self.done or node not in self.waiting:
+                return False
+            self.waiting.discard(node)
+            self.answers += 1
+            self.unchecked += 1
+            return True
+
+    def lost(self, node):
+        """
+        Stops waiting on a node we could not ask (the send failed and it was dropped).
+        """
+        with self.ready:
+            self.waiting.discard(node)
+            self.ready.notify_all()
+
+    def checked(self, election):
+        """
+        Hands the request an answer once it is verified.
+        args:
+        - election: The election it proved, None if it did not check out
+        """
+        with self.ready:
+            self.unchecked -= 1
+            if election is not None:
+                self.verified.append(election)
+                if election.finished:
+                    key = (election.winner, tuple(sorted(election.used_keys.items())))
+                    self.agreeing[key] = self.agreeing.get(key, 0) + 1
+                    if self.agreeing[key] >= self.quorum and self.answer is None:
+                        self.answer = election
+            self.ready.notify_all()
+
+    def wait(self, timeout):
+        """
+        Waits until quorum answers agree, every node has answered and had its answer checked, or timeout seconds have passed.
+        Then stops whatever is still waiting to be checked. Returns the agreed election, or None.
+        """
+        with self.ready:
+            self.ready.wait_for(lambda: self.answer is not None or (not self.waiting and self.unchecked == 0), timeout)
+            self.done = True
+            for future in self.checking:
+                future.cancel() # only stops the ones that have not started, the rest see done and give up
+            return self.answer
+
 class LightNode(Peer):
     """
     Lightweight node that extends Peer class but doesn't maintain the full blockchain.
@@ -17,11 +90,16 @@ class LightNode(Peer):
         # Initialize with parent class but modify behavior
         super().__init__(name, port, tracker_ip, tracker_port)
         self.write_log("Initializing as lightweight node")
-        self.election_reses = {}
-        self.election_reses_lock = threading.Lock()
+        self.election_requests = {} # election hash -> the ElectionRequests waiting on answers for it
+        self.election_requests_lock = threading.Lock()
+        self.verify_pool = ThreadPoolExecutor(ELECTION_VERIFY_WORKERS, thread_name_prefix=f"{name}-verify") # checks election results as they come in
 
         
         
+    def supported_features(self):
+        """We dont have any block data to serve, so no GET_BLOCKS"""
+        return FEATURE_COMPRESSION | FEATURE_HEADERS | FEATURE_VOTE_BATCH
+
     def mine(self):
         """Override mining to do nothing in lightweight node"""
         self.write_log("Mining disabled in lightweight node")
@@ -38,6 +116,13 @@ class LightNode(Peer):
         self.write_log("Received block request, but this is a lightweight node. Ignoring.")
         # Send an error message back to the sender
         self.send_error("This is a lightweight node, no data available", node)
+
+    def get_blocks(self, message, node):
+        """
+        Same as get_block, we dont carry the data.
+        """
+        self.write_log("Received blocks request, but this is a lightweight node. Ignoring.")
+        self.send_error(node, "This is a lightweight node, no data available")
     
     def receive_longest_chain(self, message, node):
         """
@@ -46,7 +131,7 @@ class LightNode(Peer):
         This should keep the p2p network running, but does not require us to do any work (since this node wont mine, it does not matter)
         """
         with self.data_lock:
-            for i in range(len(message) - 84, -1, -84):
+            for i in range(0, len(message) - 83, 84): # oldest first
                 # Extract the block header
                 block_header = message[i:i + 84]
                 index = int.from_bytes(block_header[:4], byteorder='big')
@@ -59,6 +144,30 @@ class LightNode(Peer):
                     parent = self.blocks[prev_hash]
                 
                 self.check_header(block_header, parent)
+        self.continue_longest_chain(message, node)
+
+    def receive_headers(self, message, node):
+        """
+        Handles headers messages. We only keep headers, so every one is checked and added, no blocks are requested.
+        If the batch was full we ask for the next one.
+        """
+        if len(message) % HEADER_SIZE != 0:
+            self.write_log(f"X Malformed headers message, length {len(message)}")
+            return
+        with self.data_lock:
+            for i in range(0, len(message), HEADER_SIZE):
+                block_header = message[i:i + HEADER_SIZE]
+                index = int.from_bytes(block_header[:4], byteorder='big')
+                prev_hash = block_header[4:36]
+                parent = None
+                if prev_hash not in self.blocks and index != 0:
+                    self.write_log(f"X Block {index} not in chain, exiting")
+                    return
+                if index != 0:
+                    parent = self.blocks[prev_hash]
+                self.check_header(block_header, parent)
+            locator = self.get_locator()
+        self.headers_done(node, len(message) == MAX_HEADERS_PER_MESSAGE * HEADER_SIZE, hashy(message[-HEADER_SIZE:]) if message else None, locator)
 
     def handle_vote(self, message, node):
         """
@@ -66,9 +175,18 @@ class LightNode(Peer):
         The light version is just going to mindlessly pass them on without doing any checks.
         This should keep the p2p network running, but does not require us to do any work (since this node wont mine, it does not matter)
         """
-        self.broadcast(node, VOTE, message)
+        self.queue_vote_relay(message, node)
         self.write_log("INF: Vote received, broadcasting") 
 
+    def handle_vote_batch(self, message, node):
+        """
+        Handles incoming vote batches. Same as handle_vote, every new vote is passed on without checks.
+        """
+        for raw in self.split_vote_batch(message):
+            if not self.check_seen(VOTE, VOTE.to_bytes(2, byteorder='big') + raw):
+                self.queue_vote_relay(raw, node)
+        self.write_log("INF: Vote batch received, broadcasting")
+
     def handle_election(self, message, node):
         """
         Handles incoming election messages.
@@ -127,6 +245,9 @@ class LightNode(Peer):
         if index != 0 and parent is None:
             self.write_log("X Parent not in chain")
             return False
+        if index != (parent.index + 1 if parent is not None else 0):
+            self.write_log("X Invalid index")
+            return False
         if not check_proof_of_work(header_hash, difficulty):
             self.write_log("X Invalid proof of work")
             return False
@@ -137,14 +258,14 @@ class LightNode(Peer):
             self.write_log("X Invalid timestamp")
             return False
         self.write_log("INF: Header is valid")
-        block = Block(index, header_hash, prev_hash, merkle_root, timestamp, difficulty, nonce, parent)
+        block = Header(index, header_hash, prev_hash, merkle_root, timestamp, difficulty, nonce, parent) # no body, we only keep headers
         self.blocks[header_hash] = block
         if parent == self.biggest_chain:
             self.write_log("INF: Header is in the biggest chain")
-            self.biggest_chain = block
+            self.set_tip(block)
         elif block.total_work > self.biggest_chain.total_work:
             self.write_log("INF: Header is in a bigger chain")
-            self.biggest_chain = block
+            self.set_tip(block)
         try:
             self.chain_headers.remove(parent)
         except ValueError:
@@ -152,132 +273,170 @@ class LightNode(Peer):
         self.chain_headers.append(block)
         return True
     
-    def request_election(self, election_hash):
+    def request_election(self, election_hash, timeout = ELECTION_TIMEOUT, quorum = ELECTION_QUORUM):
         """
         Request an election from the tracker.
-        Picks up to 5 random nodes, and sends them a request for the election.
-        Each will send their proofs for the election back. We will use the first that has the election end, or the first
-        assuming none of them do. If something does not check out, we will move to the next one.
+        Picks the ELECTION_FANOUT fastest nodes (by round trip time), and sends them a request for the election.
+        Each will send their proofs for the election back, and each answer is checked on the worker pool as soon as it gets here.
+        We stop as soon as quorum answers with the end of the election proven agree on the result, and drop the answers still to come.
+        If that does not happen (the election is still open, or the nodes disagree) we wait for every answer or the timeout,
+        and use the finished election most answers agreed on, or if there is none, the one with the most votes.
         
         args:
             election_hash: The hash of the election to request.
+            timeout: The most seconds to wait for the answers.
+            quorum: Fully proven answers that have to agree before we stop waiting for the rest.
         
         returns:
-            None, actual processing will be done once we get the message back.
+            The election with its results, "election not found" if nobody answered, or None if no answer checked out.
         """
         self.write_log(f"INF: Requesting election {election_hash} from tracker")
-        # Pick up to 5 random nodes
+        # Pick the fastest nodes
         with self.node_list_lock:
-            nodes = list(self.nodes.keys())
-            if len(nodes) > 5:
-                nodes = random.sample(nodes, 5)
+            nodes = self.rank_nodes(list(self.nodes.values()))[:ELECTION_FANOUT]
+        request = ElectionRequest(nodes, quorum)
+        # waiting on the answers before asking, so a quick one cant get here before we are
+        with self.election_requests_lock:
+            self.election_requests.setdefault(election_hash, []).append(request)
+        try:
+            # not under the node list lock, a send that fails drops the node, which takes it
             for node in nodes:
                 # Send a request to each node
-                self.send_message(GET_ELECTION_RES.to_bytes(2, byteorder='big') + election_hash, self.nodes[node])
-        results = []
-        for _ in range(10):
-            # Wait for the response
-            with self.election_reses_lock:
-                if election_hash in self.election_reses and len(self.election_reses[election_hash]) == len(nodes):
-                    results = self.election_reses[election_hash]
-                    del self.election_reses[election_hash]
-                    break
-            time.sleep(1)
-        if election_hash in self.election_reses:
-            results = self.election_reses[election_hash]
-        if len(results) == 0:
+                try:
+                    self.send_message(GET_ELECTION_RES.to_bytes(2, byteorder='big') + election_hash, node)
+                except OSError as e:
+                    self.write_log(f"X Could not ask {node} for election {election_hash}: {e}\n")
+                    request.lost(node)
+            answer = request.wait(timeout)
+        finally:
+            with self.election_requests_lock:
+                self.election_requests[election_hash].remove(request)
+                if not self.election_requests[election_hash]:
+                    del self.election_requests[election_hash]
+        if answer is not None:
+            self.write_log(f"INF: Election {election_hash} agreed on by {quorum} of {request.answers} answers\n")
+            return answer
+        if request.answers == 0:
             self.write_log(f"INF: Election {election_hash} not found")
             return "election not found"
-        max_votes = 0
+        with request.ready:
+            verified = list(request.verified)
+            agreeing = dict(request.agreeing)
+        finished = [election for election in verified if election.finished]
+        if finished:
+            self.write_log(f"INF: No quorum for election {election_hash}, using the result most answers agreed on\n")
+            return max(finished, key=lambda election: agreeing[(election.winner, tuple(sorted(election.used_keys.items())))])
         best_election = None
-        for result in results:
-            if best_election is not None:
-                self.write_log(f"INF: best so far: {best_election.used_keys}")
-            else:
-                self.write_log(f"INF: best so far: None")
-            vote_totals = {}
-            json_data = None
-            try:
-                json_data = json.loads(result)
-            except json.JSONDecodeError:
-                self.write_log(f"X Error decoding election result: {result}")
-                continue
-            try:
-                # handling the start
-                start = json_data["start"]
-                election = Election(start["election"])
-                for choice in election.choices:
-                    vote_totals[choice] = 0
-                election_proof = start["proof"]
-                election_block = base64.b64decode(start["block"])
-                if election_block not in self.blocks:
-                    self.write_log(f"X Election block {election_block} not in chain")
+        for election in verified:
+            if best_election is None or election.total_votes > best_election.total_votes:
+                best_election = election
+        return best_election
+
+    def check_election_result(self, request, result):
+        """
+        Runs on the worker pool for every answer to an election request, and hands the request what it proved.
+        """
+        election = None
+        try:
+            election = self.verify_election_result(result, request)
+        finally:
+            request.checked(election)
+
+    def verify_election_result(self, result, request = None):
+        """
+        Checks one node's answer to GET_ELECTION_RES: the election, every vote and the end of the election (if there is one)
+        against the merkle roots of the headers we have, and every vote's signature. Votes that do not check out are not counted.
+        Returns the election with its tally, finished if the end was proven, or None if the answer is no good.
+
+        args:
+            result: The answer (json, without the election hash)
+            request: The ElectionRequest it is for, we give up early if it is done
+        """
+        vote_totals = {}
+        json_data = None
+        try:
+            json_data = json.loads(result)
+        except json.JSONDecodeError:
+            self.write_log(f"X Error decoding election result: {result}")
+            return None
+        try:
+            # handling the start
+            start = json_data["start"]
+            election = Election(start["election"])
+            for choice in election.choices:
+                vote_totals[choice] = 0
+            election_proof = start["proof"]
+            election_block = base64.b64decode(start["block"])
+            if election_block not in self.blocks:
+                self.write_log(f"X Election block {election_block} not in chain")
+                return None
+            election_block = self.blocks[election_block]
+            valid = election_block.verify_merkle_proof(election, election_proof)
+            if not valid:
+                self.write_log(f"X Election proof not valid")
+                return None
+
+            # handling the votes
+            votes = json_data["votes"]
+            for vote in votes:
+                if request is not None and request.done:
+                    return None # somebody else's answer already settled it
+                vote_obj = Vote(vote["vote"])
+                vote_proof = vote["proof"]
+                vote_block = base64.b64decode(vote["block"])
+                if vote_block not in self.blocks:
+                    self.write_log(f"X Vote block {vote_block} not in chain")
                     continue
-                election_block = self.blocks[election_block]
-                valid = election_block.verify_merkle_proof(election, election_proof)
+                vote_block = self.blocks[vote_block]
+                valid = vote_block.verify_merkle_proof(vote_obj, vote_proof)
                 if not valid:
-                    self.write_log(f"X Election proof not valid")
+                    self.write_log(f"X Vote proof not valid")
+                    continue
+                vote_good = self.check_vote(vote_obj, election, time.time())
+                if not vote_good:
+                    self.write_log(f"X Vote {vote_obj} not valid")
                     continue
+                vote_totals[vote_obj.choice] += 1
+                election.used_keys[vote_obj.public_key] = vote_obj.choice
 
-                # handling the votes
-                votes = json_data["votes"]
-                for vote in votes:
-                    vote_obj = Vote(vote["vote"])
-                    vote_proof = vote["proof"]
-                    vote_block = base64.b64decode(vote["block"])
-                    if vote_block not in self.blocks:
-                        self.write_log(f"X Vote block {vote_block} not in chain")
-                        continue
-                    vote_block = self.blocks[vote_block]
-                    valid = vote_block.verify_merkle_proof(vote_obj, vote_proof)
-                    if not valid:
-                        self.write_log(f"X Vote proof not valid")
-                        continue
-                    vote_good = self.check_vote(vote_obj, election, time.time())
-                    if not vote_good:
-                        self.write_log(f"X Vote {vote_obj} not valid")
-                        continue
-                    vote_totals[vote_obj.choice] += 1
-                    election.used_keys[vote_obj.public_key] = vote_obj.choice
-
-
-                end = json_data["end"]
-                election.winner = max(vote_totals, key=vote_totals.get)
-                election.total_votes = sum(vote_totals.values())
-                if end != {}:
-                    # handling the end
-                    end_obj = EndOfElection(end["election_end"])
-                    end_proof = end["proof"]
-                    end_block = base64.b64decode(end["block"])
-                    if end_block not in self.blocks:
-                        self.write_log(f"X End block {end_block} not in chain")
-                        continue
-                    end_block = self.blocks[end_block]
-                    valid = end_block.verify_merkle_proof(end_obj, end_proof)
-                    if not valid:
-                        self.write_log(f"X End proof not valid")
-                        continue
-                    election.finished = True
-                    
-                    return election
-                else:
-                    if sum(vote_totals.values()) > max_votes:
-                        max_votes = sum(vote_totals.values())
-                        best_election = election
-                         
-            except KeyError:
-                self.write_log(f"X Error processing election result: {json_data}")
-                continue
-        return best_election
+
+            end = json_data["end"]
+            election.winner = max(vote_totals, key=vote_totals.get)
+            election.total_votes = sum(vote_totals.values())
+            if end != {}:
+                # handling the end
+                end_obj = EndOfElection(end["election_end"])
+                end_proof = end["proof"]
+                end_block = base64.b64decode(end["block"])
+                if end_block not in self.blocks:
+                    self.write_log(f"X End block {end_block} not in chain")
+                    return None
+                end_block = self.blocks[end_block]
+                valid = end_block.verify_merkle_proof(end_obj, end_proof)
+                if not valid:
+                    self.write_log(f"X End proof not valid")
+                    return None
+                election.finished = True
+            return election
+        except KeyError:
+            self.write_log(f"X Error processing election result: {json_data}")
+            return None
 
     def handle_election_res(self, message, node):
-        self.write_log(message)
-        election_hash = message[:32]
-        with self.election_reses_lock:
-            if election_hash not in self.election_reses:
-                self.election_reses[election_hash] = []
-            self.election_reses[election_hash].append(message[32:])
-            self.write_log(f"Got election result for {election_hash}, waiting for more")
+        self.write_log(lambda: f"Election result received: {message}\n")
+        election_hash = bytes(message[:32])
+        with self.election_requests_lock:
+            requests = list(self.election_requests.get(election_hash, []))
+        taken = False
+        for request in requests:
+            if request.add(node):
+                # checked off this thread, so the node's next messages are not stuck behind the signature checks
+                future = self.verify_pool.submit(self.check_election_result, request, message[32:])
+                with request.ready:
+                    request.checking.append(future)
+                taken = True
+        if not taken:
+            self.write_log(f"Election result for {election_hash} we were not waiting on, dropped")
     
 
     def get_active_election(self, node):
@@ -0,0 +1,103 @@
+from utils import *
+import collections
+import os
+import sys
+
+class SamplingProfiler:
+    """
+    Profiles a running node without restarting it. While it is on, a thread looks at the stack of every other thread every interval
+    seconds and counts what it sees, so it covers the connection threads, the miner and the scheduler alike (cProfile only sees the
+    thread that turned it on). While it is off there is no thread and nothing is hooked, so it costs nothing.
+    Results are written as collapsed stacks (one "thread;outer;...;inner count" line per stack), which flamegraph.pl and speedscope read,
+    and summarised as the functions the most samples were in.
+    """
+    def __init__(self):
+        self.lock = threading.Lock() # lock for starting and stopping
+        self.running = None # the Event the sampling thread stops on, None while off
+        self.thread = None
+        self.stacks = collections.Counter() # (thread name, frames outermost first) -> samples
+        self.samples = 0
+        self.started = 0 # time.time() the session started
+        self.ended = None # time.time() it stopped, None while it is running
+
+    def start(self, interval = PROFILE_INTERVAL):
+        """
+        Starts a session, throwing away the last one. Returns False if one is already running.
+        args:
+        - interval: Seconds between samples
+        """
+        with self.lock:
+            if self.running is not None:
+                return False
+            self.stacks = collections.Counter()
+            self.samples = 0
+            self.started = time.time()
+            self.ended = None
+            self.running = threading.Event()
+            self.thread = threading.Thread(target=self.run, args=(self.running, interval), daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        """
+        Stops the session and waits for the sampling thread. Returns False if there was none.
+        """
+        with self.lock:
+            if self.running is None:
+                return False
+            self.running.set()
+            self.thread.join()
+            self.ended = time.time()
+            self.running = None
+            self.thread = None
+            return True
+
+    def is_running(self):
+        return self.running is not None
+
+    def run(self, stopped, interval):
+        """
+        The sampling thread.
+        """
+        me = threading.get_ident()
+        while not stopped.wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.reverse()
+                self.stacks[(names.get(ident, str(ident)), tuple(stack))] += 1
+            self.samples += 1
+
+    def write(self, path):
+        """
+        Writes the collapsed stacks of the last session to path.
+        """
+        with open(path, "w") as f:
+            for (thread, stack), count in self.stacks.most_common():
+                f.write(";".join((thread,) + stack) + f" {count}\n")
+
+    def summary(self, top = PROFILE_SUMMARY_LINES):
+        """
+        The functions the most samples were in, as text: own is samples with the function at the top of the stack, total counts every
+        sample it was anywhere in. Threads waiting on a socket or a lock show up too, that is time they spent waiting.
+        args:
+        - top: Functions listed
+        """
+        own = collections.Counter()
+        total = collections.Counter()
+        for (thread, stack), count in self.stacks.items():
+            if stack:
+                own[stack[-1]] += count
+            for function in set(stack):
+                total[function] += count
+        lines = [f"{self.samples} samples over {(self.ended or time.time()) - self.started:.1f} seconds",
+                 f"{'own':>7} {'total':>7}  function"]
+        for function, count in own.most_common(top):
+            lines.append(f"{count:>7} {total[function]:>7}  {function}")
+        return "\n".join(lines)
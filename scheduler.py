@@ -0,0 +1,74 @@
+from utils import *
+import heapq
+import itertools
+
+class Timer:
+    """
+    A callback waiting in the scheduler. Cancelling only marks it, it is thrown away when it comes up.
+    """
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler:
+    """
+    Runs callbacks at set times on one thread, for everything that used to have its own sleeping loop (keepalives, idle timeouts,
+    request timeouts, stats). The timers sit in a heap, and the thread sleeps until the earliest one is due, so nothing wakes up
+    unless there is something to do.
+    Callbacks run on the scheduler thread, so they should be quick and must not wait on the network.
+    """
+    def __init__(self, log):
+        """
+        args:
+        - log: Where to write errors from callbacks (the peer's write_log)
+        """
+        self.heap = [] # (when, tie breaker, timer), earliest first
+        self.counter = itertools.count() # keeps timers due at the same time in the order they were added
+        self.ready = threading.Condition() # lock for the heap, wakes the thread when an earlier timer is added
+        self.log = log
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def schedule(self, delay, callback, *args):
+        """
+        Runs callback(*args) in delay seconds. Returns the Timer, which can be cancelled.
+        """
+        timer = Timer(time.monotonic() + delay, callback, args)
+        with self.ready:
+            heapq.heappush(self.heap, (timer.when, next(self.counter), timer))
+            if self.heap[0][2] is timer:
+                self.ready.notify() # it is the new earliest, the thread has to sleep less
+        return timer
+
+    def every(self, interval, callback, *args):
+        """
+        Runs callback(*args) every interval seconds, starting interval seconds from now, for as long as we run.
+        """
+        def repeat():
+            try:
+                callback(*args)
+            finally:
+                self.schedule(interval, repeat)
+        self.schedule(interval, repeat)
+
+    def run(self):
+        """
+        The scheduler thread. Sleeps until the earliest timer is due, runs it, repeats.
+        """
+        while True:
+            with self.ready:
+                while True:
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                    if self.heap and self.heap[0][0] <= time.monotonic():
+                        timer = heapq.heappop(self.heap)[2]
+                        break
+                    self.ready.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                self.log(f"X Timer {timer.callback.__name__} failed: {e}\n")
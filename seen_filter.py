@@ -0,0 +1,50 @@
+from utils import *
+from collections import OrderedDict
+
+class SeenFilter:
+    """
+    Remembers the hashes of the raw messages we have seen recently, so the copies that flooding sends us from every
+    neighbour can be dropped before we parse or verify anything.
+    Bounded by count (oldest forgotten first) and by age, so memory stays flat no matter how much traffic comes in.
+    """
+    def __init__(self, max_entries = SEEN_FILTER_SIZE, window = SEEN_FILTER_WINDOW):
+        """
+        args:
+        - max_entries: The most hashes we remember
+        - window: How long (seconds) we remember a hash for
+        """
+        self.max_entries = max_entries
+        self.window = window
+        self.seen = OrderedDict() # hash -> time first seen, oldest first
+        self.lock = threading.Lock()
+
+    def check_and_add(self, message):
+        """
+        Returns True if we have seen this message inside the window, otherwise remembers it and returns False.
+        args:
+        - message: The raw message (type + payload)
+        """
+        key = hashy(message)
+        now = time.time()
+        with self.lock:
+            if key in self.seen:
+                if now - self.seen[key] <= self.window:
+                    return True
+                del self.seen[key] # older than the window, nothing has come in since to push it out
+            self.seen[key] = now
+            # forgetting anything too old, or too many
+            while self.seen:
+                oldest_key, oldest_time = next(iter(self.seen.items()))
+                if len(self.seen) <= self.max_entries and now - oldest_time <= self.window:
+                    break
+                del self.seen[oldest_key]
+        return False
+
+    def forget(self, message):
+        """
+        Forgets a message, so the next copy of it is not dropped. For messages we could not use yet (a vote for an election we have not got).
+        args:
+        - message: The raw message (type + payload)
+        """
+        with self.lock:
+            self.seen.pop(hashy(message), None)
@@ -0,0 +1,75 @@
+import unittest
+from utils import BLOCK_WINDOW, BLOCKS_PER_BATCH, BLOCK_TIMEOUT, BLOCK_MAX_TRIES
+from block_downloader import BlockDownloader
+from node import Node
+
+def hashes(count, start = 0):
+    return [i.to_bytes(32, byteorder='big') for i in range(start, start + count)]
+
+class TestBlockDownloader(unittest.TestCase):
+    def setUp(self):
+        self.downloader = BlockDownloader()
+        self.a = Node("127.0.0.1", 8001, None)
+        self.b = Node("127.0.0.1", 8002, None)
+
+    def test_batches_spread_over_nodes(self):
+        self.downloader.add(hashes(2 * BLOCKS_PER_BATCH))
+        requests = self.downloader.schedule([self.a, self.b], 0)
+        self.assertEqual(len(requests[self.a]), BLOCKS_PER_BATCH)
+        self.assertEqual(len(requests[self.b]), BLOCKS_PER_BATCH)
+        self.assertEqual(set(requests[self.a]) & set(requests[self.b]), set())
+
+    def test_window_is_never_exceeded(self):
+        self.downloader.add(hashes(BLOCK_WINDOW * 3))
+        requests = self.downloader.schedule([self.a], 0)
+        self.assertEqual(len(requests[self.a]), BLOCK_WINDOW)
+        self.assertEqual(len(self.a.blocks_in_flight), BLOCK_WINDOW)
+        self.assertEqual(self.downloader.schedule([self.a], 0), {})
+        # an answer frees one spot
+        self.downloader.received(requests[self.a][0], 1000)
+        self.assertEqual(len(self.downloader.schedule([self.a], 0)[self.a]), 1)
+
+    def test_add_skips_pending(self):
+        self.downloader.add(hashes(3))
+        self.downloader.schedule([self.a], 0)
+        self.downloader.add(hashes(5))
+        self.assertEqual(len(self.downloader.wanted), 2)
+        self.assertTrue(self.downloader.is_pending(hashes(1)[0]))
+
+    def test_received_unasked(self):
+        self.assertEqual(self.downloader.received(hashes(1)[0], 1000), (None, None))
+
+    def test_timeout_goes_to_another_node(self):
+        wanted = hashes(4)
+        self.downloader.add(wanted)
+        self.downloader.schedule([self.a], 0)
+        self.assertEqual(self.downloader.expire([self.a, self.b], BLOCK_TIMEOUT / 2), [])
+        self.assertEqual(self.downloader.expire([self.a, self.b], BLOCK_TIMEOUT + 1), wanted)
+        self.assertEqual(self.a.blocks_in_flight, set())
+        # back at the front of the queue in the same order, and not handed to a again
+        self.assertEqual(list(self.downloader.wanted), wanted)
+        self.assertEqual(self.downloader.schedule([self.a, self.b], BLOCK_TIMEOUT + 1), {self.b: wanted})
+
+    def test_gone_node_is_taken_back(self):
+        self.downloader.add(hashes(2))
+        self.downloader.schedule([self.a], 0)
+        self.assertEqual(len(self.downloader.expire([self.b], 0)), 2)
+        self.assertEqual(self.downloader.schedule([self.b], 0), {self.b: hashes(2)})
+
+    def test_everyone_failed_tries_again(self):
+        self.downloader.add(hashes(1))
+        self.downloader.schedule([self.a], 0)
+        self.downloader.expire([self.a], BLOCK_TIMEOUT + 1)
+        self.assertEqual(self.downloader.schedule([self.a], BLOCK_TIMEOUT + 1), {self.a: hashes(1)})
+
+    def test_dropped_after_max_tries(self):
+        self.downloader.add(hashes(1))
+        now = 0
+        for _ in range(BLOCK_MAX_TRIES):
+            self.assertEqual(self.downloader.schedule([self.a], now), {self.a: hashes(1)})
+            now += BLOCK_TIMEOUT + 1
+            self.downloader.expire([self.a], now)
+        self.assertFalse(self.downloader.is_pending(hashes(1)[0]))
+
+if __name__ == "__main__":
+    unittest.main()
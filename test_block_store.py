@@ -0,0 +1,89 @@
+import unittest
+from unittest import mock
+import os
+import tempfile
+from utils import BLOCK_INDEX_RECORD_SIZE, HEADER_SIZE, hashy
+from block_store import BlockStore
+
+def block(i, size = 200):
+    data = i.to_bytes(4, byteorder='big') * (size // 4)
+    return hashy(data), data
+
+class TestBlockStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = self.directory.name
+
+    def open(self):
+        store = BlockStore(self.path)
+        self.addCleanup(store.close)
+        return store
+
+    def test_put_get(self):
+        store = self.open()
+        h, data = block(1)
+        store.put(h, 1, data)
+        store.put(h, 1, data) # already there, not written twice
+        self.assertIn(h, store)
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.get(h), data)
+        self.assertEqual(store.get(h, True), data[:HEADER_SIZE])
+        self.assertEqual(store.height(h), 1)
+        self.assertIsNone(store.get(b'\x00' * 32))
+        self.assertIsNone(store.height(b'\x00' * 32))
+
+    def test_reload(self):
+        store = self.open()
+        blocks = [block(i) for i in range(5)]
+        for height, (h, data) in reversed(list(enumerate(blocks))):
+            store.put(h, height, data)
+        store.close()
+        store = self.open()
+        self.assertEqual(len(store), 5)
+        # lowest height first, whatever order they were stored in
+        self.assertEqual([(h, height, data) for h, height, data in store.load()], [(h, height, data) for height, (h, data) in enumerate(blocks)])
+
+    def test_new_segment(self):
+        with mock.patch("block_store.SEGMENT_SIZE", 500):
+            store = self.open()
+            blocks = [block(i) for i in range(5)]
+            for height, (h, data) in enumerate(blocks):
+                store.put(h, height, data)
+            self.assertGreater(store.segment, 0)
+            store.close()
+            store = self.open()
+            for h, data in blocks:
+                self.assertEqual(store.get(h), data)
+
+    def test_half_written_index_record(self):
+        store = self.open()
+        for i in range(3):
+            store.put(block(i)[0], i, block(i)[1])
+        store.close()
+        index = os.path.join(self.path, "index.dat")
+        with open(index, "ab") as f:
+            f.write(b'\x01' * (BLOCK_INDEX_RECORD_SIZE // 2))
+        store = self.open()
+        self.assertEqual(len(store), 3)
+        self.assertEqual(os.path.getsize(index), 3 * BLOCK_INDEX_RECORD_SIZE) # cut off, so the next record lines up
+        h, data = block(3)
+        store.put(h, 3, data)
+        store.close()
+        self.assertEqual(self.open().get(h), data)
+
+    def test_index_past_segment_end(self):
+        store = self.open()
+        for i in range(3):
+            store.put(block(i)[0], i, block(i)[1])
+        store.close()
+        # the last block's bytes never made it to disk
+        segment = store.segment_path(0)
+        with open(segment, "r+b") as f:
+            f.truncate(os.path.getsize(segment) - 10)
+        store = self.open()
+        self.assertEqual(len(store), 2)
+        self.assertNotIn(block(2)[0], store)
+
+if __name__ == "__main__":
+    unittest.main()
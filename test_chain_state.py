@@ -0,0 +1,111 @@
+import unittest
+import json
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+from election import Election
+from chain_state import ChainState
+from block_store import BlockStore
+
+def make_election(name):
+    return Election({"name": name, "choices": ["A", "B"], "public_keys": ["key1", "key2", "key3"], "end_time": int(time.time()) + 1000})
+
+def make_block(index, elections = (), votes = (), ends = ()):
+    """
+    Stands in for a Block, ChainState only looks at these.
+    args:
+    - votes: (election, public key, choice)
+    """
+    block_votes = {}
+    for election, key, choice in votes:
+        block_votes.setdefault(election.hashy, []).append(SimpleNamespace(public_key=key, choice=choice))
+    return SimpleNamespace(index=index, elections={e.hashy: e for e in elections}, votes=block_votes, election_ends={e.hashy: None for e in ends})
+
+class TestChainState(unittest.TestCase):
+    def setUp(self):
+        self.election = make_election("e1")
+        self.blocks = [
+            make_block(0, elections=[self.election]),
+            make_block(1, votes=[(self.election, "key1", "A"), (self.election, "key2", "B")]),
+            make_block(2, votes=[(self.election, "key3", "A")], ends=[self.election]),
+        ]
+
+    def test_connect(self):
+        state = ChainState()
+        for block in self.blocks:
+            state.connect(block)
+        h = self.election.hashy
+        self.assertEqual(state.get_election(h).hashy, h)
+        self.assertEqual(state.tallies[h], {"A": 2, "B": 1})
+        self.assertEqual(state.used_keys[h], {"key1": "A", "key2": "B", "key3": "A"})
+        self.assertEqual(state.ended, {h: 2})
+
+    def test_disconnect_undoes_connect(self):
+        state = ChainState()
+        for block in self.blocks:
+            state.connect(block)
+        before = ChainState()
+        for block in self.blocks[:1]:
+            before.connect(block)
+        for block in reversed(self.blocks[1:]):
+            state.disconnect(block)
+        self.assertEqual(state.to_dict(), before.to_dict())
+        state.disconnect(self.blocks[0])
+        self.assertIsNone(state.get_election(self.election.hashy))
+
+    def test_dict_round_trip(self):
+        state = ChainState()
+        for block in self.blocks:
+            state.connect(block)
+        loaded = ChainState.from_dict(json.loads(json.dumps(state.to_dict())))
+        self.assertEqual(loaded.to_dict(), state.to_dict())
+        self.assertEqual(loaded.get_election(self.election.hashy).hashy, self.election.hashy)
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+        self.store = BlockStore(self.path)
+        self.addCleanup(self.store.close)
+        self.tip = b'\x07' * 32
+        self.store.put(self.tip, 2, b'\x00' * 100)
+        state = ChainState()
+        election = make_election("e1")
+        state.connect(make_block(0, elections=[election]))
+        state.connect(make_block(1, votes=[(election, "key1", "A")]))
+        self.state = state.to_dict()
+
+    def test_round_trip(self):
+        self.assertIsNone(self.store.read_snapshot())
+        self.store.write_snapshot(self.tip, 2, self.state)
+        tip, height, state = self.store.read_snapshot()
+        self.assertEqual((tip, height), (self.tip, 2))
+        self.assertEqual(ChainState.from_dict(state).to_dict(), self.state)
+        self.assertFalse(os.path.exists(os.path.join(self.path, "snapshot.json.tmp")))
+
+    def test_edited_snapshot_is_not_trusted(self):
+        self.store.write_snapshot(self.tip, 2, self.state)
+        path = os.path.join(self.path, "snapshot.json")
+        with open(path) as f:
+            wrapper = json.load(f)
+        self.assertIn('"height": 2', wrapper["body"])
+        wrapper["body"] = wrapper["body"].replace('"height": 2', '"height": 3')
+        with open(path, "w") as f:
+            json.dump(wrapper, f)
+        self.assertIsNone(self.store.read_snapshot())
+
+    def test_torn_snapshot_is_not_trusted(self):
+        self.store.write_snapshot(self.tip, 2, self.state)
+        path = os.path.join(self.path, "snapshot.json")
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) // 2)
+        self.assertIsNone(self.store.read_snapshot())
+
+    def test_unknown_tip(self):
+        self.store.write_snapshot(b'\x08' * 32, 2, self.state)
+        self.assertIsNone(self.store.read_snapshot())
+
+if __name__ == "__main__":
+    unittest.main()
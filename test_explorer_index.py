@@ -0,0 +1,100 @@
+import unittest
+import json
+import os
+import tempfile
+from types import SimpleNamespace
+from explorer_index import ExplorerIndex
+
+class Thing(SimpleNamespace):
+    """
+    Stands in for an election or a vote, the index only needs a few fields and jsonify.
+    """
+    def jsonify(self):
+        return json.dumps({k: v.hex() if isinstance(v, bytes) else v for k, v in self.__dict__.items()})
+
+def make_block(index, tag = 0, elections = (), votes = (), ends = ()):
+    """
+    Stands in for a Block.
+    args:
+    - tag: Changes the hash, for a block at the same height on another chain
+    - votes: (election hash, public key, choice)
+    - ends: (election hash, results)
+    """
+    block_votes = {}
+    for election_hash, key, choice in votes:
+        block_votes.setdefault(election_hash, []).append(Thing(election_hash=election_hash, public_key=key, choice=choice))
+    return SimpleNamespace(index=index, hash=bytes([index, tag]) * 16, previous_hash=bytes([index - 1, tag]) * 16 if index else b'\x00' * 32,
+                           timestamp=1000 + index, difficulty=20, data=[None] * (len(elections) + len(votes)),
+                           elections={e[0]: Thing(name=e[1], end_time=e[2]) for e in elections}, votes=block_votes,
+                           election_ends={h: SimpleNamespace(results=results) for h, results in ends})
+
+E1 = b'\x01' * 32
+E2 = b'\x02' * 32
+
+class TestExplorerIndex(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "explorer.db")
+        self.chain = [
+            make_block(0, elections=[(E1, "e1", 5000), (E2, "e2", 3000)]),
+            make_block(1, votes=[(E1, "key1", "A"), (E2, "key1", "B")]),
+            make_block(2, votes=[(E1, "key2", "B")], ends=[(E2, {"B": 1})]),
+        ]
+
+    def open(self):
+        index = ExplorerIndex(self.path)
+        self.addCleanup(index.close)
+        return index
+
+    def test_queries(self):
+        index = self.open()
+        self.assertEqual(index.sync(self.chain), 3)
+        block = index.block_at_height(2)
+        self.assertEqual((block["height"], block["timestamp"], block["objects"]), (2, 1002, 1))
+        self.assertIsNone(index.block_at_height(3))
+        self.assertEqual(index.height_of(self.chain[1].hash), 1)
+        self.assertIsNone(index.height_of(b'\x09' * 32))
+        self.assertEqual([(v["vote"]["public_key"], v["height"]) for v in index.votes_for_election(E1)], [("key1", 1), ("key2", 2)])
+        self.assertEqual([v["vote"]["choice"] for v in index.votes_by_key("key1")], ["A", "B"])
+        ending = index.elections_ending(0, 10000)
+        self.assertEqual([(e["election"]["name"], e["results"]) for e in ending], [("e2", {"B": 1}), ("e1", None)])
+        self.assertEqual(index.elections_ending(4000, 6000)[0]["election"]["name"], "e1")
+
+    def test_disconnect(self):
+        index = self.open()
+        index.sync(self.chain)
+        index.disconnect(self.chain[2])
+        index.commit()
+        self.assertIsNone(index.block_at_height(2))
+        self.assertEqual(len(index.votes_for_election(E1)), 1)
+        self.assertIsNone(index.elections_ending(0, 10000)[0]["results"])
+
+    def test_connect_replaces_height(self):
+        index = self.open()
+        index.sync(self.chain)
+        other = make_block(2, tag=1, votes=[(E1, "key3", "A")])
+        index.connect(other)
+        index.commit()
+        self.assertIsNone(index.height_of(self.chain[2].hash))
+        self.assertEqual(index.height_of(other.hash), 2)
+        self.assertEqual([v["vote"]["public_key"] for v in index.votes_for_election(E1)], ["key1", "key3"])
+
+    def test_sync_after_restart(self):
+        index = self.open()
+        index.sync(self.chain)
+        index.close()
+        index = self.open()
+        self.assertEqual(index.sync(self.chain), 0) # already caught up
+        # the chain moved on to another branch from height 1 while we were down
+        fork = self.chain[:1] + [make_block(1, tag=1), make_block(2, tag=1), make_block(3, tag=1)]
+        self.assertEqual(index.sync(fork), 3)
+        self.assertEqual(index.height_of(fork[3].hash), 3)
+        self.assertIsNone(index.height_of(self.chain[1].hash))
+        self.assertEqual(index.votes_by_key("key1"), [])
+        # and a shorter chain drops what is past its end
+        self.assertEqual(index.sync(fork[:2]), 0)
+        self.assertIsNone(index.block_at_height(2))
+
+if __name__ == "__main__":
+    unittest.main()
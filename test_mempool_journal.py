@@ -0,0 +1,85 @@
+import unittest
+from unittest import mock
+import os
+import tempfile
+from mempool_journal import MempoolJournal
+
+class Thing:
+    """
+    Stands in for a vote or election, the journal only needs its json dict.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def get_json_dict(self):
+        return {"name": self.name}
+
+def key(i):
+    return bytes([i]) * 32
+
+class TestMempoolJournal(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "mempool.log")
+
+    def open(self):
+        journal = MempoolJournal(self.path)
+        self.addCleanup(journal.close)
+        return journal, journal.load()
+
+    def test_replay(self):
+        journal, objects = self.open()
+        self.assertEqual(objects, [])
+        for i in range(4):
+            journal.add(key(i), Thing(f"t{i}"))
+        journal.add(key(0), Thing("t0")) # already there
+        journal.remove(key(1))
+        journal.remove(key(9)) # never added
+        journal.close()
+        _, objects = self.open()
+        self.assertEqual(objects, [{"name": "t0"}, {"name": "t2"}, {"name": "t3"}])
+
+    def test_truncated_tail(self):
+        journal, _ = self.open()
+        for i in range(3):
+            journal.add(key(i), Thing(f"t{i}"))
+        journal.close()
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 10) # the last line was half written when we crashed
+        journal, objects = self.open()
+        self.assertEqual(objects, [{"name": "t0"}, {"name": "t1"}])
+        # what we log after that has to survive the next restart too
+        journal.add(key(3), Thing("t3"))
+        journal.remove(key(0))
+        journal.close()
+        _, objects = self.open()
+        self.assertEqual(objects, [{"name": "t1"}, {"name": "t3"}])
+
+    def test_replace(self):
+        journal, _ = self.open()
+        journal.add(key(0), Thing("t0"))
+        journal.replace(({key(1): Thing("t1")}, {key(2): Thing("t2")}))
+        journal.add(key(3), Thing("t3"))
+        journal.close()
+        _, objects = self.open()
+        self.assertEqual(objects, [{"name": "t1"}, {"name": "t2"}, {"name": "t3"}])
+
+    def test_compact(self):
+        with mock.patch("mempool_journal.MEMPOOL_COMPACT_MIN", 10), mock.patch("mempool_journal.MEMPOOL_COMPACT_RATIO", 2):
+            journal, _ = self.open()
+            for i in range(10):
+                journal.add(key(i), Thing(f"t{i}"))
+            self.assertEqual(journal.compact(), 0) # not enough lines yet
+            for i in range(8):
+                journal.remove(key(i))
+            self.assertEqual(journal.compact(), 16)
+            self.assertEqual(journal.compact(), 0)
+            journal.close()
+            with open(self.path, "rb") as f:
+                self.assertEqual(len(f.readlines()), 2)
+            _, objects = self.open()
+            self.assertEqual(objects, [{"name": "t8"}, {"name": "t9"}])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+from unittest import mock
+from peer_directory import PeerDirectory
+from peer import Peer
+
+def address(i):
+    return ("127.0.0.1", 9000 + i)
+
+class TestPeerDirectory(unittest.TestCase):
+    def test_add_remove(self):
+        directory = PeerDirectory()
+        self.assertTrue(directory.add(address(0)))
+        self.assertFalse(directory.add(address(0)))
+        directory.add(address(1))
+        directory.add(address(2))
+        self.assertTrue(directory.remove(address(0)))
+        self.assertFalse(directory.remove(address(0)))
+        self.assertEqual(len(directory), 2)
+        self.assertEqual(sorted(directory.addresses), [address(1), address(2)])
+        for position, kept in enumerate(directory.addresses):
+            self.assertEqual(directory.positions[kept], position)
+
+    def test_sample(self):
+        directory = PeerDirectory()
+        for i in range(10):
+            directory.add(address(i))
+        sample = directory.sample(4, address(0))
+        self.assertEqual(len(sample), 4)
+        self.assertEqual(len(set(sample)), 4)
+        self.assertNotIn(address(0), sample)
+        self.assertEqual(sorted(directory.sample(100)), sorted(directory.addresses))
+
+    def test_changes_since(self):
+        directory = PeerDirectory()
+        directory.add(address(0))
+        seq = directory.seq
+        directory.add(address(1))
+        directory.remove(address(0))
+        self.assertEqual(directory.changes_since(seq), ([(True, address(1)), (False, address(0))], directory.seq))
+        self.assertEqual(directory.changes_since(directory.seq), ([], directory.seq))
+        self.assertEqual(directory.changes_since(0)[0][0], (True, address(0)))
+
+    def test_changes_since_limit(self):
+        directory = PeerDirectory()
+        for i in range(10):
+            directory.add(address(i))
+        events, seq = directory.changes_since(2, 3)
+        self.assertEqual(events, [(True, address(2)), (True, address(3)), (True, address(4))])
+        self.assertEqual(seq, 5)
+        self.assertEqual(directory.changes_since(seq, 3)[0][0], (True, address(5)))
+
+    def test_too_far_behind(self):
+        directory = PeerDirectory(log_size = 3)
+        for i in range(10):
+            directory.add(address(i))
+        self.assertIsNone(directory.changes_since(2)) # its events are gone from the log
+        self.assertIsNone(directory.changes_since(50)) # from before a restart
+        self.assertEqual(len(directory.changes_since(7)[0]), 3)
+
+class TestCheckNodeList(unittest.TestCase):
+    """
+    Peer.check_node_list on its own, without starting a peer.
+    """
+    def setUp(self):
+        self.peer = mock.Mock()
+        self.peer.check_address = lambda ip, port: Peer.check_address(self.peer, ip, port)
+
+    def check(self, node_list):
+        return Peer.check_node_list(self.peer, node_list)
+
+    def test_good_lists(self):
+        self.assertEqual(self.check({"seq": 4, "peers": [["127.0.0.1", 9000]]}), (4, [("127.0.0.1", 9000)], []))
+        self.assertEqual(self.check({"seq": 5, "events": [[False, "127.0.0.1", 9000]]}), (5, [], [(False, ("127.0.0.1", 9000))]))
+
+    def test_bad_lists(self):
+        for node_list in ([], 1, "x", None, {}, {"seq": "5"}, {"seq": -1}, {"seq": 2**64}, {"seq": 1.5}, {"seq": True},
+                          {"seq": 1, "peers": "ab"}, {"seq": 1, "peers": [[1, 2]]}, {"seq": 1, "peers": [["127.0.0.1", 70000]]},
+                          {"seq": 1, "peers": [["127.0.0.1"]]}, {"seq": 1, "events": [[1, "127.0.0.1", 9000]]}, {"seq": 1, "events": {}}):
+            with self.assertRaises((ValueError, KeyError), msg=node_list):
+                self.check(node_list)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import threading
+from scheduler import Scheduler
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.logged = []
+        self.scheduler = Scheduler(self.logged.append)
+        self.ran = []
+        self.done = threading.Event()
+
+    def record(self, name):
+        self.ran.append(name)
+
+    def test_runs_in_time_order(self):
+        self.scheduler.schedule(0.06, self.record, "c")
+        self.scheduler.schedule(0.02, self.record, "a")
+        self.scheduler.schedule(0.04, self.record, "b")
+        self.scheduler.schedule(0.08, self.done.set)
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.ran, ["a", "b", "c"])
+
+    def test_same_time_keeps_order_added(self):
+        # scheduled from a callback, so they are all in the heap before any of them is due
+        def add_all():
+            for name in "abcde":
+                self.scheduler.schedule(0, self.record, name)
+            self.scheduler.schedule(0, self.done.set)
+        self.scheduler.schedule(0, add_all)
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.ran, list("abcde"))
+
+    def test_earlier_timer_wakes_the_thread(self):
+        self.scheduler.schedule(10, self.record, "late")
+        self.scheduler.schedule(0.01, self.done.set)
+        self.assertTrue(self.done.wait(1))
+        self.assertEqual(self.ran, [])
+
+    def test_cancel(self):
+        timer = self.scheduler.schedule(0.02, self.record, "cancelled")
+        self.scheduler.schedule(0.03, self.record, "kept")
+        self.scheduler.schedule(0.05, self.done.set)
+        timer.cancel()
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.ran, ["kept"])
+
+    def test_failing_callback_is_logged(self):
+        def fail():
+            raise ValueError("broken")
+        self.scheduler.schedule(0, fail)
+        self.scheduler.schedule(0.02, self.done.set)
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(len(self.logged), 1)
+        self.assertIn("broken", self.logged[0])
+
+    def test_every(self):
+        count = []
+        def tick():
+            count.append(1)
+            if len(count) == 3:
+                self.done.set()
+        self.scheduler.every(0.01, tick)
+        self.assertTrue(self.done.wait(2))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+from unittest import mock
+from seen_filter import SeenFilter
+
+class TestSeenFilter(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("seen_filter.time.time", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_second_copy_is_dropped(self):
+        seen = SeenFilter(10, 60)
+        self.assertFalse(seen.check_and_add(b"message"))
+        self.assertTrue(seen.check_and_add(b"message"))
+        self.assertFalse(seen.check_and_add(b"other"))
+
+    def test_forgotten_after_window(self):
+        seen = SeenFilter(10, 60)
+        seen.check_and_add(b"message")
+        self.now += 30
+        self.assertTrue(seen.check_and_add(b"message"))
+        # nothing else came in to push it out, it still has to count as new once the window is over
+        self.now += 31
+        self.assertFalse(seen.check_and_add(b"message"))
+        self.assertTrue(seen.check_and_add(b"message"))
+
+    def test_old_entries_are_dropped(self):
+        seen = SeenFilter(10, 60)
+        seen.check_and_add(b"old")
+        self.now += 61
+        seen.check_and_add(b"new")
+        self.assertEqual(len(seen.seen), 1)
+
+    def test_bounded_by_count(self):
+        seen = SeenFilter(3, 60)
+        for i in range(5):
+            seen.check_and_add(bytes([i]))
+        self.assertEqual(len(seen.seen), 3)
+        self.assertFalse(seen.check_and_add(bytes([0]))) # the oldest went first
+        self.assertTrue(seen.check_and_add(bytes([4])))
+
+    def test_forget(self):
+        seen = SeenFilter(10, 60)
+        seen.check_and_add(b"message")
+        seen.forget(b"message")
+        self.assertFalse(seen.check_and_add(b"message"))
+        self.assertTrue(seen.check_and_add(b"message"))
+        seen.forget(b"never seen") # nothing to forget is fine
+
+if __name__ == "__main__":
+    unittest.main()
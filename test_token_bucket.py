@@ -0,0 +1,64 @@
+import unittest
+from unittest import mock
+from utils import BLOCK, VOTE, PEER_CPU_DEBT_LIMIT
+from token_bucket import TokenBucket
+from node import Node
+from peer import Peer
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch("token_bucket.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_starts_full(self):
+        bucket = TokenBucket(1.0, 5.0)
+        self.assertTrue(bucket.has(5.0))
+        self.assertFalse(bucket.has(5.1))
+
+    def test_refills_at_rate_up_to_burst(self):
+        bucket = TokenBucket(2.0, 5.0)
+        bucket.consume(5.0)
+        self.now += 1
+        self.assertAlmostEqual(bucket.refill(), 2.0)
+        self.now += 100
+        self.assertAlmostEqual(bucket.refill(), 5.0)
+
+    def test_debt(self):
+        bucket = TokenBucket(1.0, 2.0)
+        self.assertAlmostEqual(bucket.consume(5.0), -3.0)
+        self.assertFalse(bucket.has(0.1))
+        # the debt is paid off before there is anything to spend again
+        self.now += 3
+        self.assertAlmostEqual(bucket.refill(), 0.0)
+        self.now += 1
+        self.assertTrue(bucket.has(1.0))
+
+class TestChargeNode(unittest.TestCase):
+    """
+    Peer.charge_node on its own, without starting a peer.
+    """
+    def setUp(self):
+        self.peer = mock.Mock()
+        self.node = Node("127.0.0.1", 8001, None)
+
+    def charge(self, typey, elapsed, answer = False):
+        Peer.charge_node(self.peer, self.node, typey, elapsed, answer)
+
+    def test_over_budget_is_disconnected(self):
+        for _ in range(100):
+            self.charge(VOTE, 0.1)
+        self.peer.disconnect_node.assert_called_with(self.node, "over CPU budget")
+
+    def test_answers_are_not_charged(self):
+        # a node serving our block download, blocks we asked for can take as long as they take
+        for _ in range(1000):
+            self.charge(BLOCK, 0.03, True)
+        self.peer.disconnect_node.assert_not_called()
+        self.assertGreater(self.node.bucket.refill(), -PEER_CPU_DEBT_LIMIT)
+        self.assertEqual(self.node.messages[BLOCK][0], 1000) # still recorded
+        self.assertAlmostEqual(self.node.cpu_time, 30.0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+from utils import *
+
+class TokenBucket:
+    """
+    Simple token bucket. Tokens come back at a fixed rate up to the burst size, and are spent by consume.
+    The balance can go negative (a message cost more than we thought), which is how we spot a node that is way over budget.
+    """
+    def __init__(self, rate, burst):
+        """
+        args:
+        - rate: Tokens added per second
+        - burst: The most tokens the bucket can hold
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def refill(self):
+        """
+        Adds the tokens earned since the last refill, returns the current balance.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return self.tokens
+
+    def has(self, amount):
+        """
+        Checks if there are at least amount tokens in the bucket (after refilling).
+        """
+        return self.refill() >= amount
+
+    def consume(self, amount):
+        """
+        Takes amount tokens out, even if that puts the bucket below zero. Returns the new balance.
+        """
+        self.refill()
+        self.tokens -= amount
+        return self.tokens
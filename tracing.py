@@ -0,0 +1,181 @@
+from utils import *
+import collections
+import json
+import os
+import random
+
+class TraceLocal(threading.local):
+    """
+    Each thread's current trace. A class default instead of getattr, which is slow on thread locals when the attribute is missing.
+    """
+    trace_id = None # the sampled trace the thread is in
+
+class Span:
+    """
+    A timed stage, recorded into the tracer's ring buffer when it ends. Only made for sampled traces, see Tracer.span.
+    """
+    __slots__ = ("tracer", "name", "start")
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start, time.perf_counter())
+
+class Trace(Span):
+    """
+    The outermost span of a trace (handling one message, mining one block). Sets the thread's current trace while it runs,
+    so the spans inside it and anything we relay from it carry its id.
+    """
+    __slots__ = ("trace_id",)
+
+    def __init__(self, tracer, name, trace_id):
+        super().__init__(tracer, name)
+        self.trace_id = trace_id
+
+    def __enter__(self):
+        self.tracer.local.trace_id = self.trace_id
+        return super().__enter__()
+
+    def __exit__(self, *exc):
+        super().__exit__(*exc)
+        self.tracer.local.trace_id = None
+
+class LockWait:
+    """
+    Holds a lock for a with block, recording the wait for it as a span. See Tracer.acquire.
+    """
+    __slots__ = ("tracer", "lock", "name")
+
+    def __init__(self, tracer, lock, name):
+        self.tracer = tracer
+        self.lock = lock
+        self.name = name
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.tracer.record(f"wait {self.name}", start, time.perf_counter())
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+class NoSpan:
+    """
+    What every span is when the trace is not sampled, so tracing costs next to nothing the rest of the time.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+NO_SPAN = NoSpan()
+
+class Tracer:
+    """
+    Sampled tracing of where the time goes when handling a message or mining a block: json parsing, signature checks,
+    waiting on the data lock, relaying. A trace starts with start, which picks sample_rate of them at random, and the stages inside
+    it are timed with span. Spans of traces that were not picked are free. Finished spans go into a ring buffer of the last capacity
+    spans, which dump writes out in the Chrome trace event format (chrome://tracing, Perfetto).
+    Traces are carried between nodes: a sampled trace's id goes out with what we relay (TRACED frames), and a node that gets one
+    always traces it under the same id. Timestamps are wall clock, so dumps from several nodes can be put together with merge_traces.
+    """
+    def __init__(self, pid, name, sample_rate = TRACE_SAMPLE_RATE, capacity = TRACE_BUFFER_SIZE):
+        """
+        args:
+        - pid: Process id in the trace, the node's port, so each node gets its own row when dumps are merged
+        - name: The node's name, shown on its row
+        - sample_rate: Fraction of traces recorded, 0 for none (except the ones other nodes started)
+        - capacity: Most spans kept, the oldest are dropped first
+        """
+        self.pid = pid
+        self.name = name
+        self.sample_rate = sample_rate
+        self.spans = collections.deque(maxlen=capacity) # (name, start, end, thread id, trace id), perf_counter times
+        self.local = TraceLocal()
+        self.clock_offset = time.time() - time.perf_counter() # turns perf_counter times into wall clock times
+
+    def current(self):
+        """
+        The id of the sampled trace this thread is in (8 bytes), or None.
+        """
+        return self.local.trace_id
+
+    def start(self, name, trace_id = None):
+        """
+        Starts a trace, to be used as a with block. If the thread is already in a trace this is just a span in it.
+        args:
+        - name: What is being traced
+        - trace_id: The id it came in with from another node. Those are always traced, otherwise it is down to the sample rate
+        """
+        if self.current() is not None:
+            return Span(self, name)
+        if trace_id is None:
+            if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+                return NO_SPAN
+            trace_id = os.urandom(TRACE_ID_SIZE)
+        return Trace(self, name, trace_id)
+
+    def span(self, name):
+        """
+        Times a stage of the current trace, to be used as a with block. Does nothing if the thread is not in a sampled trace.
+        """
+        if self.current() is None:
+            return NO_SPAN
+        return Span(self, name)
+
+    def acquire(self, lock, name):
+        """
+        For with blocks that take a lock: the time spent waiting for it is a span of its own.
+        args:
+        - lock: The lock
+        - name: The lock's name in the trace
+        """
+        if self.current() is None:
+            return lock
+        return LockWait(self, lock, name)
+
+    def record(self, name, start, end):
+        self.spans.append((name, start, end, threading.get_ident(), self.current()))
+
+    def events(self):
+        """
+        The spans in the buffer as Chrome trace events, oldest first, with a name for the node's row.
+        """
+        events = [{"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": self.name}}]
+        for name, start, end, tid, trace_id in list(self.spans):
+            events.append({"name": name, "ph": "X", "pid": self.pid, "tid": tid, "ts": round((start + self.clock_offset) * 1e6, 1),
+                           "dur": round((end - start) * 1e6, 1), "args": {"trace": trace_id.hex() if trace_id else None}})
+        return events
+
+    def dump(self, path):
+        """
+        Writes the buffer to path as a Chrome trace file. Returns the number of spans written.
+        """
+        events = self.events()
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return len(events) - 1
+
+def merge_traces(paths, path):
+    """
+    Puts the trace dumps of several nodes in one file, so a block or vote can be followed from node to node (filter on its trace id).
+    args:
+    - paths: The dumps
+    - path: Where to write the merged one
+    """
+    events = []
+    for dump in paths:
+        with open(dump) as f:
+            events.extend(json.load(f)["traceEvents"])
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -17,7 +17,7 @@ INIT = 1
 VOTE = 2
 BLOCK = 3
 ELECTION = 4
-LONGEST_CHAIN = 5
+LONGEST_CHAIN = 5 # our main chain headers from the height asked for up to the tip, oldest first
 GET_LONGEST_CHAIN = 6
 GET_BLOCK = 7
 GET_ELECTION_RES = 8
@@ -25,12 +25,141 @@ ELECTION_RES = 9
 ERROR_RESPONSE = 10
 ACTIVE_ELECTIONS = 11
 GET_ACTIVE_ELECTIONS = 12
+COMPRESSED = 13 # wraps another frame (type + payload) compressed with zlib
+GET_BLOCKS = 14 # asks for many blocks at once, answered with a stream of BLOCK frames
+GET_HEADERS = 15 # block locator (sparse list of our main chain hashes, newest first)
+HEADERS = 16 # up to MAX_HEADERS_PER_MESSAGE headers after the fork point, oldest first
+CMPCT_BLOCK = 17 # block header + count (2 bytes) + short ids of the objects, the body is rebuilt from the mempool
+GET_BLOCK_TXN = 18 # block hash + indexes (2 bytes each) of the objects we could not find
+BLOCK_TXN = 19 # block hash + json of {index: object}
+VOTE_BATCH = 20 # many votes in one frame, each one is length (2 bytes) + the vote json
+PING = 21 # payload: the time we sent it (8 bytes, our own clock in ns), so the PONG tells us the round trip time
+PONG = 22 # echoes the PING payload back
+GET_PEERS = 23 # the last peer list sequence number we got from the node (8 bytes), 0 for a fresh sample
+PEERS = 24 # json {"seq": n, "events": [[joined, ip, port], ...]} with what changed, or {"seq": n, "peers": [[ip, port], ...]} for a fresh sample
+TRACED = 25 # trace id (TRACE_ID_SIZE bytes) + another frame (type + payload), for following a sampled message from node to node
+MESSAGE_NAMES = {
+    INIT: "INIT",
+    VOTE: "VOTE",
+    BLOCK: "BLOCK",
+    ELECTION: "ELECTION",
+    LONGEST_CHAIN: "LONGEST_CHAIN",
+    GET_LONGEST_CHAIN: "GET_LONGEST_CHAIN",
+    GET_BLOCK: "GET_BLOCK",
+    GET_ELECTION_RES: "GET_ELECTION_RES",
+    ELECTION_RES: "ELECTION_RES",
+    ERROR_RESPONSE: "ERROR_RESPONSE",
+    ACTIVE_ELECTIONS: "ACTIVE_ELECTIONS",
+    GET_ACTIVE_ELECTIONS: "GET_ACTIVE_ELECTIONS",
+    COMPRESSED: "COMPRESSED",
+    GET_BLOCKS: "GET_BLOCKS",
+    GET_HEADERS: "GET_HEADERS",
+    HEADERS: "HEADERS",
+    CMPCT_BLOCK: "CMPCT_BLOCK",
+    GET_BLOCK_TXN: "GET_BLOCK_TXN",
+    BLOCK_TXN: "BLOCK_TXN",
+    VOTE_BATCH: "VOTE_BATCH",
+    PING: "PING",
+    PONG: "PONG",
+    GET_PEERS: "GET_PEERS",
+    PEERS: "PEERS",
+    TRACED: "TRACED",
+}
+# feature bits, sent after the port in the INIT handshake so both sides know what the other can handle
+FEATURE_COMPRESSION = 1
+FEATURE_GET_BLOCKS = 2
+FEATURE_HEADERS = 4
+FEATURE_COMPACT_BLOCKS = 8
+FEATURE_VOTE_BATCH = 16
+FEATURE_PRUNED = 32 # we drop old block bodies and cannot serve blocks deeper than PRUNE_DEPTH
+FEATURE_TRACE = 64 # we understand TRACED frames
+COMPRESSION_THRESHOLD = 1024 # frames smaller than this (PING, single votes) are sent raw
+COMPRESSION_LEVEL = 6
+GET_BLOCKS_RANGE = 0 # GET_BLOCKS payload: mode + start hash + count (2 bytes), walks our main chain from the start hash
+GET_BLOCKS_LIST = 1 # GET_BLOCKS payload: mode + list of 32 byte hashes
+MAX_BLOCKS_PER_REQUEST = 128 # most blocks one GET_BLOCKS will be answered with
+BLOCK_WINDOW = 64 # most blocks we will have requested from one node and not gotten yet
+BLOCKS_PER_BATCH = 16 # blocks handed to one node at a time, small so a sync is spread over every node
+BLOCK_TIMEOUT = 10 # seconds before a requested block is asked for from someone else
+BLOCK_MAX_TRIES = 5
+HEADER_SIZE = 84
+MAX_HEADERS_PER_MESSAGE = 500 # 500 * 84 bytes, keeps a HEADERS frame well under the 2 byte length limit
+MAX_LOCATOR_HASHES = 64
+SHORT_ID_SIZE = 6 # bytes of the object hash (the merkle leaf) used to find it in the mempool
+MAX_PENDING_COMPACT = 16 # compact blocks waiting on missing objects
+SEEN_FILTER_TYPES = (VOTE, ELECTION, BLOCK, CMPCT_BLOCK) # flooded messages, checked against the seen filter before we parse them
+SEEN_FILTER_SIZE = 100000 # most message hashes we remember
+SEEN_FILTER_WINDOW = 600 # seconds we remember a message hash for
+VOTE_BATCH_INTERVAL = 0.05 # seconds we hold admitted votes before relaying them together
+VOTE_BATCH_SIZE = 64 # relay straight away once this many votes are waiting
+MAX_VOTE_BATCH_BYTES = 60000 # keeps a VOTE_BATCH frame under the 2 byte length limit
+RTT_WEIGHT = 0.25 # weight of a new sample in the round trip time moving average
+THROUGHPUT_WEIGHT = 0.25 # weight of a new sample in the throughput moving average
+DEFAULT_RTT = 0.5 # seconds, assumed for a node we have not timed yet
+DEFAULT_THROUGHPUT = 100000 # bytes per second, assumed for a node we have not downloaded from yet
+ELECTION_FANOUT = 5 # nodes a light node asks for an election's results
+ELECTION_TIMEOUT = 10 # most seconds a light node waits for the answers to an election request
+ELECTION_QUORUM = 1 # answers with the end of the election proven that have to agree before a light node stops waiting for the rest
+ELECTION_VERIFY_WORKERS = 4 # threads a light node checks election answers on
+PEER_SAMPLE_SIZE = 32 # most addresses in a node list, picked at random from everyone we know
+PEER_LOG_SIZE = 10000 # join/leave events we keep, nodes further behind than this get a fresh sample
+MAX_PEER_DELTA = 500 # most join/leave events in one PEERS message
+MAX_OUTBOUND = 8 # most connections we open ourselves, nodes that connect to us are not counted
+PEER_POOL_SIZE = 1000 # most addresses we remember for opening new connections later
+KEEPALIVE_INTERVAL = 60 # seconds a node can be quiet before we ping it
+MAX_MISSED_PINGS = 3 # pings in a row without hearing anything back before we drop the node
+SEND_TIMEOUT = 10 # seconds a send to a node can be stuck (the node is not reading) before we drop it
+STATS_INTERVAL = 60 # seconds between writing the stats to the log
+SEGMENT_SIZE = 64 * 1024 * 1024 # bytes in a block store segment file before a new one is started
+BLOCK_INDEX_RECORD_SIZE = 52 # hash (32) + segment (4) + offset (8) + length (4) + height (4)
+SNAPSHOT_INTERVAL = 1000 # blocks between chain state snapshots
+PRUNE_DEPTH = 288 # in pruned mode, blocks deeper than this on the main chain only keep their header (unless an election in them is still open)
+MEMPOOL_COMPACT_INTERVAL = 30 # seconds between checks if the mempool journal needs compacting
+MEMPOOL_COMPACT_RATIO = 2 # the mempool journal is compacted once it has more than this many lines per object still in the pool
+MEMPOOL_COMPACT_MIN = 1000 # and at least this many lines
+LOG_DEBUG = 10 # log levels, write_log works out which one a message is from its prefix if it is not given
+LOG_INFO = 20
+LOG_ERROR = 40
+LOG_LEVEL = LOG_DEBUG # the lowest level written to the log, raise it to LOG_INFO or LOG_ERROR to skip the per message chatter
+LOG_QUEUE_LIMIT = 100000 # most log lines waiting for the writer thread, more than that are dropped (and counted)
+LOG_FLUSH_INTERVAL = 0.01 # seconds the log writer waits for more lines before writing, the most a line sits in memory
+METRICS_PREFIX = "node_" # put in front of every metric name on the metrics endpoint
+METRICS_RATE_INTERVAL = 10 # seconds between working out the per second rates (signature checks, hashrate)
+VALIDATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5) # block validation time histogram buckets, seconds
+REORG_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100) # reorg depth histogram buckets, blocks
+TRACE_SAMPLE_RATE = 0.01 # fraction of messages handled and blocks mined that are traced
+TRACE_BUFFER_SIZE = 20000 # most trace spans kept in memory for a dump, the oldest are dropped first
+TRACE_ID_SIZE = 8
+PROFILE_INTERVAL = 0.005 # seconds between stack samples while the profiler is on
+PROFILE_SUMMARY_LINES = 25 # functions listed in the profile summary
+ADMIN_TIMEOUT = 10 # seconds an admin socket client gets to send its command (and the admin client waits for the reply)
+ADMIN_MAX_COMMAND = 4096 # longest admin command line, in bytes
+PEER_CPU_RATE = 0.2 # seconds of our CPU each node earns per second
+PEER_CPU_BURST = 2.0 # most CPU seconds a node can save up
+PEER_CPU_DEBT_LIMIT = 5.0 # a node whose bucket goes this far below zero is disconnected
+BAD_NODE_COST_FACTOR = 2 # nodes we have sent errors to pay this many times the cost of each message
+MAX_NODE_ERRORS = 20 # errors we send a node before disconnecting it
+RATE_LIMITED_TYPES = (VOTE, VOTE_BATCH, ELECTION, BLOCK, CMPCT_BLOCK, GET_BLOCK, GET_BLOCKS, GET_BLOCK_TXN, GET_HEADERS, GET_LONGEST_CHAIN, GET_ELECTION_RES, GET_ACTIVE_ELECTIONS, GET_PEERS) # what a node can send us without us asking
+MIN_COST_SAMPLES = 20 # messages of a type we handle before trusting the measured cost over the default
+DEFAULT_MESSAGE_COST = 0.001 # seconds, for types not in MESSAGE_COSTS
+MESSAGE_COSTS = { # starting guesses (seconds) of what each message costs us, replaced by the measured average
+    VOTE: 0.002,
+    VOTE_BATCH: 0.05,
+    ELECTION: 0.002,
+    BLOCK: 0.05,
+    CMPCT_BLOCK: 0.05,
+    GET_LONGEST_CHAIN: 0.05,
+    GET_ELECTION_RES: 0.05,
+    GET_HEADERS: 0.005,
+    GET_BLOCKS: 0.01,
+}
 MAX_BLOCK_SIZE = 1024 * 1024
 TARGET = 2**32
 MAX_LEVELS = 8
 START_ZEROS = 2
 CLAMP = 1.3
 TIME_TARGET = 5 # seconds
+MAX_FUTURE_TIME = 120 # seconds a block's timestamp can be ahead of our clock
 def hashy(data):
     """
     Hashes the data using SHA-256.